@@ -3,10 +3,11 @@
 GOYOUTATI x OMISHONIN 雲倉
 """
 
-from flask import Flask, request, jsonify, render_template, make_response, send_file, session
+from flask import Flask, Response, request, jsonify, render_template, make_response, send_file, session
 from datetime import datetime, timedelta
 import requests
 import json
+import base64
 import os
 import sqlite3
 import csv
@@ -16,10 +17,29 @@ import time
 import re
 import secrets
 import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:     # 非 POSIX（本機 Windows 開發）：沒有跨行程鎖，各 worker 自己更新
+    fcntl = None
 
 # 廠商出貨檔案範本（Nigel / JpD…）
 import vendors as vendor_templates
 
+# Shopify 批次匯出（會員全量匯入）、會員記憶體索引
+import shopify_bulk
+import shopify_webhook
+from member_directory import LookupCache, MemberDirectory
+
+# SQLite 連線池（get_db() 重用已設定好的連線）
+import batch_writer
+import http_client
+import dbpool
+import events
+import g_codes
+import migrations
+
 # PWA（manifest / service worker）
 from pwa import register_pwa
 from openpyxl import Workbook
@@ -35,6 +55,9 @@ app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(days=7)
 # PWA：註冊 /sw.js + /manifest.webmanifest + /admin-manifest.webmanifest 三條路由
 register_pwa(app)
 
+# 連線池：request 結束時歸還沒 close 的連線
+dbpool.init_app(app)
+
 # 對帳模組：/recon 上傳銷帳檔比對帳單（限老闆）。DB_PATH 讓 recon 沿用同一個資料庫
 app.config["DB_PATH"] = os.environ.get("DB_PATH", "packages.db")
 try:
@@ -52,6 +75,12 @@ JPD_DELIV_ID = int(os.environ.get("JPD_DELIV_ID", "40"))  # 台灣空運線
 
 SHOPIFY_STORE = os.environ.get("SHOPIFY_STORE", "")
 SHOPIFY_ACCESS_TOKEN = os.environ.get("SHOPIFY_ACCESS_TOKEN", "")
+# Admin API 網址；離線測試可指到 shopify_standin.py（例：http://127.0.0.1:8765/admin/api/2026-01）
+SHOPIFY_ADMIN_URL = os.environ.get("SHOPIFY_ADMIN_URL") or f"https://{SHOPIFY_STORE}/admin/api/2026-01"
+# 全量抓會員先走批次匯出（不受分頁上限、一次抓全部）；設 0 → 只用分頁
+SHOPIFY_BULK_IMPORT = os.environ.get("SHOPIFY_BULK_IMPORT", "1") == "1"
+# webhook 簽章用的 app client secret；沒設 → webhook 一律拒收
+SHOPIFY_WEBHOOK_SECRET = os.environ.get("SHOPIFY_WEBHOOK_SECRET", "")
 
 # 預設運費（台幣/kg），0 表示未設定
 DEFAULT_SHIPPING_RATE = int(os.environ.get("DEFAULT_SHIPPING_RATE", "0"))
@@ -66,12 +95,9 @@ DB_PATH = os.environ.get("DB_PATH", "packages.db")
 # ============ SQLite 初始化 ============
 
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    # 等鎖最多 5 秒（預設 0 秒）→ 大幅減少「database is locked」錯誤、
-    # 多 worker / LINE Bot / 客戶端同時操作時不互卡
-    conn.execute("PRAGMA busy_timeout=5000")
-    return conn
+    """向連線池借一條連線（row_factory=Row、busy_timeout 等 PRAGMA 已設好，見 dbpool.py）。
+    用法不變：用完 conn.close() 即歸還；同一個 request 內的巢狀呼叫共用同一條。"""
+    return dbpool.connect(DB_PATH)
 
 
 # ============ 加值服務預設目錄 ============
@@ -167,16 +193,43 @@ def delivery_tracking_url(carrier, tracking):
     return f"https://www.t-cat.com.tw/Inquire/TraceDetail.aspx?BillID={t}"
 
 
+def _match_delivery_codes(conn, codes):
+    """試算表這些客戶編號可能對應的出貨單（export_code 相同，或同會員的 {g_code}-{MMDD}）重新比對；回傳新對到的筆數"""
+    g_codes = {c.rsplit("-", 1)[0] for c in codes if "-" in c}
+    rows = {}
+    for col, keys in (("export_code", codes), ("g_code", g_codes)):
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            for r in conn.execute(f"SELECT {migrations.DELIVERY_MATCH_COLS} FROM shipment_requests "
+                                  f"WHERE {col} IN ({','.join('?' * len(chunk))})", chunk):
+                rows[r[0]] = tuple(r)
+    return migrations.match_shipment_delivery(conn, rows.values())
+
+
+def _match_delivery_ids(conn, shipment_ids):
+    """出貨單的 export_code / updated_at 變了 → 重算它們的台灣配送對應"""
+    ids = list(shipment_ids)
+    if not ids:
+        return 0
+    rows = conn.execute(f"SELECT {migrations.DELIVERY_MATCH_COLS} FROM shipment_requests "
+                        f"WHERE id IN ({','.join('?' * len(ids))})", ids).fetchall()
+    return migrations.match_shipment_delivery(conn, rows)
+
+
 def sync_delivery_tracking():
-    """抓取貨運行試算表 CSV，解析後 upsert 進 delivery_tracking。回傳寫入筆數。"""
+    """抓取貨運行試算表 CSV，解析後 upsert 進 delivery_tracking，並把對到的出貨單寫進 shipment_delivery。
+
+    回傳 (寫入筆數, 新對到的出貨單數)。
+    """
     url = _get_setting("tracking_sheet_url", DEFAULT_TRACKING_SHEET_URL)
-    resp = requests.get(url, timeout=20)
+    resp = http_client.request("GET", url, timeout=20)
     resp.raise_for_status()
     text = resp.content.decode("utf-8-sig", errors="replace")
     reader = csv.reader(io.StringIO(text))
     rows = list(reader)
     if not rows:
-        return 0
+        return 0, 0
 
     # 依標題找欄位（容忍欄位順序變動）；找不到就用固定位置 C=2 / F=5 / G=6
     header = [h.strip() for h in rows[0]]
@@ -192,6 +245,7 @@ def sync_delivery_tracking():
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     conn = get_db()
     count = 0
+    codes = set()
     for r in rows[1:]:
         if len(r) <= max(ci_code, ci_track, ci_carrier):
             continue
@@ -207,11 +261,13 @@ def sync_delivery_tracking():
             "carrier=excluded.carrier, tracking_num=excluded.tracking_num, synced_at=excluded.synced_at",
             (code, carrier, tracking, now)
         )
+        codes.add(code)
         count += 1
+    matched = _match_delivery_codes(conn, codes)
     conn.commit()
     conn.close()
     _set_setting("tracking_last_sync", now)
-    return count
+    return count, matched
 
 
 def maybe_auto_sync():
@@ -230,8 +286,8 @@ def maybe_auto_sync():
         _set_setting("tracking_last_sync", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
         def _run():
             try:
-                n = sync_delivery_tracking()
-                print(f"[tracking] 自動同步完成，{n} 筆", flush=True)
+                n, matched = sync_delivery_tracking()
+                print(f"[tracking] 自動同步完成，{n} 筆，新對到 {matched} 張出貨單", flush=True)
             except Exception as e:
                 print(f"[tracking] 自動同步失敗: {e}", flush=True)
             finally:
@@ -243,310 +299,11 @@ def maybe_auto_sync():
 
 def init_db():
     conn = get_db()
-    # ===== 啟用 WAL 模式（一次性設定，會持久化在 DB 檔案內）=====
-    # WAL：讀寫不互鎖、併發效能大幅提升（讀者不擋寫者、寫者不擋讀者）
-    # synchronous=NORMAL：搭配 WAL 安全，速度比 FULL 快很多
-    try:
-        conn.execute("PRAGMA journal_mode=WAL")
-        conn.execute("PRAGMA synchronous=NORMAL")
-        mode_row = conn.execute("PRAGMA journal_mode").fetchone()
-        print(f"[DB] ✅ SQLite journal_mode = {mode_row[0]}", flush=True)
-    except Exception as e:
-        print(f"[DB] ⚠️ 啟用 WAL 失敗（將使用預設模式）: {e}", flush=True)
-
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS packages (
-            id          INTEGER PRIMARY KEY AUTOINCREMENT,
-            g_code      TEXT    NOT NULL,
-            logis_num   TEXT,
-            product_name TEXT   DEFAULT '',
-            weight      TEXT    DEFAULT '',
-            status      TEXT    DEFAULT '已到貨',
-            note        TEXT    DEFAULT '',
-            in_date     TEXT,
-            created_at  TEXT    NOT NULL
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS shipment_requests (
-            id          INTEGER PRIMARY KEY AUTOINCREMENT,
-            g_code      TEXT    NOT NULL,
-            customer_name TEXT  DEFAULT '',
-            package_ids TEXT    NOT NULL,
-            package_summary TEXT DEFAULT '',
-            status      TEXT    DEFAULT '待處理',
-            note        TEXT    DEFAULT '',
-            admin_note  TEXT    DEFAULT '',
-            created_at  TEXT    NOT NULL,
-            updated_at  TEXT
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS forecasts (
-            id          INTEGER PRIMARY KEY AUTOINCREMENT,
-            g_code      TEXT    NOT NULL,
-            customer_name TEXT  DEFAULT '',
-            items_json  TEXT    NOT NULL,
-            status      TEXT    DEFAULT '待處理',
-            note        TEXT    DEFAULT '',
-            created_at  TEXT    NOT NULL
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS admin_settings (
-            key   TEXT PRIMARY KEY,
-            value TEXT NOT NULL
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS delivery_tracking (
-            customer_code TEXT PRIMARY KEY,
-            carrier       TEXT DEFAULT '',
-            tracking_num  TEXT DEFAULT '',
-            synced_at     TEXT DEFAULT ''
-        )
-    """)
-    # ── 員工班表（老闆排班，員工登入可看全部人本月+下月）──
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS staff_schedules (
-            id         INTEGER PRIMARY KEY AUTOINCREMENT,
-            staff_id   INTEGER NOT NULL,
-            staff_name TEXT DEFAULT '',
-            work_date  TEXT NOT NULL,
-            start_time TEXT DEFAULT '',
-            end_time   TEXT DEFAULT '',
-            created_at TEXT NOT NULL
-        )
-    """)
-    # ── 操作紀錄（誰做了什麼：到貨建立/出貨/帳單確認/認領）──
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS operation_logs (
-            id         INTEGER PRIMARY KEY AUTOINCREMENT,
-            operator   TEXT DEFAULT '',
-            role       TEXT DEFAULT '',
-            action     TEXT DEFAULT '',
-            target     TEXT DEFAULT '',
-            detail     TEXT DEFAULT '',
-            created_at TEXT NOT NULL
-        )
-    """)
-    # ── 無主包裹認領牆（沒客編/羅馬拼音的包裹，先登記保留到倉日，認領後轉入 packages）──
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS unclaimed_packages (
-            id              INTEGER PRIMARY KEY AUTOINCREMENT,
-            recipient_name  TEXT DEFAULT '',
-            logis_num       TEXT DEFAULT '',
-            product_name    TEXT DEFAULT '',
-            weight          TEXT DEFAULT '',
-            note            TEXT DEFAULT '',
-            registered_date TEXT,
-            created_at      TEXT NOT NULL
-        )
-    """)
-    # ── 停用會員名單（集運系統層級，不動 Shopify；g_code 為鍵）──
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS disabled_members (
-            g_code       TEXT PRIMARY KEY,
-            reason       TEXT DEFAULT '',
-            disabled_at  TEXT DEFAULT ''
-        )
-    """)
-    # ── 代理每週分潤撥款記錄（agent_id + period_key 唯一）──
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS agent_payouts (
-            id            INTEGER PRIMARY KEY AUTOINCREMENT,
-            agent_id      INTEGER NOT NULL,
-            period_key    TEXT NOT NULL,
-            amount        REAL DEFAULT 0,
-            payment_last5 TEXT DEFAULT '',
-            paid_at       TEXT DEFAULT '',
-            note          TEXT DEFAULT '',
-            created_at    TEXT DEFAULT '',
-            UNIQUE(agent_id, period_key)
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS addresses (
-            id          INTEGER PRIMARY KEY AUTOINCREMENT,
-            g_code      TEXT    NOT NULL,
-            label       TEXT    DEFAULT '',
-            recipient   TEXT    NOT NULL,
-            phone       TEXT    NOT NULL,
-            zipcode     TEXT    DEFAULT '',
-            address     TEXT    NOT NULL,
-            is_default  INTEGER DEFAULT 0,
-            created_at  TEXT    NOT NULL
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS announcements (
-            id          INTEGER PRIMARY KEY AUTOINCREMENT,
-            title       TEXT    NOT NULL,
-            content     TEXT    NOT NULL,
-            is_active   INTEGER DEFAULT 1,
-            created_at  TEXT    NOT NULL
-        )
-    """)
-    # ── 內部公告（只給後台老闆/員工看，客戶端讀不到）──
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS internal_announcements (
-            id          INTEGER PRIMARY KEY AUTOINCREMENT,
-            title       TEXT    NOT NULL,
-            content     TEXT    NOT NULL,
-            is_active   INTEGER DEFAULT 1,
-            created_at  TEXT    NOT NULL
-        )
-    """)
-    # ── 內部公告已讀記錄（誰按過「我知道了」）──
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS internal_ann_reads (
-            username    TEXT NOT NULL,
-            ann_id      INTEGER NOT NULL,
-            read_at     TEXT NOT NULL,
-            UNIQUE(username, ann_id)
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS admin_users (
-            id          INTEGER PRIMARY KEY AUTOINCREMENT,
-            username    TEXT    UNIQUE NOT NULL,
-            password    TEXT    NOT NULL,
-            role        TEXT    DEFAULT 'admin',
-            created_at  TEXT    NOT NULL
-        )
-    """)
-    # ===== 代理帳號表（Phase 1）=====
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS agents (
-            id              INTEGER PRIMARY KEY AUTOINCREMENT,
-            username        TEXT UNIQUE NOT NULL,
-            password        TEXT NOT NULL,
-            prefix          TEXT UNIQUE NOT NULL,
-            name            TEXT NOT NULL,
-            min_rate        REAL DEFAULT 180,
-            contact_phone   TEXT DEFAULT '',
-            contact_email   TEXT DEFAULT '',
-            status          TEXT DEFAULT 'active',
-            note            TEXT DEFAULT '',
-            created_at      TEXT NOT NULL
-        )
-    """)
-    # ===== 會員表（代理建的客戶，存本地；你自己的客戶仍走 Shopify）=====
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS members (
-            g_code          TEXT PRIMARY KEY,
-            agent_id        INTEGER NOT NULL,
-            name            TEXT NOT NULL,
-            password        TEXT DEFAULT '',
-            phone           TEXT DEFAULT '',
-            address         TEXT DEFAULT '',
-            line_id         TEXT DEFAULT '',
-            email           TEXT DEFAULT '',
-            note            TEXT DEFAULT '',
-            status          TEXT DEFAULT 'active',
-            created_at      TEXT NOT NULL
-        )
-    """)
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_members_agent ON members(agent_id)")
-    # 帳單欄位遷移（已存在的表加欄位）
-    for col, col_type, default in [
-        ("admin_note", "TEXT", "''"),
-        ("updated_at", "TEXT", "NULL"),
-        ("billed_weight", "REAL", "0"),
-        ("rate_per_kg", "REAL", "0"),
-        ("shipping_fee", "REAL", "0"),
-        ("handling_fee", "REAL", "0"),
-        ("total_fee", "REAL", "0"),
-        ("payment_last5", "TEXT", "''"),
-        ("payment_at", "TEXT", "''"),
-        ("tracking_num", "TEXT", "''"),
-        ("extra_services", "TEXT", "''"),
-        ("ship_recipient", "TEXT", "''"),
-        ("ship_phone", "TEXT", "''"),
-        ("ship_address", "TEXT", "''"),
-        ("consolidation_fee", "REAL", "0"),
-        ("letter_fee", "REAL", "0"),
-        ("boxes_json", "TEXT", "''"),   # 多箱明細 [{actual_weight,length,width,height,tracking_num,billed_weight}]
-        # 出檔案給廠商（Nigel / JpD）追蹤欄位
-        ("exported_at", "TEXT", "''"),
-        ("exported_vendor", "TEXT", "''"),
-        ("exported_batch_id", "TEXT", "''"),
-    ]:
-        try:
-            conn.execute(f"ALTER TABLE shipment_requests ADD COLUMN {col} {col_type} DEFAULT {default}")
-        except:
-            pass
-
-    # ===== Phase 2: 加 agent_id 欄位（既有資料預設 0 = 主管理員的）=====
-    for table in ["packages", "forecasts", "shipment_requests", "announcements"]:
-        try:
-            conn.execute(f"ALTER TABLE {table} ADD COLUMN agent_id INTEGER DEFAULT 0")
-            print(f"[migrate] 已加 {table}.agent_id 欄位", flush=True)
-        except:
-            pass
-    # 索引加速 agent 過濾
-    for table in ["packages", "forecasts", "shipment_requests"]:
-        try:
-            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_agent ON {table}(agent_id)")
-        except:
-            pass
-
-    # ===== Phase 3+: 加 members.shipping_rate 欄位（代理為每個客戶設定獨立費率）=====
-    # 預設 0 = 沿用該代理的 min_rate；>0 = 該會員的專屬費率
-    try:
-        conn.execute("ALTER TABLE members ADD COLUMN shipping_rate REAL DEFAULT 0")
-        print("[migrate] 已加 members.shipping_rate 欄位", flush=True)
-    except:
-        pass
-
-    # ===== 包裹類型欄位：區分「包裹」與「信件」（信件計費一件 +NT$20，見帳單邏輯）=====
-    try:
-        conn.execute("ALTER TABLE packages ADD COLUMN pkg_type TEXT DEFAULT '包裹'")
-        print("[migrate] 已加 packages.pkg_type 欄位", flush=True)
-    except:
-        pass
-
-    # ===== 出檔案客戶編號（{g_code}-{MMDD}）：存起來供台灣配送貨況比對 =====
-    try:
-        conn.execute("ALTER TABLE shipment_requests ADD COLUMN export_code TEXT DEFAULT ''")
-        print("[migrate] 已加 shipment_requests.export_code 欄位", flush=True)
-    except:
-        pass
-
-    # ===== 客戶 × 廠商編號對照（出檔案給 Nigel / JpD 等廠商時用） =====
-    # 對 Shopify 主帳號客戶 + 代理客戶都通用
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS customer_vendor_codes (
-            g_code TEXT NOT NULL,
-            vendor TEXT NOT NULL,
-            code TEXT NOT NULL,
-            updated_at TEXT,
-            PRIMARY KEY (g_code, vendor)
-        )
-    """)
-
-    # ===== 代理品牌欄位（用於 referral URL + 登入後客製內容）=====
-    for col, col_type, default in [
-        ("contact_line", "TEXT", "''"),
-        ("insurance_url", "TEXT", "''"),
-        ("insurance_label", "TEXT", "''"),
-        ("insurance_desc", "TEXT", "''"),
-        ("signup_guide", "TEXT", "''"),
-        ("promo_text", "TEXT", "''"),
-        ("promo_price", "TEXT", "''"),
-        ("owner_name", "TEXT", "''"),
-        ("owner_address", "TEXT", "''"),
-        ("bank_code", "TEXT", "''"),
-        ("bank_name", "TEXT", "''"),
-        ("bank_branch", "TEXT", "''"),
-        ("bank_account", "TEXT", "''"),
-        ("bank_account_name", "TEXT", "''"),
-    ]:
-        try:
-            conn.execute(f"ALTER TABLE agents ADD COLUMN {col} {col_type} DEFAULT {default}")
-            print(f"[migrate] 已加 agents.{col} 欄位", flush=True)
-        except:
-            pass
+    # ===== schema 版本遷移（見 migrations.py）=====
+    # 已是最新版本 → 只查一次 schema_version 就結束，不拿寫鎖；部署時 Procfile 會先跑一次
+    applied = migrations.migrate(conn)
+    if applied:
+        print(f"[DB] schema 已更新到 v{migrations.LATEST}（本次套用 {applied}）", flush=True)
 
     # ===== 首次 seed 加值服務目錄（之後由後台管理，不覆寫既有值）=====
     try:
@@ -592,7 +349,9 @@ def jpd_request(operation, data):
     print(f"\n{'='*50}")
     print(f"📤 JPD API 請求: {operation}")
     try:
-        response = requests.post(url, json=payload, timeout=30)
+        # 只有查詢類（TSearch*）可以逾時重送；建單 / 預報重送可能重複建立
+        response = http_client.request("POST", url, json=payload, timeout=30,
+                                       idempotent=operation.startswith("TSearch"))
         result = response.json()
         return result
     except Exception as e:
@@ -601,7 +360,7 @@ def jpd_request(operation, data):
 
 
 def shopify_graphql(query, variables=None):
-    graphql_url = f"https://{SHOPIFY_STORE}/admin/api/2026-01/graphql.json"
+    graphql_url = f"{SHOPIFY_ADMIN_URL}/graphql.json"
     headers = {
         "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
         "Content-Type": "application/json"
@@ -610,24 +369,21 @@ def shopify_graphql(query, variables=None):
     if variables:
         payload["variables"] = variables
     try:
-        response = requests.post(graphql_url, headers=headers, json=payload, timeout=15)
-        return response.json()
+        return http_client.graphql(graphql_url, payload, headers=headers, timeout=15)
     except Exception as e:
         print(f"❌ GraphQL 錯誤: {e}")
         return {"error": str(e)}
 
 
 def shopify_request(endpoint, method="GET", data=None):
-    url = f"https://{SHOPIFY_STORE}/admin/api/2026-01/{endpoint}"
+    url = f"{SHOPIFY_ADMIN_URL}/{endpoint}"
     headers = {
         "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
         "Content-Type": "application/json"
     }
     try:
-        if method == "GET":
-            response = requests.get(url, headers=headers, timeout=30)
-        elif method == "POST":
-            response = requests.post(url, headers=headers, json=data, timeout=30)
+        response = http_client.request(method, url, headers=headers, json=data if method != "GET" else None,
+                                       timeout=30)
         return response.json()
     except Exception as e:
         return {"error": str(e)}
@@ -635,6 +391,8 @@ def shopify_request(endpoint, method="GET", data=None):
 
 # ============ Shopify 會員快取 ============
 # 持久化到磁碟（容器重啟、Zeabur 重新部署都不用重抓）+ stale-while-revalidate
+# 多 worker 共用同一份磁碟快取：更新前先拿 .lock 檔的 flock（single-flight，同時間只有一個行程抓 Shopify），
+# 其他 worker 看快取檔的 (mtime, size) 戳記變了就重讀，不各自重抓
 
 # 快取檔案位置：跟 DB 放同個目錄（Zeabur Volume 持久化）
 _db_dir = os.path.dirname(os.path.abspath(DB_PATH))
@@ -642,22 +400,120 @@ SHOPIFY_CACHE_FILE = os.environ.get(
     "SHOPIFY_CACHE_FILE",
     os.path.join(_db_dir or ".", "shopify_cache.json")
 )
-CACHE_TTL = 600  # 10 分鐘
-
-_customers_cache = {"data": None, "time": 0}
+SHOPIFY_LOCK_FILE = SHOPIFY_CACHE_FILE + ".lock"
+CACHE_TTL = 600  # 10 分鐘：過期後只抓「這段時間有異動」的會員（增量同步）
+# 搶不到更新鎖的 worker 隔多久再試（期間直接用現有資料，等別人寫好的新快取）
+REFRESH_RETRY_SEC = 30
+# webhook / 改運費寫回快取時最多等更新鎖幾秒（整批同步可能佔鎖 shopify_bulk.TIMEOUT_SEC 秒，不能跟著卡住）
+CHANGE_LOCK_WAIT = 5
+# 全量對帳間隔：增量抓不到「被刪除」的會員，定期整批重抓一次
+FULL_SYNC_INTERVAL = int(os.environ.get("SHOPIFY_FULL_SYNC_SEC", "21600"))  # 6 小時
+
+# hwm = 已同步到的最大 customer.updatedAt（增量同步的起點）；full_time = 上次全量抓取時間
+_customers_cache = {"data": None, "time": 0, "hwm": "", "full_time": 0}
 _cache_lock = threading.Lock()
 _refresh_thread = None  # 背景更新執行緒（同時間只允許一個）
+_next_refresh_try = 0   # 本 worker 下次可以再啟動背景更新的時間
+_disk_stamp = None      # 記憶體快取對應的磁碟快取檔戳記（mtime_ns, size）
+# 目前快取對應的會員索引（客編 / gid）；快取換新就整個換掉
+_member_dir = MemberDirectory([])
+# 冷啟動登入用的單一會員查詢結果（整份名單還沒抓好時才用；webhook 異動時清掉）
+_member_lookups = LookupCache(size=256, ttl=300, miss_ttl=60)
+
+
+def member_directory():
+    """目前已快取的 Shopify 會員索引（不觸發抓取）。快取清單換了才重建，一次更新只建一次。"""
+    global _member_dir
+    _pick_up_shared_cache()
+    data = _customers_cache.get("data") or []
+    d = _member_dir
+    if d.members is not data:
+        d = MemberDirectory(data)
+        _member_dir = d
+    return d
+
+
+def lookup_shopify_member(g_code):
+    """單一 Shopify 會員（登入用）。已有整份名單 → 索引 O(1)；
+    冷啟動（沒有快取）→ 不等全量抓取：先查鏡像表 / 小 LRU，都沒有才向 Shopify 問這一個客編（一次往返），
+    同時在背景暖整份名單。查詢失敗丟 RuntimeError。"""
+    _pick_up_shared_cache()
+    if _customers_cache.get("data") is not None:
+        return get_member_directory().get(g_code)
+    _start_background_refresh("ShopifyWarm")
+    c = _member_lookups.get(g_code)
+    if c is not LookupCache.MISS:
+        return c
+    conn = get_db()
+    row = conn.execute(f"SELECT {', '.join(_SHOPIFY_MEMBER_COLS)} FROM shopify_members WHERE g_code=? LIMIT 1",
+                       (g_code,)).fetchone()
+    conn.close()
+    c = dict(row) if row else _fetch_customer_by_g_code(g_code)
+    _member_lookups.put(g_code, c)
+    return c
+
+
+def get_member_directory(force_refresh=False):
+    """同 get_all_goyoutati_customers（必要時抓取 / 背景更新），回傳索引。"""
+    get_all_goyoutati_customers(force_refresh=force_refresh)
+    return member_directory()
+
+
+def _cache_file_stamp():
+    try:
+        st = os.stat(SHOPIFY_CACHE_FILE)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+def _pick_up_shared_cache():
+    """別的 worker 寫了新一版磁碟快取 → 重讀（只花一次 stat；沒變就什麼都不做）"""
+    stamp = _cache_file_stamp()
+    if stamp is not None and stamp != _disk_stamp:
+        _load_cache_from_disk()
+
+
+@contextmanager
+def _refresh_lock(blocking=True, timeout=None):
+    """跨 worker 的會員快取更新鎖（flock）；blocking=False 拿不到 → yield False；
+    timeout=秒數 → 最多等這麼久，還拿不到 → yield False"""
+    if fcntl is None:
+        yield True
+        return
+    deadline = None if timeout is None else time.monotonic() + timeout
+    f = open(SHOPIFY_LOCK_FILE, "a+")
+    try:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking and deadline is None else fcntl.LOCK_NB))
+                break
+            except BlockingIOError:
+                if deadline is None or time.monotonic() >= deadline:
+                    yield False
+                    return
+                time.sleep(0.05)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        f.close()
 
 
 def _load_cache_from_disk():
-    """容器啟動時嘗試從磁碟讀取快取，避免每次重啟都要等 Shopify 慢慢回應。"""
-    global _customers_cache
+    """容器啟動時嘗試從磁碟讀取快取，避免每次重啟都要等 Shopify 慢慢回應。
+    別的 worker 更新過磁碟快取時也用這個重讀。"""
+    global _customers_cache, _disk_stamp
     try:
-        if os.path.exists(SHOPIFY_CACHE_FILE):
+        stamp = _cache_file_stamp()
+        if stamp is not None:
             with open(SHOPIFY_CACHE_FILE, "r", encoding="utf-8") as f:
                 data = json.load(f)
+            _disk_stamp = stamp
             if data.get("data"):
-                _customers_cache = {"data": data["data"], "time": data.get("time", 0)}
+                _customers_cache = {"data": data["data"], "time": data.get("time", 0),
+                                    "hwm": data.get("hwm", ""), "full_time": data.get("full_time", 0)}
                 age = int(time.time() - _customers_cache["time"])
                 print(f"[Shopify] 📂 從磁碟讀取快取：{len(_customers_cache['data'])} 位會員（{age}秒前）", flush=True)
     except Exception as e:
@@ -665,29 +521,104 @@ def _load_cache_from_disk():
 
 
 def _save_cache_to_disk():
-    """以原子方式寫入磁碟（先寫 .tmp 再 rename，避免多 worker 競爭時寫到一半）"""
+    """以原子方式寫入磁碟（先寫 .tmp 再 rename，讀的 worker 不會讀到寫一半的檔）"""
+    global _disk_stamp
     try:
         os.makedirs(os.path.dirname(os.path.abspath(SHOPIFY_CACHE_FILE)) or ".", exist_ok=True)
-        tmp = SHOPIFY_CACHE_FILE + ".tmp"
+        tmp = f"{SHOPIFY_CACHE_FILE}.{os.getpid()}.tmp"
         with open(tmp, "w", encoding="utf-8") as f:
             json.dump(_customers_cache, f, ensure_ascii=False)
         os.replace(tmp, SHOPIFY_CACHE_FILE)
+        _disk_stamp = _cache_file_stamp()   # 自己寫的這版不必再重讀
     except Exception as e:
         print(f"[Shopify] ⚠️ 寫入磁碟快取失敗: {e}", flush=True)
 
 
+# shopify_members 鏡像表欄位（= 快取裡每位會員 dict 的鍵）
+_SHOPIFY_MEMBER_COLS = ("gid", "customer_id", "g_code", "name", "email", "phone", "phone_raw",
+                        "address", "shipping_rate", "created_at", "updated_at")
+
+
+def _mirror_shopify_members(customers=None, changed=None):
+    """把會員快取寫進 shopify_members（單一交易，讀的人看不到寫一半的狀態）。
+
+    customers：全量 → 整表換掉；changed：增量 {gid: 會員或 None} → 只 upsert / 刪除這幾位。
+    """
+    cols = ", ".join(_SHOPIFY_MEMBER_COLS)
+    sql = f"INSERT OR REPLACE INTO shopify_members ({cols}) VALUES ({', '.join('?' * len(_SHOPIFY_MEMBER_COLS))})"
+    t0 = time.time()
+    conn = dbpool.connect(DB_PATH, shared=False)
+    try:
+        with conn:
+            if customers is not None:
+                conn.execute("DELETE FROM shopify_members")
+                rows = customers
+            else:
+                gone = [(gid,) for gid, c in changed.items() if c is None]
+                for gid, in gone:
+                    old = conn.execute("SELECT g_code FROM shopify_members WHERE gid=?", (gid,)).fetchone()
+                    if old:
+                        g_codes.release(conn, old[0])
+                if gone:
+                    conn.executemany("DELETE FROM shopify_members WHERE gid=?", gone)
+                rows = [c for c in changed.values() if c is not None]
+            conn.executemany(sql, ([str(c.get(k) or "") for k in _SHOPIFY_MEMBER_COLS]
+                                   for c in rows if c.get("gid")))
+            # G 字頭配號：全量 → 依現有編號重算；增量 → 新出現的編號從空號清單拿掉
+            if customers is not None:
+                g_codes.rebuild(conn, "G")
+            else:
+                for c in rows:
+                    g_codes.claim(conn, c.get("g_code"))
+            # 會員清單 ETag 用（不掛 trigger：全量一次幾萬列，整批只 +1）
+            conn.execute("UPDATE change_counters SET n = n + 1 WHERE name = 'shopify_members'")
+        print(f"[Shopify] shopify_members 已更新 {len(rows)} 位（{time.time() - t0:.2f}s）", flush=True)
+    except sqlite3.Error as e:
+        print(f"[Shopify] ⚠️ 寫入 shopify_members 失敗: {e}", flush=True)
+    finally:
+        conn.close()
+
+
+def _ensure_shopify_members_mirror():
+    """開機：鏡像表是空的（剛加這張表）但磁碟快取有資料 → 補寫一次（只由拿到更新鎖的 worker 做）"""
+    data = _customers_cache.get("data")
+    if not data:
+        return
+    conn = get_db()
+    empty = conn.execute("SELECT 1 FROM shopify_members LIMIT 1").fetchone() is None
+    conn.close()
+    if empty:
+        with _refresh_lock(blocking=False) as locked:
+            if locked:
+                _mirror_shopify_members(data)
+
+
+def _member_fallback_map(conn, g_codes):
+    """出貨單收件資訊 fallback：g_code → {name, phone, address}；members 表優先，其次 Shopify 鏡像表（一條 UNION）"""
+    out = {}
+    if not g_codes:
+        return out
+    ph = ",".join(["?"] * len(g_codes))
+    rows = conn.execute(f"""
+        SELECT g_code, name, phone, address, 0 AS src FROM members WHERE g_code IN ({ph})
+        UNION ALL
+        SELECT g_code, name, phone, address, 1 FROM shopify_members WHERE g_code IN ({ph})
+        ORDER BY src
+    """, list(g_codes) * 2).fetchall()
+    for r in rows:
+        out.setdefault(r["g_code"], {"name": r["name"], "phone": r["phone"], "address": r["address"]})
+    return out
+
+
 def _refresh_shopify_async():
     """背景靜默更新（呼叫者立刻回舊資料、不阻塞使用者）"""
     global _customers_cache, _refresh_thread
     try:
         t0 = time.time()
         print("[Shopify] 🔄 背景重新抓取會員…", flush=True)
-        customers = _fetch_customers_from_shopify()
+        customers = _sync_customers(wait=False)
         elapsed = time.time() - t0
         if customers:
-            with _cache_lock:
-                _customers_cache = {"data": customers, "time": time.time()}
-            _save_cache_to_disk()
             print(f"[perf] Shopify 背景更新完成: {len(customers)} 位、{elapsed:.2f}s", flush=True)
         else:
             print(f"[Shopify] ⚠️ 背景抓取回空，保留舊快取（{elapsed:.2f}s）", flush=True)
@@ -698,15 +629,30 @@ def _refresh_shopify_async():
             _refresh_thread = None
 
 
+def _start_background_refresh(name="ShopifyRefresh"):
+    """啟動背景更新（本 worker 同時間只一條；別的 worker 正在更新時 REFRESH_RETRY_SEC 內不重試）"""
+    global _refresh_thread, _next_refresh_try
+    with _cache_lock:
+        if _refresh_thread is not None and _refresh_thread.is_alive():
+            return False
+        if time.time() < _next_refresh_try:
+            return False
+        _next_refresh_try = time.time() + REFRESH_RETRY_SEC
+        _refresh_thread = threading.Thread(target=_refresh_shopify_async, daemon=True, name=name)
+        _refresh_thread.start()
+        return True
+
+
 def get_all_goyoutati_customers(force_refresh=False):
     """
     取得 Shopify 會員清單。Stale-while-revalidate 行為：
-      • force_refresh=True：同步等新資料（admin 按「整理」用）
+      • force_refresh=True：同步等新資料（admin 按「整理」用；全量重抓）
       • 完全無快取（冷啟動、磁碟也沒有）：同步等
-      • 有快取但過期：立刻回舊資料，背景靜默更新
+      • 有快取但過期：立刻回舊資料，背景靜默更新（增量：只抓 updatedAt ≥ hwm 的會員）
       • 有快取且新鮮：直接回（最快路徑，無 print）
+    每次先看磁碟快取戳記：別的 worker 更新過就直接讀它那版。
     """
-    global _customers_cache, _refresh_thread
+    _pick_up_shared_cache()
     now = time.time()
     has_cache = _customers_cache.get("data") is not None
     age = now - _customers_cache.get("time", 0)
@@ -716,12 +662,9 @@ def get_all_goyoutati_customers(force_refresh=False):
     if force_refresh:
         t0 = time.time()
         try:
-            customers = _fetch_customers_from_shopify()
+            customers = _sync_customers(full=True)
             elapsed = time.time() - t0
             if customers:
-                with _cache_lock:
-                    _customers_cache = {"data": customers, "time": time.time()}
-                _save_cache_to_disk()
                 print(f"[perf] Shopify force_refresh: {len(customers)} 位、{elapsed:.2f}s", flush=True)
                 return customers
             print(f"[Shopify] ⚠️ force_refresh 回空，回傳舊快取（{elapsed:.2f}s）", flush=True)
@@ -734,26 +677,18 @@ def get_all_goyoutati_customers(force_refresh=False):
     if not has_cache:
         t0 = time.time()
         try:
-            customers = _fetch_customers_from_shopify()
+            customers = _sync_customers()   # 別的 worker 正在抓 → 等它抓完直接用
             elapsed = time.time() - t0
             if customers:
-                with _cache_lock:
-                    _customers_cache = {"data": customers, "time": time.time()}
-                _save_cache_to_disk()
                 print(f"[perf] Shopify cold-start: {len(customers)} 位、{elapsed:.2f}s", flush=True)
             return customers or []
         except Exception as e:
             print(f"[Shopify] ❌ cold-start 失敗: {e}", flush=True)
             return []
 
-    # 情境 3：有快取但過期 → 啟動背景更新（lock 確保同時間只一個）
+    # 情境 3：有快取但過期 → 啟動背景更新（跨 worker 同時間只一個行程真的去抓）
     if is_stale:
-        with _cache_lock:
-            if _refresh_thread is None or not _refresh_thread.is_alive():
-                _refresh_thread = threading.Thread(
-                    target=_refresh_shopify_async, daemon=True, name="ShopifyRefresh"
-                )
-                _refresh_thread.start()
+        _start_background_refresh()
 
     # 情境 3/4：立刻回現有資料（最多就是舊一點點，等背景更新完下次就新的）
     return _customers_cache.get("data") or []
@@ -761,24 +696,20 @@ def get_all_goyoutati_customers(force_refresh=False):
 
 # 啟動時嘗試從磁碟讀取快取
 _load_cache_from_disk()
+_ensure_shopify_members_mirror()
 
 
 def _prewarm_cache():
     """開機預熱：容器一啟動就在背景先抓一次 Shopify 會員，
     讓「登入後第一屏（會員管理）」不用等冷啟動的同步撈取。
-    只有在完全沒快取、或快取已過期時才預熱；有新鮮快取就跳過。"""
-    global _refresh_thread
+    只有在完全沒快取、或快取已過期時才預熱；有新鮮快取就跳過。
+    每個 worker 都會呼叫，但只有拿到更新鎖的那個真的去抓。"""
     try:
         has = _customers_cache.get("data") is not None
         age = time.time() - _customers_cache.get("time", 0)
         if (not has) or age >= CACHE_TTL:
-            with _cache_lock:
-                if _refresh_thread is None or not _refresh_thread.is_alive():
-                    _refresh_thread = threading.Thread(
-                        target=_refresh_shopify_async, daemon=True, name="ShopifyPrewarm"
-                    )
-                    _refresh_thread.start()
-                    print("[Shopify] 🔥 開機預熱：背景抓取會員中…", flush=True)
+            if _start_background_refresh("ShopifyPrewarm"):
+                print("[Shopify] 🔥 開機預熱：背景抓取會員中…", flush=True)
     except Exception as e:
         print(f"[Shopify] 預熱啟動失敗: {e}", flush=True)
 
@@ -786,16 +717,71 @@ def _prewarm_cache():
 _prewarm_cache()
 
 
+# 會員資料欄位（全量 / 增量兩種查詢共用）
+_CUSTOMER_FIELDS = ('id firstName lastName email phone defaultAddress{phone province city zip address1 address2} '
+                    'createdAt updatedAt shippingRate:metafield(namespace:"custom",key:"shipping_rate"){value}')
+
+
+def _customer_record(g_code, owner):
+    """Shopify customer 節點 → 快取裡的一筆會員（電話正規化、地址補齊都在這做，只對有異動的會員跑）"""
+    gid = owner.get("id", "")
+    customer_id = gid.split("/")[-1] if "/" in gid else gid
+    customer_name = f"{owner.get('lastName') or ''}{owner.get('firstName') or ''}".strip()
+    if not customer_name:
+        customer_name = owner.get("email", "")
+    default_address = owner.get("defaultAddress") or {}
+    phone_raw = default_address.get("phone") or owner.get("phone") or ""
+    phone = normalize_phone(phone_raw)
+    # 用郵遞區號反查補齊缺的縣市/區（Shopify 拆欄常漏縣市區 → 黑貓無法投遞）
+    address, _addr_fixed = tw_zip.compose_full_address(
+        default_address.get("province", ""),
+        default_address.get("city", ""),
+        default_address.get("address1", ""),
+        default_address.get("address2", ""),
+        default_address.get("zip", ""),
+    )
+    rate_mf = owner.get("shippingRate")
+    # shipping_rate 現在儲存台幣值
+    shipping_rate_twd = rate_mf["value"] if rate_mf and rate_mf.get("value") else ""
+    return {
+        "g_code": g_code,
+        "customer_id": customer_id,
+        "gid": gid,
+        "name": customer_name,
+        "email": owner.get("email", ""),
+        "address": address,
+        "phone": phone,
+        "phone_raw": phone_raw,
+        "shipping_rate": shipping_rate_twd,  # 台幣
+        "created_at": owner.get("createdAt", ""),
+        "updated_at": owner.get("updatedAt", ""),
+    }
+
+
 def _fetch_customers_from_shopify():
+    """全量抓 Shopify 會員：先走批次匯出（JSONL 逐行匯入），失敗再走 metafields 分頁。"""
+    if SHOPIFY_BULK_IMPORT:
+        t0 = time.time()
+        try:
+            customers = [_customer_record(g, node)
+                         for g, node in shopify_bulk.iter_customers(shopify_graphql, _CUSTOMER_FIELDS)]
+            print(f"[Shopify] 批次匯入 {len(customers)} 位（{time.time() - t0:.2f}s）", flush=True)
+            return customers
+        except (shopify_bulk.BulkOperationError, requests.RequestException, ValueError) as e:
+            print(f"[Shopify] ⚠️ 批次匯入失敗，改用分頁抓取: {e}", flush=True)
+    return _fetch_customers_paged()
+
+
+def _fetch_customers_paged():
     customers = []
     cursor = None
     has_next = True
     page = 0
 
-    while has_next and page < 10:  # 最多 10 頁 = 1000 會員
+    while has_next:   # 以前最多 10 頁（1000 位），超過的會員直接消失
         page += 1
         after_arg = f', after: "{cursor}"' if cursor else ''
-        graphql_query = '{metafieldDefinitions(first:1,ownerType:CUSTOMER,namespace:"custom",key:"goyoutati_id"){edges{node{id metafields(first:100' + after_arg + '){edges{node{value owner{...on Customer{id firstName lastName email phone defaultAddress{phone province city zip address1 address2} createdAt shippingRate:metafield(namespace:"custom",key:"shipping_rate"){value}}}} cursor} pageInfo{hasNextPage}}}}}}'
+        graphql_query = '{metafieldDefinitions(first:1,ownerType:CUSTOMER,namespace:"custom",key:"goyoutati_id"){edges{node{id metafields(first:250' + after_arg + '){edges{node{value owner{...on Customer{' + _CUSTOMER_FIELDS + '}}} cursor} pageInfo{hasNextPage}}}}}}'
 
         page_t0 = time.time()
         result = shopify_graphql(graphql_query)
@@ -824,40 +810,181 @@ def _fetch_customers_from_shopify():
             owner = node.get("owner", {})
             if not g_code or not owner:
                 continue
-            gid = owner.get("id", "")
-            customer_id = gid.split("/")[-1] if "/" in gid else gid
-            customer_name = f"{owner.get('lastName', '')}{owner.get('firstName', '')}".strip()
-            if not customer_name:
-                customer_name = owner.get("email", "")
-            default_address = owner.get("defaultAddress") or {}
-            phone_raw = default_address.get("phone") or owner.get("phone") or ""
-            phone = normalize_phone(phone_raw)
-            # 用郵遞區號反查補齊缺的縣市/區（Shopify 拆欄常漏縣市區 → 黑貓無法投遞）
-            address, _addr_fixed = tw_zip.compose_full_address(
-                default_address.get("province", ""),
-                default_address.get("city", ""),
-                default_address.get("address1", ""),
-                default_address.get("address2", ""),
-                default_address.get("zip", ""),
-            )
-            rate_mf = owner.get("shippingRate")
-            # shipping_rate 現在儲存台幣值
-            shipping_rate_twd = rate_mf["value"] if rate_mf and rate_mf.get("value") else ""
-            customers.append({
-                "g_code": g_code,
-                "customer_id": customer_id,
-                "gid": gid,
-                "name": customer_name,
-                "email": owner.get("email", ""),
-                "address": address,
-                "phone": phone,
-                "phone_raw": phone_raw,
-                "shipping_rate": shipping_rate_twd,  # 台幣
-                "created_at": owner.get("createdAt", "")
-            })
+            customers.append(_customer_record(g_code, owner))
+        if not edges:
+            break
     return customers
 
 
+def _fetch_customers_updated_since(since):
+    """增量：抓 updatedAt ≥ since 的會員 → ({gid: 會員 dict 或 None（已沒有 goyoutati_id）}, 新 hwm)；失敗回 None。
+
+    用 >= 而不是 >：同一秒內更新的會員不會漏（重抓邊界那幾位無妨，合併是冪等的）。
+    """
+    changed = {}
+    hwm = since
+    cursor = None
+    page = 0
+    search = json.dumps(f"updated_at:>='{since}'")
+    while True:
+        page += 1
+        after_arg = f', after: "{cursor}"' if cursor else ''
+        graphql_query = ('{customers(first:250, sortKey:UPDATED_AT, query:' + search + after_arg + '){edges{cursor node{'
+                         + _CUSTOMER_FIELDS + ' goyoutati:metafield(namespace:"custom",key:"goyoutati_id"){value}'
+                         '}} pageInfo{hasNextPage}}}')
+        page_t0 = time.time()
+        result = shopify_graphql(graphql_query)
+        page_ms = int((time.time() - page_t0) * 1000)
+        if "data" not in result or not result["data"].get("customers"):
+            print(f"[Shopify] 增量 page {page} error ({page_ms}ms): {result}", flush=True)
+            return None
+        conn_data = result["data"]["customers"]
+        edges = conn_data.get("edges", [])
+        for e in edges:
+            cursor = e.get("cursor")
+            owner = e.get("node") or {}
+            gid = owner.get("id")
+            if not gid:
+                continue
+            g_code = (owner.get("goyoutati") or {}).get("value") or ""
+            changed[gid] = _customer_record(g_code, owner) if g_code else None
+            hwm = max(hwm, owner.get("updatedAt") or "")
+        if not conn_data.get("pageInfo", {}).get("hasNextPage") or not edges:
+            return changed, hwm
+
+
+def _merge_customers(current, changed):
+    """把增量結果併進現有清單：原順序保留、異動的就地替換、新會員接在後面、沒有 goyoutati_id 的移除。"""
+    merged = []
+    seen = set()
+    for c in current:
+        gid = c.get("gid")
+        if not gid:
+            continue    # 只收 Shopify 會員
+        if gid in changed:
+            seen.add(gid)
+            if changed[gid] is not None:
+                merged.append(changed[gid])
+        else:
+            merged.append(c)
+    merged.extend(rec for gid, rec in changed.items() if gid not in seen and rec is not None)
+    return merged
+
+
+def _sync_customers(full=False, wait=True):
+    """同步 Shopify 會員到快取 + 磁碟；回傳新清單，失敗或回空 → None（保留舊快取）。
+
+    快取有 hwm 且距上次全量不到 FULL_SYNC_INTERVAL → 增量（成本 ∝ 異動會員數）；否則全量。
+    跨 worker single-flight：先拿更新鎖；wait=False 拿不到就放棄（別人正在抓）。
+    拿到鎖後先重讀磁碟快取 —— 剛等鎖時別人已經更新好（還新鮮）就直接用，不重抓（full=True 除外）。
+    """
+    with _refresh_lock(blocking=wait) as locked:
+        if not locked:
+            print("[Shopify] 另一個 worker 正在更新會員快取，本次略過", flush=True)
+            return None
+        _pick_up_shared_cache()
+        cache = _customers_cache
+        if not full and cache.get("data") and time.time() - cache.get("time", 0) < CACHE_TTL:
+            return cache["data"]
+        return _sync_customers_locked(full)
+
+
+def _sync_customers_locked(full):
+    global _customers_cache
+    cache = _customers_cache
+    started = time.time()
+    full = (full or not cache.get("data") or not cache.get("hwm")
+            or started - cache.get("full_time", 0) >= FULL_SYNC_INTERVAL)
+    if full:
+        customers = _fetch_customers_from_shopify()
+        if not customers:
+            return None
+        new = {"data": customers, "time": time.time(), "full_time": started,
+               "hwm": max((c.get("updated_at") or "" for c in customers), default="")}
+    else:
+        delta = _fetch_customers_updated_since(cache["hwm"])
+        if delta is None:
+            return None
+        changed, hwm = delta
+        customers = _merge_customers(cache["data"], changed) if changed else cache["data"]
+        new = {"data": customers, "time": time.time(), "full_time": cache.get("full_time", 0), "hwm": hwm}
+        print(f"[Shopify] 增量同步：{len(changed)} 位有異動（{time.time() - started:.2f}s）", flush=True)
+    with _cache_lock:
+        _customers_cache = new
+    member_directory()      # 在背景執行緒先建好索引，請求端不用等
+    if full:
+        _mirror_shopify_members(customers)
+    elif changed:
+        _mirror_shopify_members(changed=changed)
+    _save_cache_to_disk()
+    return customers
+
+
+def _fetch_customer(gid):
+    """單一顧客目前的狀態 → 會員 dict；已刪除或沒有 goyoutati_id → None；查詢失敗丟 RuntimeError"""
+    result = shopify_graphql('query one($id: ID!) { customer(id: $id) { ' + _CUSTOMER_FIELDS
+                             + ' goyoutati:metafield(namespace:"custom",key:"goyoutati_id"){value} } }', {"id": gid})
+    if "data" not in result:
+        raise RuntimeError(f"查詢顧客 {gid} 失敗: {result}")
+    owner = result["data"].get("customer")
+    g_code = ((owner or {}).get("goyoutati") or {}).get("value") or ""
+    return _customer_record(g_code, owner) if g_code else None
+
+
+def _fetch_customer_by_g_code(g_code):
+    """只查一位：customers 搜尋 goyoutati_id metafield = g_code → 會員 dict 或 None；查詢失敗丟 RuntimeError"""
+    if not re.fullmatch(r"[A-Z0-9_-]+", g_code or ""):
+        return None
+    search = json.dumps(f'metafields.custom.goyoutati_id:"{g_code}"')
+    t0 = time.time()
+    result = shopify_graphql('{customers(first:5, query:' + search + '){edges{node{' + _CUSTOMER_FIELDS
+                             + ' goyoutati:metafield(namespace:"custom",key:"goyoutati_id"){value}}}}}')
+    if "data" not in result or not result["data"].get("customers"):
+        raise RuntimeError(f"查詢會員 {g_code} 失敗: {result}")
+    print(f"[Shopify] 單一會員查詢 {g_code}（{time.time() - t0:.2f}s）", flush=True)
+    for e in result["data"]["customers"].get("edges", []):
+        node = e.get("node") or {}
+        # 搜尋語法比對不是精確的 → 一定要再核對 metafield 值
+        if (node.get("goyoutati") or {}).get("value") == g_code:
+            return _customer_record(g_code, node)
+    return None
+
+
+def _apply_customer_changes(changed=None, patch=None):
+    """把幾位會員的異動就地併進快取 + 鏡像表 + 磁碟（不重抓、不動 hwm / TTL）。
+
+    changed：{gid: 新的會員 dict 或 None（移除）}（webhook）；
+    patch：{gid: {欄位: 值}}（寫回自己剛改的欄位，例如運費）—— 拿到鎖後才以最新快取為底，不會蓋掉別人的更新。
+    快取還是空的 → 不做（下次冷啟動全量抓就會包含）。回傳是否有套用；
+    更新鎖被整批同步佔著、等 CHANGE_LOCK_WAIT 秒還拿不到 → 回 None（呼叫端決定要不要重送）。
+    """
+    global _customers_cache
+    _member_lookups.clear()
+    with _refresh_lock(timeout=CHANGE_LOCK_WAIT) as locked:
+        if not locked:
+            return None
+        _pick_up_shared_cache()
+        cache = _customers_cache
+        if not cache.get("data"):
+            return False
+        changed = dict(changed or {})
+        if patch:
+            d = member_directory()
+            for gid, fields in patch.items():
+                c = d.by_gid(gid)
+                if c is not None:
+                    changed[gid] = dict(c, **fields)
+        if not changed:
+            return False
+        customers = _merge_customers(cache["data"], changed)
+        with _cache_lock:
+            _customers_cache = dict(cache, data=customers)
+        member_directory()
+        _mirror_shopify_members(changed=changed)
+        _save_cache_to_disk()
+    return True
+
+
 # ============ 路由 ============
 
 @app.route("/admin")
@@ -1027,17 +1154,30 @@ def current_operator():
     """當前操作者顯示名稱（給操作紀錄用）"""
     return session.get("username") or "?"
 
+# 操作紀錄走背景批次寫入：request 只丟佇列，每 OPLOG_FLUSH_MS 毫秒或 OPLOG_BATCH_ROWS 列一次交易寫入
+# 用自己的連線（shared=False），不會順帶 commit 到 request 裡還沒提交的寫入
+_oplog_writer = batch_writer.BatchWriter(
+    "operation_logs",
+    "INSERT INTO operation_logs (operator, role, action, target, detail, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+    connect=lambda: dbpool.connect(DB_PATH, shared=False),
+    flush_ms=int(os.environ.get("OPLOG_FLUSH_MS", "200")),
+    max_rows=int(os.environ.get("OPLOG_BATCH_ROWS", "100")),
+)
+
+# 即時通知（SSE）：寫入端在同一交易裡 _events.publish()，/api/events 串流送出；跨 worker 靠 events 表（見 events.py）
+_events = events.EventBus(connect=lambda: dbpool.connect(DB_PATH, shared=False))
+
+
 def log_op(action, target="", detail=""):
-    """記一筆操作紀錄（誰、做了什麼、對象）。失敗不影響主流程。"""
+    """記一筆操作紀錄（誰、做了什麼、對象）。失敗不影響主流程。
+
+    session 只在 request 執行緒讀得到 → 操作者 / 角色 / 時間在這裡先取好再丟佇列。
+    """
     try:
-        conn = get_db()
-        conn.execute(
-            "INSERT INTO operation_logs (operator, role, action, target, detail, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        _oplog_writer.submit(
             (current_operator(), session.get("role", ""), action, str(target), str(detail),
              datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
         )
-        conn.commit()
-        conn.close()
     except Exception as e:
         print(f"[log_op] 失敗: {e}", flush=True)
 
@@ -1081,30 +1221,154 @@ def _safe_str(v):
     return s
 
 
-def _parse_pkg_ids(raw):
-    """容錯解析 package_ids 字串 → [int]（保序、不去重，與舊 list comprehension 行為一致）。
+# 容錯解析 package_ids 字串 → [int]（規則見 migrations.parse_pkg_ids；shipment_packages 回填共用）
+_parse_pkg_ids = migrations.parse_pkg_ids
 
-    支援這些髒格式：
-      • "5,8,12"        → [5, 8, 12]   （正常）
-      • "5.0,8.0,12.0"  → [5, 8, 12]   （migration 把整數 floatify；舊版用 .isdigit() 會整批解析成空）
-      • " 5 , 8 "       → [5, 8]       （多餘空白）
-      • "5，8、12"       → [5, 8, 12]   （全形逗號／頓號／空白分隔）
-      • None / ""       → []
-    只接受純整數或「整數.000」格式；"5.7" / "abc" / "-3" / "1e3" 一律忽略，
-    避免把壞資料硬轉成錯誤 ID。
+
+# 關鍵字少於 3 字元 trigram 切不出詞 → 改用 LIKE（資料量小的短關鍵字也夠快）
+FTS_MIN_CHARS = 3
+
+
+def _keyword_filter(table, q, ranked=False):
+    """後台關鍵字搜尋條件 → (join_sql, join_params, where_sql, where_params)。
+
+    q ≥ 3 字元：JOIN {table}_fts（trigram 全文索引，見 migrations v12）；where 為空。
+      ranked=True 時另帶 fts.fts_rank（bm25，越小越相關）供排序（要多讀 docsize，不排序就不算）。
+    q 太短：回到原本的多欄 LIKE '%q%'；join 為空。
     """
-    if raw is None:
-        return []
-    out = []
-    for tok in re.split(r"[,，、\s]+", str(raw)):
-        tok = tok.strip()
-        if not tok:
-            continue
-        # 純整數，或整數後接全 0 的小數（"5"、"5.0"、"5.00"）
-        if re.fullmatch(r"\d+(?:\.0+)?", tok):
-            n = int(float(tok))
-            if n > 0:
-                out.append(n)
+    if len(q) >= FTS_MIN_CHARS:
+        phrase = '"' + q.replace('"', '""') + '"'   # 整串當片語＝子字串比對，與 LIKE 語意一致
+        rank = ", rank AS fts_rank" if ranked else ""
+        join = (f" JOIN (SELECT rowid AS fts_id{rank} FROM {table}_fts "
+                f"WHERE {table}_fts MATCH ?) fts ON fts.fts_id = {table}.id")
+        return join, [phrase], "", []
+    fields = migrations.FTS_COLUMNS[table]
+    like = f"%{q}%"
+    return "", [], "(" + " OR ".join(f"{f} LIKE ?" for f in fields) + ")", [like] * len(fields)
+
+
+# ===== 後台列表分頁：keyset（游標）+ 舊的 page/OFFSET =====
+# 游標模式下 total 用快取（同樣條件 COUNT_TTL 秒內不重算）；?count=exact 強制重算、?count=none 不算
+COUNT_TTL = 30
+_agg_cache = {}
+
+
+def _encode_cursor(keys, backward=False):
+    raw = json.dumps({"k": keys, "b": 1 if backward else 0}, ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        d = json.loads(raw.decode("utf-8"))
+        return list(d["k"]), bool(d.get("b"))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError("分頁游標無效")
+
+
+def _keyset_args(conn, table, spec):
+    """?cursor= / ?after_id=（往後一頁）/ ?before_id=（往前一頁）→ (條件, 參數, 是否往前)；都沒帶 → None"""
+    token = request.args.get("cursor")
+    if token:
+        keys, backward = _decode_cursor(token)
+    else:
+        for name, backward in (("after_id", False), ("before_id", True)):
+            v = (request.args.get(name) or "").strip()
+            if v:
+                break
+        else:
+            return None
+        if not v.isdigit():
+            raise ValueError(f"{name} 必須是數字")
+        keys = [int(v)]
+        if spec != ["id"]:
+            # 複合排序鍵：用該筆資料本身的鍵值當起點
+            row = conn.execute(
+                f"SELECT {', '.join(f'{table}.{c}' for c in spec)} FROM {table} WHERE id=?", (int(v),)
+            ).fetchone()
+            if not row:
+                raise ValueError(f"找不到 {name}={v}")
+            keys = list(row)
+    if len(keys) != len(spec):
+        raise ValueError("分頁游標與排序方式不符")
+    op = ">" if backward else "<"
+    if len(spec) == 1:
+        return f"{table}.{spec[0]} {op} ?", keys, backward
+    lhs = "(" + ", ".join(f"{table}.{c}" for c in spec) + ")"
+    return f"{lhs} {op} ({', '.join('?' * len(spec))})", keys, backward
+
+
+def _cached_agg(conn, sql, params, exact):
+    """同樣的聚合查詢 COUNT_TTL 秒內重用結果（exact=True 一律重算並更新快取）。"""
+    key = (sql, tuple(params))
+    hit = _agg_cache.get(key)
+    now = time.time()
+    if not exact and hit and now - hit[1] < COUNT_TTL:
+        return hit[0]
+    row = tuple(conn.execute(sql, params).fetchone())
+    if len(_agg_cache) > 500:
+        _agg_cache.clear()
+    _agg_cache[key] = (row, now)
+    return row
+
+
+def _paginate(conn, table, join, jparams, where, params, order, spec, page, limit):
+    """後台列表分頁。帶 ?cursor= / ?after_id= / ?before_id= 走 keyset（WHERE 鍵 < ? LIMIT n，深頁不變慢）；
+    否則沿用 page/OFFSET（舊前端相容）。
+
+    spec：排序鍵（須與 order 一致，例 ["id"]、["payment_at", "id"]）；None＝不支援游標（依相關度排序）。
+    回傳 {rows, total, has_more, next_cursor, prev_cursor, cursor_mode}；游標格式錯 → ValueError。
+    """
+    all_params = jparams + params
+    wsql = (" WHERE " + " AND ".join(where)) if where else ""
+    base = f"SELECT {table}.* FROM {table}{join}"
+    ks = _keyset_args(conn, table, spec) if spec else None
+    if ks is None:
+        rows = conn.execute(f"{base}{wsql} {order} LIMIT ? OFFSET ?",
+                            all_params + [limit + 1, (page - 1) * limit]).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = _encode_cursor([rows[-1][c] for c in spec]) if spec and more else None
+        prev_cursor = None
+    else:
+        cond, kparams, backward = ks
+        direction = "ASC" if backward else "DESC"
+        rows = conn.execute(
+            f"{base} WHERE {' AND '.join(where + [cond])} "
+            f"ORDER BY {', '.join(f'{table}.{c} {direction}' for c in spec)} LIMIT ?",
+            all_params + kparams + [limit + 1]
+        ).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        # 往後翻：有多的才有下一頁、一定有上一頁；往前翻反過來
+        has_next, has_prev = (True, more) if backward else (more, True)
+        next_cursor = _encode_cursor([rows[-1][c] for c in spec]) if rows and has_next else None
+        prev_cursor = _encode_cursor([rows[0][c] for c in spec], True) if rows and has_prev else None
+        more = next_cursor is not None
+    count_mode = request.args.get("count", "")
+    total = None
+    if count_mode != "none":
+        total = _cached_agg(conn, f"SELECT COUNT(*) FROM {table}{join}{wsql}", all_params,
+                            exact=(count_mode == "exact" or ks is None))[0]
+    return {"rows": rows, "total": total, "has_more": more, "next_cursor": next_cursor,
+            "prev_cursor": prev_cursor, "cursor_mode": ks is not None}
+
+
+def _shipment_pkg_ids(conn, shipment_ids):
+    """{出貨單 id: [包裹 id, ...]}（依原申請順序），一次查 shipment_packages。"""
+    out = {sid: [] for sid in shipment_ids}
+    if not out:
+        return out
+    ph = ",".join(["?"] * len(out))
+    for r in conn.execute(
+        f"SELECT shipment_id, package_id FROM shipment_packages "
+        f"WHERE shipment_id IN ({ph}) ORDER BY shipment_id, seq",
+        list(out)
+    ).fetchall():
+        out[r["shipment_id"]].append(r["package_id"])
     return out
 
 
@@ -1566,16 +1830,16 @@ def get_member_unified(g_code):
         return d
     # 回退到 Shopify 快取
     try:
-        for c in get_all_goyoutati_customers():
-            if (c.get("g_code") or "") == g_code:
-                return {
-                    "g_code": g_code,
-                    "name": c.get("name", ""),
-                    "phone": c.get("phone", ""),
-                    "address": c.get("address", ""),
-                    "agent_id": 0,
-                    "source": "shopify"
-                }
+        c = get_member_directory().get(g_code)
+        if c:
+            return {
+                "g_code": g_code,
+                "name": c.get("name", ""),
+                "phone": c.get("phone", ""),
+                "address": c.get("address", ""),
+                "agent_id": 0,
+                "source": "shopify"
+            }
     except Exception as e:
         print(f"[get_member_unified] Shopify 查詢失敗: {e}", flush=True)
     return None
@@ -1791,9 +2055,20 @@ def admin_delete_schedule(sched_id):
     return jsonify({"success": True})
 
 
+@app.route("/api/admin/perf", methods=["GET"])
+def admin_perf():
+    """效能指標（老闆專用）：連線池開/借/還次數、閒置數、重用率；背景批次寫入的佇列深度與 flush 延遲；
+    對外 HTTP（Shopify / JPD / 試算表）各 host 的延遲、重試、節流等待與斷路器狀態；SSE 串流數與事件數。"""
+    if not is_boss():
+        return jsonify({"success": False, "error": "權限不足"}), 403
+    return jsonify({"success": True, "db_pool": dbpool.metrics(), "writers": batch_writer.metrics(),
+                     "http": http_client.metrics(), "events": _events.metrics()})
+
+
 @app.route("/api/admin/operation_logs", methods=["GET"])
 def admin_operation_logs():
-    """操作紀錄（老闆專用）：誰做了什麼。?q= 關鍵字、?page=、?limit= 分頁。"""
+    """操作紀錄（老闆專用）：誰做了什麼。?q= 關鍵字（?sort=rank 依相關度）；
+    分頁：?cursor=（回傳的 next_cursor / prev_cursor）或 ?after_id= / ?before_id=，舊的 ?page= 仍可用；?limit=。"""
     if not is_boss():
         return jsonify({"success": False, "error": "權限不足"}), 403
     q = (request.args.get("q") or "").strip()
@@ -1805,22 +2080,26 @@ def admin_operation_logs():
         limit = min(200, max(1, int(request.args.get("limit", 50))))
     except (ValueError, TypeError):
         limit = 50
-    offset = (page - 1) * limit
+    _oplog_writer.flush()   # 剛做完的操作要看得到
     conn = get_db()
-    where, params = "", []
+    join, jparams, where, params = "", [], [], []
+    order, spec = "ORDER BY id DESC", ["id"]
     if q:
-        like = f"%{q}%"
-        where = " WHERE operator LIKE ? OR action LIKE ? OR target LIKE ? OR detail LIKE ?"
-        params = [like, like, like, like]
-    total = conn.execute(f"SELECT COUNT(*) AS c FROM operation_logs{where}", params).fetchone()["c"]
-    rows = conn.execute(
-        f"SELECT * FROM operation_logs{where} ORDER BY id DESC LIMIT ? OFFSET ?",
-        params + [limit, offset]
-    ).fetchall()
+        ranked = request.args.get("sort") == "rank"
+        join, jparams, w, wparams = _keyword_filter("operation_logs", q, ranked)
+        if w:
+            where.append(w); params += wparams
+        elif ranked:
+            order, spec = "ORDER BY fts.fts_rank, id DESC", None
+    try:
+        pg = _paginate(conn, "operation_logs", join, jparams, where, params, order, spec, page, limit)
+    except ValueError as e:
+        conn.close()
+        return jsonify({"success": False, "error": str(e)}), 400
     conn.close()
-    return jsonify({"success": True, "logs": [dict(r) for r in rows],
-                    "total": total, "page": page, "limit": limit,
-                    "has_more": offset + len(rows) < total})
+    return jsonify({"success": True, "logs": [dict(r) for r in pg["rows"]],
+                    "total": pg["total"], "page": page, "limit": limit, "has_more": pg["has_more"],
+                    "next_cursor": pg["next_cursor"], "prev_cursor": pg["prev_cursor"]})
 
 
 def _mark_disabled(members):
@@ -1839,134 +2118,220 @@ def _mark_disabled(members):
     return members
 
 
+# 會員清單排序（/api/admin/members?sort=…&order=asc|desc）；g_code 先比長度 → G9999 排在 G10000 前面
+_MEMBER_SORTS = {
+    "g_code": "LENGTH(v.g_code) {d}, v.g_code {d}",
+    "name": "v.name {d}, v.g_code",
+    "shipping_rate": "CAST(v.shipping_rate AS REAL) {d}, v.g_code",
+    "created_at": "v.created_at {d}, v.g_code",
+}
+
+
+def _members_etag(conn, aid):
+    """會員清單的 ETag：members / Shopify 鏡像表 / 停用名單 / 代理的變更計數（migrations v17）＋代理 ID"""
+    v = dict(conn.execute(
+        "SELECT name, n FROM change_counters "
+        "WHERE name IN ('members', 'shopify_members', 'disabled_members', 'agents')"
+    ).fetchall())
+    return (f"members-{aid}-{v.get('members', 0)}-{v.get('shopify_members', 0)}"
+            f"-{v.get('disabled_members', 0)}-{v.get('agents', 0)}")
+
+
 @app.route("/api/admin/members", methods=["GET"])
 def get_all_members():
+    """
+    會員清單
+    - 主管理員：Shopify 鏡像表 + 全部本地會員（含所有代理底下的、離職移交的）
+    - 代理：只看自己本地建的會員
+    參數（都可省略）：
+      page / limit：分頁（沒給 limit → 全部一次回傳，後台拿來當姓名 / 運費查找表）
+      q：客編 / 姓名 / 電話 / 地址 / 代理名稱；source：shopify | agent | transferred（代理視角一律 local）
+      agent_id、disabled=1|0、sort=g_code|name|shipping_rate|created_at、order=asc|desc
+    ETag = 會員相關資料表的變更計數：沒人改過會員 → 304，不重跑查詢、不重送整份清單。
+    """
     try:
         aid = get_current_agent_id()
-        # ===== 代理：只看自己本地建的會員 =====
+        force = request.args.get("refresh") == "1"
+        if aid == 0:
+            get_all_goyoutati_customers(force_refresh=force)   # 冷啟動 / 「整理」時先同步（會寫入 shopify_members）
+        conn = get_db()
+        etag = _members_etag(conn, aid)
+        if not force and request.if_none_match.contains(etag):
+            conn.close()
+            resp = make_response("", 304)
+            resp.set_etag(etag)
+            return resp
+
         if aid > 0:
-            conn = get_db()
+            # ===== 代理：只看自己本地建的會員 =====
             agent = conn.execute("SELECT prefix, min_rate FROM agents WHERE id=?", (aid,)).fetchone()
             prefix = agent["prefix"] if agent else "X"
             min_rate = float(agent["min_rate"] or 180) if agent else 180.0
-            rows = conn.execute(
-                "SELECT * FROM members WHERE agent_id=? ORDER BY g_code", (aid,)
-            ).fetchall()
+            # 會員專屬費率 > 0 → 用該費率；否則 fallback 到代理 min_rate
+            base = """
+                SELECT m.g_code, COALESCE(m.name, '') AS name, COALESCE(m.phone, '') AS phone,
+                       COALESCE(m.address, '') AS address, COALESCE(m.line_id, '') AS line_id,
+                       COALESCE(m.email, '') AS email,
+                       CASE WHEN COALESCE(m.shipping_rate, 0) > 0 THEN m.shipping_rate ELSE :min_rate END
+                           AS shipping_rate,
+                       COALESCE(m.shipping_rate, 0) AS shipping_rate_raw,
+                       COALESCE(m.note, '') AS note, COALESCE(m.status, 'active') AS status,
+                       'local' AS source, '' AS agent_name, :aid AS agent_id, m.created_at, 'local' AS kind,
+                       d.g_code IS NOT NULL AS disabled,
+                       COALESCE(d.reason, '') AS disabled_reason, COALESCE(d.disabled_at, '') AS disabled_at
+                FROM members m LEFT JOIN disabled_members d ON d.g_code = m.g_code
+                WHERE m.agent_id = :aid
+            """
+            params = {"aid": aid, "min_rate": min_rate}
+            keys = ("g_code", "name", "phone", "address", "line_id", "email", "shipping_rate", "shipping_rate_raw",
+                    "note", "status", "source", "disabled", "disabled_reason", "disabled_at")
+            total_all = conn.execute("SELECT COUNT(*) FROM members WHERE agent_id=?", (aid,)).fetchone()[0]
+            max_number, next_g_code = g_codes.peek(conn, prefix)
+            extra = {"default_shipping_rate": min_rate, "min_rate": min_rate, "prefix": prefix,
+                     "source": "agent_local"}
+        else:
+            # ===== 主管理員：一條 SQL，shopify_members UNION ALL members，順便 JOIN 停用名單 =====
+            # 兩邊各自只輸出原本就有的欄位
+            base = """
+                SELECT u.*, d.g_code IS NOT NULL AS disabled,
+                       COALESCE(d.reason, '') AS disabled_reason, COALESCE(d.disabled_at, '') AS disabled_at
+                FROM (
+                    SELECT sm.g_code, sm.customer_id, sm.gid, sm.name, sm.email, sm.address, sm.phone, sm.phone_raw,
+                           sm.shipping_rate, sm.created_at, sm.updated_at,
+                           NULL AS line_id, NULL AS note, NULL AS status, NULL AS source,
+                           NULL AS agent_name, NULL AS agent_id, 'shopify' AS kind
+                    FROM shopify_members sm
+                    UNION ALL
+                    -- 代理底下的會員：member rate > 0 用會員專屬、否則用代理 min_rate；離職移交 / 主管理員直接管：預設費率
+                    SELECT m.g_code, '', NULL, m.name, m.email, m.address, m.phone, NULL,
+                           CASE WHEN COALESCE(m.shipping_rate, 0) > 0 THEN m.shipping_rate
+                                WHEN COALESCE(m.agent_id, 0) > 0 THEN COALESCE(NULLIF(a.min_rate, 0), :default_rate)
+                                ELSE :default_rate END,
+                           m.created_at, NULL,
+                           m.line_id, m.note, COALESCE(m.status, 'active'),
+                           CASE WHEN COALESCE(m.agent_id, 0) > 0 THEN 'agent' ELSE 'transferred' END,
+                           CASE WHEN COALESCE(m.agent_id, 0) > 0 THEN COALESCE(a.name, '') ELSE '' END,
+                           COALESCE(m.agent_id, 0),
+                           CASE WHEN COALESCE(m.agent_id, 0) > 0 THEN 'agent' ELSE 'transferred' END
+                    FROM members m LEFT JOIN agents a ON a.id = m.agent_id
+                ) u
+                LEFT JOIN disabled_members d ON d.g_code = u.g_code
+            """
+            params = {"default_rate": DEFAULT_SHIPPING_RATE}
+            keys = None
+            total_all = conn.execute("SELECT (SELECT COUNT(*) FROM shopify_members) + (SELECT COUNT(*) FROM members)"
+                                     ).fetchone()[0]
+            max_number, next_g_code = g_codes.peek(conn, "G")
+            extra = {"default_shipping_rate": DEFAULT_SHIPPING_RATE}  # 台幣
+
+        # 篩選 / 排序 / 分頁
+        where = []
+        q = (request.args.get("q") or "").strip().upper()
+        if q:
+            where.append("(UPPER(v.g_code) LIKE :q OR UPPER(COALESCE(v.name, '')) LIKE :q OR v.phone LIKE :qp "
+                         "OR UPPER(COALESCE(v.address, '')) LIKE :q OR UPPER(COALESCE(v.agent_name, '')) LIKE :q)")
+            q_phone = normalize_phone(q)
+            params.update(q=f"%{q}%", qp=f"%{q_phone}%" if q_phone else None)   # 只有空白 / 連字號 → 不比電話（%% 會全中）
+        source = request.args.get("source", "")
+        if source and aid == 0:
+            if source not in ("shopify", "agent", "transferred"):
+                conn.close()
+                return jsonify({"success": False, "error": "source 只能是 shopify / agent / transferred"}), 400
+            where.append("v.kind = :source")
+            params["source"] = source
+        if request.args.get("agent_id") and aid == 0:
+            try:
+                params["agent_filter"] = int(request.args["agent_id"])
+            except ValueError:
+                conn.close()
+                return jsonify({"success": False, "error": "agent_id 必須是數字"}), 400
+            where.append("v.agent_id = :agent_filter")
+        if request.args.get("disabled") in ("0", "1"):
+            where.append("v.disabled = :disabled")
+            params["disabled"] = int(request.args["disabled"])
+        sort = request.args.get("sort", "g_code")
+        if sort not in _MEMBER_SORTS:
             conn.close()
-            members = []
-            used_numbers = set()
-            for r in rows:
-                d = dict(r)
-                # 會員專屬費率 > 0 → 用該費率；否則 fallback 到代理 min_rate
-                member_rate = float(d.get("shipping_rate") or 0)
-                effective_rate = member_rate if member_rate > 0 else min_rate
-                members.append({
-                    "g_code": d.get("g_code", ""),
-                    "name": d.get("name", ""),
-                    "phone": d.get("phone", ""),
-                    "address": d.get("address", ""),
-                    "line_id": d.get("line_id", ""),
-                    "email": d.get("email", ""),
-                    "shipping_rate": effective_rate,
-                    "shipping_rate_raw": member_rate,  # 0 表示沿用 min_rate
-                    "note": d.get("note", ""),
-                    "status": d.get("status", "active"),
-                    "source": "local",
-                })
-                gc = d.get("g_code", "")
-                if gc.startswith(prefix):
-                    try:
-                        used_numbers.add(int(gc[len(prefix):]))
-                    except (ValueError, TypeError):
-                        pass
-            max_number = max(used_numbers) if used_numbers else 0
-            next_number = 1
-            while next_number in used_numbers:
-                next_number += 1
-            next_g_code = f"{prefix}{next_number:04d}"
-            return jsonify({
-                "success": True,
-                "members": _mark_disabled(members),
-                "total": len(members),
-                "max_number": max_number,
-                "next_g_code": next_g_code,
-                "default_shipping_rate": min_rate,
-                "twd_to_jpy_rate": TWD_TO_JPY_RATE,
-                "min_rate": min_rate,
-                "prefix": prefix,
-                "source": "agent_local",
-            })
+            return jsonify({"success": False, "error": f"sort 只能是 {' / '.join(_MEMBER_SORTS)}"}), 400
+        order = _MEMBER_SORTS[sort].format(d="DESC" if request.args.get("order") == "desc" else "ASC")
+        paged = "limit" in request.args
+        page, limit = 1, 0
+        if paged:
+            try:
+                page = max(1, int(request.args.get("page", 1)))
+                limit = max(1, min(int(request.args["limit"]), 500))
+            except ValueError:
+                conn.close()
+                return jsonify({"success": False, "error": "page / limit 必須是數字"}), 400
+            params.update(limit=limit, offset=(page - 1) * limit)
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+        rows = conn.execute(
+            f"SELECT v.*, COUNT(*) OVER () AS _total FROM ({base}) v {where_sql} ORDER BY {order}"
+            + (" LIMIT :limit OFFSET :offset" if paged else ""),
+            params
+        ).fetchall()
+        if rows:
+            total = rows[0]["_total"]
+        elif paged and page > 1:
+            total = conn.execute(f"SELECT COUNT(*) FROM ({base}) v {where_sql}", params).fetchone()[0]
+        else:
+            total = 0
+        conn.close()
 
-        # ===== 主管理員：Shopify + 全部本地會員（含所有代理底下的）=====
-        force = request.args.get("refresh") == "1"
-        members = get_all_goyoutati_customers(force_refresh=force)
-        # 附加所有本地會員（含代理 agent_id>0 的、以及離職移交 agent_id=0 的）
-        try:
-            conn0 = get_db()
-            local_rows = conn0.execute(
-                "SELECT m.*, a.name AS agent_name, a.prefix AS agent_prefix, a.min_rate AS agent_min_rate "
-                "FROM members m LEFT JOIN agents a ON a.id = m.agent_id "
-                "ORDER BY m.g_code"
-            ).fetchall()
-            conn0.close()
-            for r in local_rows:
-                d = dict(r)
-                m_rate = float(d.get("shipping_rate") or 0)
-                aid_of_member = int(d.get("agent_id") or 0)
-                if aid_of_member > 0:
-                    # 代理底下的會員：member rate > 0 用會員專屬、否則用代理 min_rate
-                    agent_min = float(d.get("agent_min_rate") or DEFAULT_SHIPPING_RATE)
-                    effective_rate = m_rate if m_rate > 0 else agent_min
-                    source = "agent"
-                    agent_name = d.get("agent_name", "") or ""
-                else:
-                    # 離職移交 / 主管理員直接管
-                    effective_rate = m_rate if m_rate > 0 else DEFAULT_SHIPPING_RATE
-                    source = "transferred"
-                    agent_name = ""
-                members.append({
-                    "g_code": d.get("g_code", ""),
-                    "name": d.get("name", ""),
-                    "phone": d.get("phone", ""),
-                    "address": d.get("address", ""),
-                    "line_id": d.get("line_id", ""),
-                    "email": d.get("email", ""),
-                    "shipping_rate": effective_rate,
-                    "note": d.get("note", ""),
-                    "status": d.get("status", "active"),
-                    "source": source,
-                    "agent_name": agent_name,
-                    "agent_id": aid_of_member,
-                    "customer_id": "",  # 本地會員無 Shopify ID
-                })
-        except Exception as e:
-            print(f"[admin members] 抓本地會員失敗: {e}", flush=True)
-        members.sort(key=lambda x: x["g_code"])
-        used_numbers = set()
-        for m in members:
-            if m["g_code"].startswith("G"):
-                try:
-                    used_numbers.add(int(m["g_code"][1:]))
-                except:
-                    pass
-        max_number = max(used_numbers) if used_numbers else 0
-        next_number = 1
-        while next_number in used_numbers:
-            next_number += 1
-        next_g_code = f"G{next_number:04d}"
-        return jsonify({
+        shopify_keys = _SHOPIFY_MEMBER_COLS + ("disabled", "disabled_reason", "disabled_at")
+        local_keys = ("g_code", "name", "phone", "address", "line_id", "email", "shipping_rate", "note", "status",
+                      "source", "agent_name", "agent_id", "customer_id", "disabled", "disabled_reason", "disabled_at")
+        members = []
+        for r in rows:
+            local = r["kind"] != "shopify"
+            m = {k: r[k] for k in (keys or (local_keys if local else shopify_keys))}
+            m["disabled"] = bool(m["disabled"])
+            if local:
+                m["shipping_rate"] = float(m["shipping_rate"] or 0)
+            if keys:
+                m["shipping_rate_raw"] = float(m["shipping_rate_raw"] or 0)
+            members.append(m)
+        result = {
             "success": True,
-            "members": _mark_disabled(members),
-            "total": len(members),
+            "members": members,
+            "total": total,
+            "total_all": total_all,
             "max_number": max_number,
             "next_g_code": next_g_code,
-            "default_shipping_rate": DEFAULT_SHIPPING_RATE,  # 台幣
-            "twd_to_jpy_rate": TWD_TO_JPY_RATE
-        })
+            "twd_to_jpy_rate": TWD_TO_JPY_RATE,
+            **extra,
+        }
+        if paged:
+            result.update(page=page, limit=limit, has_more=page * limit < total)
+        resp = jsonify(result)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"   # 瀏覽器每次都帶 If-None-Match 回來驗證
+        return resp
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
 
+def _search_shopify_members(conn, q_upper, q_phone, limit):
+    """鏡像表搜尋：客編 / 電話前綴走索引（範圍查詢），不足 limit 位才補子字串比對（姓名只能這樣比）"""
+    cols = "g_code, name, phone, address, 0 AS agent_id, '' AS agent_name, 'shopify' AS source"
+    phone_lo, phone_hi = (q_phone, q_phone + "\uffff") if q_phone else (None, None)
+    rows = conn.execute(f"""
+        SELECT {cols} FROM shopify_members
+        WHERE (g_code >= ? AND g_code < ?) OR (phone >= ? AND phone < ?)
+        ORDER BY g_code LIMIT ?
+    """, (q_upper, q_upper + "\uffff", phone_lo, phone_hi, limit)).fetchall()
+    if len(rows) < limit:
+        seen = [r["g_code"] for r in rows]
+        rows += conn.execute(f"""
+            SELECT {cols} FROM shopify_members
+            WHERE (UPPER(g_code) LIKE ? OR UPPER(name) LIKE ? OR phone LIKE ?)
+              AND g_code NOT IN ({",".join("?" * len(seen))})
+            ORDER BY g_code LIMIT ?
+        """, (f"%{q_upper}%", f"%{q_upper}%", f"%{q_phone}%" if q_phone else None, *seen,
+              limit - len(rows))).fetchall()
+    return rows
+
+
 @app.route("/api/admin/search_members", methods=["GET"])
 def admin_search_members():
     """
@@ -2003,15 +2368,16 @@ def admin_search_members():
             ORDER BY g_code LIMIT ?
         """, (aid, pattern, pattern, pattern_phone, limit)).fetchall()
     else:
+        # 主管理員：本地 members（含代理客戶）在前、Shopify 鏡像表在後
         local = conn.execute("""
-            SELECT m.g_code, m.name, m.phone, m.address, m.agent_id, m.status,
-                   a.name as agent_name, a.prefix as agent_prefix
+            SELECT m.g_code, m.name, m.phone, m.address, m.agent_id, a.name AS agent_name, 'agent' AS source
             FROM members m
             LEFT JOIN agents a ON a.id = m.agent_id
             WHERE m.status='active'
               AND (UPPER(m.g_code) LIKE ? OR UPPER(m.name) LIKE ? OR m.phone LIKE ?)
             ORDER BY m.g_code LIMIT ?
         """, (pattern, pattern, pattern_phone, limit)).fetchall()
+        local += _search_shopify_members(conn, q_upper, q_phone, limit)
     conn.close()
 
     for r in local:
@@ -2021,37 +2387,53 @@ def admin_search_members():
             "name": d.get("name") or "",
             "phone": d.get("phone") or "",
             "address": d.get("address") or "",
-            "source": "agent",
+            "source": d.get("source") or "agent",
             "agent_id": d.get("agent_id") or 0,
             "agent_name": d.get("agent_name") or "",
         })
 
-    # Shopify 客戶（僅主管理員視角）
-    if aid == 0:
-        try:
-            customers = get_all_goyoutati_customers()
-            for c in customers:
-                if len(results) >= limit:
-                    break
-                gc = (c.get("g_code") or "").upper()
-                nm = (c.get("name") or "").upper()
-                ph = c.get("phone") or ""
-                if q_upper in gc or q_upper in nm or (q_phone and q_phone in ph):
-                    results.append({
-                        "g_code": c.get("g_code"),
-                        "name": c.get("name") or "",
-                        "phone": ph,
-                        "address": c.get("address") or "",
-                        "source": "shopify",
-                        "agent_id": 0,
-                        "agent_name": "",
-                    })
-        except Exception as e:
-            print(f"[search_members] Shopify 搜尋失敗：{e}", flush=True)
-
     return jsonify({"success": True, "results": results[:limit]})
 
 
+# ===== Shopify 顧客 webhook（會員異動即時進快取，不等 TTL / 不整批重抓）=====
+
+@app.route("/webhooks/shopify/customers", methods=["POST"])
+def shopify_customer_webhook():
+    """
+    Shopify 後台訂閱 customers/create、customers/update、customers/delete（與 metafields/* 顧客 metafield 異動）
+    到這個網址。驗過 HMAC 後只更新受影響的那一位：
+    - delete → 從快取 / 鏡像表移除
+    - 其他 → 向 Shopify 查這位顧客「目前」的資料再寫入（webhook 可能重送、亂序，以現況為準就是冪等的）
+    回非 2xx Shopify 會重送，所以查詢失敗、或會員名單正在整批同步（更新鎖被佔）都回 503。
+    """
+    body = request.get_data()
+    if not shopify_webhook.verify(body, request.headers.get("X-Shopify-Hmac-Sha256"), SHOPIFY_WEBHOOK_SECRET):
+        return jsonify({"success": False, "error": "簽章驗證失敗"}), 401
+    topic = request.headers.get("X-Shopify-Topic", "")
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        return jsonify({"success": False, "error": "內容不是 JSON"}), 400
+    gid = shopify_webhook.customer_gid(topic, payload)
+    if not gid:
+        return jsonify({"success": True, "ignored": topic})
+    if topic == "customers/delete":
+        rec = None
+    else:
+        try:
+            rec = _fetch_customer(gid)
+        except RuntimeError as e:
+            print(f"[webhook] ⚠️ {topic} {gid}: {e}", flush=True)
+            return jsonify({"success": False, "error": "讀取 Shopify 顧客失敗"}), 503
+    applied = _apply_customer_changes(changed={gid: rec})
+    if applied is None:
+        print(f"[webhook] ⏳ {topic} {gid}: 會員名單同步中，請 Shopify 稍後重送", flush=True)
+        return jsonify({"success": False, "error": "會員名單同步中，請稍後重送"}), 503
+    print(f"[webhook] {topic} {gid} → {rec['g_code'] if rec else '移除'}{'' if applied else '（快取未載入，略過）'}",
+          flush=True)
+    return jsonify({"success": True, "applied": applied})
+
+
 # ===== 停用 / 啟用會員（集運系統層級，不動 Shopify）=====
 
 @app.route("/api/admin/members/<g_code>/disable", methods=["POST"])
@@ -2108,7 +2490,6 @@ def admin_create_member():
         return jsonify({"success": False, "error": "代理資料異常"}), 500
     prefix = ag["prefix"]
 
-    # 自動產生下一個 g_code（前綴+四位流水）
     g_code_in = (data.get("g_code") or "").strip().upper()
     if g_code_in:
         # 手動指定的：必須以該代理前綴開頭
@@ -2120,20 +2501,6 @@ def admin_create_member():
         if exists:
             conn.close()
             return jsonify({"success": False, "error": f"編號「{g_code_in}」已使用"})
-        g_code = g_code_in
-    else:
-        used = set()
-        for r in conn.execute("SELECT g_code FROM members WHERE agent_id=?", (aid,)).fetchall():
-            gc = r["g_code"] or ""
-            if gc.startswith(prefix):
-                try:
-                    used.add(int(gc[len(prefix):]))
-                except (ValueError, TypeError):
-                    pass
-        n = 1
-        while n in used:
-            n += 1
-        g_code = f"{prefix}{n:04d}"
 
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     # 處理會員專屬費率（>= 代理 min_rate；留空/0 = 沿用 min_rate）
@@ -2147,6 +2514,12 @@ def admin_create_member():
             return jsonify({"success": False, "error": "運費必須為數字"})
         # 代理可自由設定費率，無下限
     try:
+        # 配號和 INSERT 同一交易：同時兩位建會員由寫鎖排隊，不會拿到同一號；INSERT 失敗 rollback 號碼也退回
+        if g_code_in:
+            g_code = g_code_in
+            g_codes.claim(conn, g_code)
+        else:
+            g_code = g_codes.allocate(conn, prefix)   # 前綴 + 四位流水
         conn.execute(
             """INSERT INTO members (g_code, agent_id, name, phone, address, line_id, email, note, status, created_at, shipping_rate)
                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'active', ?, ?)""",
@@ -2155,7 +2528,8 @@ def admin_create_member():
              (data.get("note") or "").strip(), now, rate_val)
         )
         conn.commit()
-    except sqlite3.IntegrityError as e:
+    except (sqlite3.IntegrityError, RuntimeError) as e:
+        conn.rollback()
         conn.close()
         return jsonify({"success": False, "error": f"資料庫錯誤：{e}"})
     conn.close()
@@ -2233,64 +2607,151 @@ def admin_delete_member(g_code):
             "error": f"此會員已有 {p} 個包裹/{f} 個預報/{s} 個出貨紀錄，無法刪除。請改為「停用」狀態。"
         })
     conn.execute("DELETE FROM members WHERE g_code=?", (g_code,))
+    g_codes.release(conn, g_code)
     conn.commit()
     conn.close()
     return jsonify({"success": True, "message": "會員已刪除"})
 
 
+# metafieldsSet 一次最多 25 個 metafield（Shopify 上限）
+METAFIELDS_SET_MAX = 25
+_METAFIELDS_SET = """
+mutation metafieldsSet($metafields: [MetafieldsSetInput!]!) {
+    metafieldsSet(metafields: $metafields) {
+        metafields { key value owner { ... on Customer { id } } }
+        userErrors { field message }
+    }
+}
+"""
+
+
+def _parse_rate(shipping_rate):
+    """運費輸入 → (台幣整數, 錯誤訊息)"""
+    if shipping_rate == "" or shipping_rate is None:
+        return None, "請輸入運費"
+    try:
+        rate_val = int(shipping_rate)
+    except (ValueError, TypeError):
+        return None, "運費必須為整數"
+    if rate_val < 0:
+        return None, "運費不能為負數"
+    return rate_val, None
+
+
+def _set_shipping_rates(rates, retries=3):
+    """批次寫 shipping_rate metafield：{gid: 台幣} → {gid: 錯誤訊息}（沒列出的就是成功）。
+
+    每 METAFIELDS_SET_MAX 位一次 metafieldsSet；連線失敗 / 被限流（THROTTLED）退避重試。
+    metafieldsSet 是整批原子的：有 userErrors 時整批沒寫 → 把出錯的那幾位剔掉、其餘再送一次。
+    成功的直接寫回快取 + 鏡像表（不必整批重抓）。
+    """
+    failed = {}
+    done = {}
+    items = list(rates.items())
+    for i in range(0, len(items), METAFIELDS_SET_MAX):
+        chunk = items[i:i + METAFIELDS_SET_MAX]
+        attempt = 0     # 只算連線失敗 / 限流的重試；剔掉 userErrors 後重送不佔額度（每次至少少一位，必定收斂）
+        while chunk:
+            result = shopify_graphql(_METAFIELDS_SET, {"metafields": [{
+                "ownerId": gid,
+                "namespace": "custom",
+                "key": "shipping_rate",
+                "type": "single_line_text_field",
+                "value": str(rate),     # 儲存台幣值
+            } for gid, rate in chunk]})
+            errors = result.get("errors") or result.get("error")
+            if errors:
+                # 連線失敗（shopify_graphql 回 {"error": ...}）或被限流才值得重試；查詢本身有錯直接算失敗
+                transient = "error" in result or "THROTTLED" in str(errors)
+                print(f"[shipping_rate] ⚠️ 第 {attempt + 1} 次寫入失敗（{len(chunk)} 位）: {errors}", flush=True)
+                if transient and attempt + 1 < retries:
+                    time.sleep(0.5 * 2 ** attempt)
+                    attempt += 1
+                    continue
+                failed.update((gid, str(errors)) for gid, _rate in chunk)
+                break
+            payload = (result.get("data") or {}).get("metafieldsSet") or {}
+            user_errors = payload.get("userErrors") or []
+            if user_errors:
+                bad = set()
+                for e in user_errors:
+                    field = e.get("field") or []
+                    idx = int(field[1]) if len(field) > 1 and str(field[1]).isdigit() else None
+                    if idx is not None and idx < len(chunk):
+                        bad.add(idx)
+                        failed[chunk[idx][0]] = e.get("message", "")
+                if not bad:     # 看不出是哪一位 → 整批算失敗
+                    failed.update((gid, "; ".join(e.get("message", "") for e in user_errors)) for gid, _rate in chunk)
+                    break
+                chunk = [c for j, c in enumerate(chunk) if j not in bad]
+                continue
+            if not payload.get("metafields"):
+                failed.update((gid, "設定失敗，請重試") for gid, _rate in chunk)
+                break
+            done.update((gid, str(rate)) for gid, rate in chunk)
+            break
+    if done:
+        try:
+            if _apply_customer_changes(patch={gid: {"shipping_rate": v} for gid, v in done.items()}) is None:
+                print(f"[shipping_rate] ⏳ 會員名單同步中，{len(done)} 位的快取寫回略過（下次同步會補上）", flush=True)
+        except Exception as e:
+            print(f"[shipping_rate] ⚠️ 快取寫回失敗（下次同步會補上）: {e}", flush=True)
+    return failed
+
+
 @app.route("/api/admin/shipping_rate", methods=["POST"])
 def set_shipping_rate():
     data = request.json
     customer_gid = data.get("customer_gid", "")
-    shipping_rate = data.get("shipping_rate", "")  # 台幣
     if not customer_gid:
         return jsonify({"success": False, "error": "缺少客戶 ID"})
-    if shipping_rate == "" or shipping_rate is None:
-        return jsonify({"success": False, "error": "請輸入運費"})
-    try:
-        rate_val = int(shipping_rate)
-        if rate_val < 0:
-            return jsonify({"success": False, "error": "運費不能為負數"})
-    except ValueError:
-        return jsonify({"success": False, "error": "運費必須為整數"})
-
-    mutation = """
-    mutation metafieldsSet($metafields: [MetafieldsSetInput!]!) {
-        metafieldsSet(metafields: $metafields) {
-            metafields { key value }
-            userErrors { field message }
-        }
-    }
-    """
-    variables = {
-        "metafields": [{
-            "ownerId": customer_gid,
-            "namespace": "custom",
-            "key": "shipping_rate",
-            "type": "single_line_text_field",
-            "value": str(rate_val)  # 儲存台幣值
-        }]
-    }
+    rate_val, err = _parse_rate(data.get("shipping_rate", ""))  # 台幣
+    if err:
+        return jsonify({"success": False, "error": err})
     try:
-        result = shopify_graphql(mutation, variables)
-        if "data" in result:
-            mutation_result = result["data"].get("metafieldsSet", {})
-            user_errors = mutation_result.get("userErrors", [])
-            if user_errors:
-                return jsonify({"success": False, "error": "; ".join([e["message"] for e in user_errors])})
-            if mutation_result.get("metafields"):
-                return jsonify({
-                    "success": True,
-                    "shipping_rate_twd": rate_val,
-                    "shipping_rate_jpy": twd_to_jpy(rate_val)
-                })
-        if "errors" in result:
-            return jsonify({"success": False, "error": str(result["errors"])})
-        return jsonify({"success": False, "error": "設定失敗，請重試"})
+        failed = _set_shipping_rates({customer_gid: rate_val})
+        if failed:
+            return jsonify({"success": False, "error": failed[customer_gid] or "設定失敗，請重試"})
+        return jsonify({
+            "success": True,
+            "shipping_rate_twd": rate_val,
+            "shipping_rate_jpy": twd_to_jpy(rate_val)
+        })
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
 
+@app.route("/api/admin/shipping_rate/bulk", methods=["POST"])
+def set_shipping_rates_bulk():
+    """
+    一次改多位 Shopify 會員的運費：{"items": [{"customer_gid": ..., "shipping_rate": 台幣}, ...]}
+    每 25 位一次 metafieldsSet（原本一位一個請求）；回傳成功筆數與失敗清單。
+    """
+    if not is_super_admin():
+        return jsonify({"success": False, "error": "權限不足"}), 403
+    items = (request.json or {}).get("items") or []
+    if not isinstance(items, list) or not items:
+        return jsonify({"success": False, "error": "沒有要更新的會員"}), 400
+    if len(items) > 500:
+        return jsonify({"success": False, "error": "一次最多 500 位"}), 400
+    rates, failed = {}, []
+    for it in items:
+        gid = (it or {}).get("customer_gid") or ""
+        rate_val, err = _parse_rate((it or {}).get("shipping_rate"))
+        if not gid:
+            failed.append({"customer_gid": gid, "error": "缺少客戶 ID"})
+        elif err:
+            failed.append({"customer_gid": gid, "error": err})
+        else:
+            rates[gid] = rate_val
+    t0 = time.time()
+    errors = _set_shipping_rates(rates) if rates else {}
+    failed += [{"customer_gid": gid, "error": msg} for gid, msg in errors.items()]
+    updated = len(rates) - len(errors)
+    print(f"[shipping_rate] 批次更新 {updated} 位、失敗 {len(failed)} 位（{time.time() - t0:.2f}s）", flush=True)
+    return jsonify({"success": not failed, "updated": updated, "failed": failed})
+
+
 # ============ 管理員：到貨包裹管理 ============
 
 @app.route("/api/admin/packages", methods=["GET"])
@@ -2323,15 +2784,20 @@ def admin_list_packages():
         limit = min(200, max(1, int(request.args.get("limit", 50))))
     except (ValueError, TypeError):
         limit = 50
-    offset = (page - 1) * limit
 
     where, params = [], []
+    join, jparams = "", []
+    order, spec = "ORDER BY id DESC", ["id"]
     if aid > 0:
         where.append("agent_id=?"); params.append(aid)
     if q:
-        like = f"%{q}%"
-        where.append("(g_code LIKE ? OR logis_num LIKE ? OR product_name LIKE ?)")
-        params += [like, like, like]   # 搜尋時忽略狀態、跨全部
+        # 搜尋時忽略狀態、跨全部
+        ranked = request.args.get("sort") == "rank"
+        join, jparams, w, wparams = _keyword_filter("packages", q, ranked)
+        if w:
+            where.append(w); params += wparams
+        elif ranked:
+            order, spec = "ORDER BY fts.fts_rank, id DESC", None
     else:
         if status == "未出貨":
             where.append("status!='已出貨'")
@@ -2339,16 +2805,73 @@ def admin_list_packages():
             where.append("status=?"); params.append(status)
         # 全部 / 最近50 → 不加狀態條件（最近50 由分頁自然呈現）
 
-    wsql = (" WHERE " + " AND ".join(where)) if where else ""
-    total = conn.execute(f"SELECT COUNT(*) AS c FROM packages{wsql}", params).fetchone()["c"]
+    try:
+        pg = _paginate(conn, "packages", join, jparams, where, params, order, spec, page, limit)
+    except ValueError as e:
+        conn.close()
+        return jsonify({"success": False, "error": str(e)}), 400
+    conn.close()
+    return jsonify({"success": True, "packages": [dict(r) for r in pg["rows"]],
+                    "total": pg["total"], "page": page, "limit": limit, "has_more": pg["has_more"],
+                    "next_cursor": pg["next_cursor"], "prev_cursor": pg["prev_cursor"]})
+
+
+def _logis_norm(v):
+    """追蹤號正規化（與 migrations._LOGIS_NORM 一致）：去空白與 -、轉大寫。"""
+    return re.sub(r"[\s\-]+", "", str(v or "")).upper()
+
+
+@app.route("/api/admin/scan", methods=["GET"])
+def admin_scan_lookup():
+    """倉庫掃描 / 輸入末幾碼找包裹：?code=完整或尾段追蹤號（至少 4 碼）。
+
+    走 packages.logis_rev（倒寫的追蹤號）索引前綴查詢；回傳包裹、所屬客戶、進行中的出貨申請。
+    """
+    if not current_user():
+        return jsonify({"success": False, "error": "請先登入"}), 403
+    code = _logis_norm(request.args.get("code"))
+    if len(code) < 4:
+        return jsonify({"success": False, "error": "請至少輸入追蹤號末四碼"}), 400
+    # 反轉鍵只存末 LOGIS_REV_LEN 碼；更長的輸入取尾段即可（仍是唯一）
+    rev = code[::-1][:migrations.LOGIS_REV_LEN]
+    upper = rev[:-1] + chr(ord(rev[-1]) + 1)
+    aid = get_current_agent_id()
+    af, params = ("AND p.agent_id=? ", [rev, upper, aid]) if aid > 0 else ("", [rev, upper])
+    conn = get_db()
     rows = conn.execute(
-        f"SELECT * FROM packages{wsql} ORDER BY id DESC LIMIT ? OFFSET ?",
-        params + [limit, offset]
+        f"""SELECT p.id, p.g_code, p.logis_num, p.product_name, p.weight, p.status, p.in_date, p.pkg_type,
+                   -- 客戶姓名：代理客戶在 members；主帳號客戶查 Shopify 鏡像表（不觸發抓取）
+                   COALESCE(NULLIF(m.name, ''),
+                            (SELECT sm.name FROM shopify_members sm WHERE sm.g_code = p.g_code LIMIT 1),
+                            '') AS member_name,
+                   (SELECT MAX(sp.shipment_id) FROM shipment_packages sp
+                      JOIN shipment_requests sr ON sr.id = sp.shipment_id
+                     WHERE sp.package_id = p.id AND sr.status IN ('待處理', '處理中')) AS active_request_id
+            FROM packages p LEFT JOIN members m ON m.g_code = p.g_code
+            WHERE p.logis_rev >= ? AND p.logis_rev < ? {af}
+            ORDER BY p.id DESC LIMIT 20""",
+        params
     ).fetchall()
+    req_status = {}
+    req_ids = [r["active_request_id"] for r in rows if r["active_request_id"]]
+    if req_ids:
+        ph = ",".join(["?"] * len(req_ids))
+        for r in conn.execute(f"SELECT id, status FROM shipment_requests WHERE id IN ({ph})", req_ids).fetchall():
+            req_status[r["id"]] = r["status"]
     conn.close()
-    return jsonify({"success": True, "packages": [dict(r) for r in rows],
-                    "total": total, "page": page, "limit": limit,
-                    "has_more": offset + len(rows) < total})
+
+    matches = []
+    for r in rows:
+        d = dict(r)
+        rid = d.pop("active_request_id")
+        d["owner"] = {"g_code": d["g_code"],
+                      "name": d.pop("member_name")}
+        d["active_request"] = {"id": rid, "status": req_status.get(rid, "")} if rid else None
+        d["exact"] = _logis_norm(d["logis_num"]) == code
+        matches.append(d)
+    # 完整追蹤號命中的排最前面
+    matches.sort(key=lambda d: not d["exact"])
+    return jsonify({"success": True, "count": len(matches), "matches": matches})
 
 
 # ===== 無主包裹認領牆 =====
@@ -2423,6 +2946,8 @@ def admin_claim_unclaimed(uid):
         (g_code, u.get("logis_num", ""), u.get("product_name", ""), u.get("weight", ""),
          u.get("note", ""), in_date, now, pkg_agent_id)
     )
+    _events.publish(conn, "package.arrived", {"g_code": g_code, "product_name": u.get("product_name", "")},
+                    audience="customer", g_code=g_code)
     conn.execute("DELETE FROM unclaimed_packages WHERE id=?", (uid,))
     conn.commit()
     conn.close()
@@ -2472,6 +2997,9 @@ def admin_add_package():
         (g_code, logis_num, product_name, weight, status, note, today, now, pkg_agent_id, pkg_type)
     )
     new_id = cur.lastrowid
+    if status in ("已到貨", "已入庫"):
+        _events.publish(conn, "package.arrived", {"id": new_id, "g_code": g_code, "product_name": product_name},
+                        audience="customer", g_code=g_code)
     conn.commit()
     conn.close()
     log_op("登記到貨", g_code, f"{product_name or logis_num} {weight}kg")
@@ -2504,6 +3032,12 @@ def admin_update_package(pkg_id):
     values.append(pkg_id)
     conn = get_db()
     conn.execute(f"UPDATE packages SET {', '.join(fields)} WHERE id=?", values)
+    arrived = ("已到貨", "已入庫")
+    if data.get("status") in arrived and row["status"] not in arrived:
+        g_code = data["g_code"].strip().upper() if "g_code" in data else row["g_code"]
+        _events.publish(conn, "package.arrived",
+                        {"id": pkg_id, "g_code": g_code, "product_name": data.get("product_name", row["product_name"])},
+                        audience="customer", g_code=g_code)
     conn.commit()
     conn.close()
     return jsonify({"success": True})
@@ -2622,35 +3156,33 @@ def verify_customer():
     except Exception as e:
         print(f"[verify_customer] 本地查詢失敗：{e}", flush=True)
 
-    # ===== 2) 回退查 Shopify（你的客戶，原有邏輯）=====
+    # ===== 2) 回退查 Shopify（你的客戶）；冷啟動只查這一位，不等整份名單 =====
     try:
-        customers = get_all_goyoutati_customers()
-        for c in customers:
-            if c["g_code"] == g_code:
-                if c["phone"] and c["phone"] == password_clean:
-                    try:
-                        rate_twd = int(c["shipping_rate"]) if c["shipping_rate"] else DEFAULT_SHIPPING_RATE
-                    except (ValueError, TypeError):
-                        rate_twd = DEFAULT_SHIPPING_RATE
-                    rate_jpy = twd_to_jpy(rate_twd) if rate_twd else 0
-                    return jsonify({
-                        "success": True,
-                        "customer": {
-                            "id": c["customer_id"],
-                            "g_code": g_code,
-                            "name": c["name"] or "會員",
-                            "email": c["email"],
-                            "phone": c["phone"],
-                            "phone_raw": c["phone_raw"],
-                            "address": c.get("address", ""),
-                            "shipping_rate_twd": rate_twd,
-                            "shipping_rate_jpy": rate_jpy,
-                            "source": "shopify",
-                        }
-                    })
-                else:
-                    return jsonify({"success": False, "error": "密碼錯誤，請輸入您的手機號碼"})
-        return jsonify({"success": False, "error": "找不到此會員編號，請確認後重試"})
+        c = lookup_shopify_member(g_code)
+        if not c:
+            return jsonify({"success": False, "error": "找不到此會員編號，請確認後重試"})
+        if not (c["phone"] and c["phone"] == password_clean):
+            return jsonify({"success": False, "error": "密碼錯誤，請輸入您的手機號碼"})
+        try:
+            rate_twd = int(c["shipping_rate"]) if c["shipping_rate"] else DEFAULT_SHIPPING_RATE
+        except (ValueError, TypeError):
+            rate_twd = DEFAULT_SHIPPING_RATE
+        rate_jpy = twd_to_jpy(rate_twd) if rate_twd else 0
+        return jsonify({
+            "success": True,
+            "customer": {
+                "id": c["customer_id"],
+                "g_code": g_code,
+                "name": c["name"] or "會員",
+                "email": c["email"],
+                "phone": c["phone"],
+                "phone_raw": c["phone_raw"],
+                "address": c.get("address", ""),
+                "shipping_rate_twd": rate_twd,
+                "shipping_rate_jpy": rate_jpy,
+                "source": "shopify",
+            }
+        })
     except Exception as e:
         return jsonify({"success": False, "error": f"查詢失敗: {str(e)}"})
 
@@ -2714,36 +3246,39 @@ def create_forecast():
     return jsonify({"success": all(r["success"] for r in results), "results": results})
 
 
-@app.route("/api/packages", methods=["GET"])
-def get_packages():
-    g_code = request.args.get("g_code") or request.args.get("customer_id")
-    if not g_code:
-        return jsonify({"success": False, "error": "缺少會員編號"})
+def _customer_etag(conn, g_code, kind):
+    """客戶端 GET 的 ETag：customer_summary.version（該會員的包裹 / 出貨申請 / 預報 / 地址 / 配送對應
+    任何寫入都 +1，migrations v19 / v20 / v22 的 trigger 維護）。只查主鍵，不碰主資料表。"""
+    row = conn.execute("SELECT version FROM customer_summary WHERE g_code=?", (g_code,)).fetchone()
+    return f"{kind}-{g_code}-{row[0] if row else 0}"
+
+
+def _not_modified(etag):
+    resp = make_response("", 304)
+    resp.set_etag(etag)
+    return resp
 
-    g_code = g_code.upper()
-    conn = get_db()
-    rows = conn.execute(
-        "SELECT * FROM packages WHERE g_code=? ORDER BY id DESC",
-        (g_code,)
-    ).fetchall()
 
-    # 找出該會員「進行中」的出貨申請（待處理／處理中），標記其包含的包裹
+def _etag_json(payload, etag):
+    resp = jsonify(payload)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"   # 瀏覽器每次都帶 If-None-Match 回來驗證
+    return resp
+
+
+def _customer_packages(conn, g_code, limit=None):
+    """客戶端「我的包裹」清單（新→舊）；limit 有給只取前幾筆"""
+    # 順便標出該會員「進行中」的出貨申請（待處理／處理中）包含的包裹（每個包裹一次索引查詢）
     # 用途：前端據此隱藏勾選框、顯示「已申請出貨」徽章，避免重複申請
-    active_reqs = conn.execute(
-        "SELECT id, package_ids FROM shipment_requests "
-        "WHERE g_code=? AND status IN ('待處理', '處理中')",
-        (g_code,)
+    rows = conn.execute(
+        """SELECT p.*,
+                  (SELECT MAX(sp.shipment_id) FROM shipment_packages sp
+                     JOIN shipment_requests sr ON sr.id = sp.shipment_id
+                    WHERE sp.package_id = p.id AND sr.g_code = p.g_code
+                      AND sr.status IN ('待處理', '處理中')) AS pending_req_id
+           FROM packages p WHERE p.g_code=? ORDER BY p.id DESC LIMIT ?""",
+        (g_code, -1 if limit is None else limit)
     ).fetchall()
-    conn.close()
-
-    pkg_to_req = {}
-    for r in active_reqs:
-        ids_str = r["package_ids"] or ""
-        for pid_str in ids_str.split(","):
-            try:
-                pkg_to_req[int(pid_str.strip())] = r["id"]
-            except (ValueError, AttributeError):
-                pass
 
     packages = []
     for row in rows:
@@ -2757,9 +3292,26 @@ def get_packages():
             "note":         r["note"] or "",
             "in_date":      r["in_date"] or "",
             "created_at":   r["created_at"],
-            "pending_ship_request_id": pkg_to_req.get(r["id"]),  # None 表示未在出貨申請中
+            "pending_ship_request_id": r["pending_req_id"],  # None 表示未在出貨申請中
         })
-    return jsonify({"success": True, "packages": packages})
+    return packages
+
+
+@app.route("/api/packages", methods=["GET"])
+def get_packages():
+    g_code = request.args.get("g_code") or request.args.get("customer_id")
+    if not g_code:
+        return jsonify({"success": False, "error": "缺少會員編號"})
+
+    g_code = g_code.upper()
+    conn = get_db()
+    etag = _customer_etag(conn, g_code, "packages")
+    if request.if_none_match.contains(etag):
+        conn.close()
+        return _not_modified(etag)
+    packages = _customer_packages(conn, g_code)
+    conn.close()
+    return _etag_json({"success": True, "packages": packages}, etag)
 
 
 @app.route("/api/orders", methods=["GET"])
@@ -3097,28 +3649,27 @@ def admin_daily_ops():
     aid = get_current_agent_id()
     conn = get_db()
 
-    # 進倉：依到倉日 group（in_date 為 YYYY-MM-DD；防呆截前10碼）
-    inb_where = ["substr(COALESCE(in_date,''),1,10) BETWEEN ? AND ?"]
+    # 進倉：依到倉日 group（arrival_date＝正規化後的 in_date，有索引）
+    inb_where = ["arrival_date BETWEEN ? AND ?"]
     inb_params = [date_from, date_to]
     if aid > 0:
         inb_where.append("agent_id=?"); inb_params.append(aid)
     inbound = {}
     for r in conn.execute(
-        f"SELECT substr(in_date,1,10) AS d, COUNT(*) AS cnt, "
-        f"COALESCE(SUM(CAST(weight AS REAL)),0) AS kg FROM packages "
+        f"SELECT arrival_date AS d, COUNT(*) AS cnt, "
+        f"COALESCE(SUM(weight_kg),0) AS kg FROM packages "
         f"WHERE {' AND '.join(inb_where)} GROUP BY d", inb_params
     ).fetchall():
         inbound[r["d"]] = {"in_count": r["cnt"], "in_kg": round(r["kg"] or 0, 1)}
 
-    # 出貨：依出貨日 group（出貨日＝updated_at 那刻；當天全部已出貨單）
-    out_where = ["status='已出貨'",
-                 "substr(COALESCE(NULLIF(updated_at,''), created_at),1,10) BETWEEN ? AND ?"]
+    # 出貨：依出貨日 group（ship_date＝updated_at 那天；當天全部已出貨單）
+    out_where = ["status='已出貨'", "ship_date BETWEEN ? AND ?"]
     out_params = [date_from, date_to]
     if aid > 0:
         out_where.append("agent_id=?"); out_params.append(aid)
     outbound = {}
     for r in conn.execute(
-        f"SELECT substr(COALESCE(NULLIF(updated_at,''), created_at),1,10) AS d, "
+        f"SELECT ship_date AS d, "
         f"COUNT(*) AS cnt, COALESCE(SUM(CAST(billed_weight AS REAL)),0) AS kg, "
         f"COALESCE(SUM(CAST(total_fee AS REAL)),0) AS fee FROM shipment_requests "
         f"WHERE {' AND '.join(out_where)} GROUP BY d", out_params
@@ -3456,6 +4007,7 @@ def admin_create_announcement():
         "INSERT INTO announcements (title, content, is_active, created_at) VALUES (?, ?, 1, ?)",
         (title, content, now)
     )
+    _events.publish(conn, "announcement.created", {"id": cur.lastrowid, "title": title}, audience="customers")
     conn.commit()
     conn.close()
     return jsonify({"success": True, "id": cur.lastrowid})
@@ -3561,6 +4113,7 @@ def admin_create_internal_announcement():
         "INSERT INTO internal_announcements (title, content, is_active, created_at) VALUES (?, ?, 1, ?)",
         (title, content, now)
     )
+    _events.publish(conn, "internal_announcement.created", {"id": cur.lastrowid, "title": title}, audience="staff")
     conn.commit()
     conn.close()
     return jsonify({"success": True, "id": cur.lastrowid})
@@ -3608,11 +4161,15 @@ def get_addresses():
     if not g_code:
         return jsonify({"success": False, "error": "缺少會員編號"})
     conn = get_db()
+    etag = _customer_etag(conn, g_code, "addresses")
+    if request.if_none_match.contains(etag):
+        conn.close()
+        return _not_modified(etag)
     rows = conn.execute(
         "SELECT * FROM addresses WHERE g_code=? ORDER BY is_default DESC, id DESC", (g_code,)
     ).fetchall()
     conn.close()
-    return jsonify({"success": True, "addresses": [dict(r) for r in rows]})
+    return _etag_json({"success": True, "addresses": [dict(r) for r in rows]}, etag)
 
 
 @app.route("/api/addresses", methods=["POST"])
@@ -3828,8 +4385,9 @@ def admin_tracking_sync():
     if new_url:
         _set_setting("tracking_sheet_url", new_url)
     try:
-        count = sync_delivery_tracking()
-        return jsonify({"success": True, "count": count, "last_sync": _get_setting("tracking_last_sync", "")})
+        count, matched = sync_delivery_tracking()
+        return jsonify({"success": True, "count": count, "matched": matched,
+                        "last_sync": _get_setting("tracking_last_sync", "")})
     except Exception as e:
         return jsonify({"success": False, "error": f"同步失敗：{e}"}), 500
 
@@ -3877,21 +4435,15 @@ def create_shipment_request():
         except (ValueError, TypeError):
             pass
 
-    active_reqs = conn.execute(
-        "SELECT id, package_ids FROM shipment_requests "
-        "WHERE g_code=? AND status IN ('待處理', '處理中')",
-        (g_code,)
-    ).fetchall()
-    already_pending = set()
-    for r in active_reqs:
-        ids_str = r["package_ids"] or ""
-        for pid_str in ids_str.split(","):
-            try:
-                already_pending.add(int(pid_str.strip()))
-            except (ValueError, AttributeError):
-                pass
-
-    duplicates = requested_set & already_pending
+    duplicates = set()
+    if requested_set:
+        duplicates = {r["package_id"] for r in conn.execute(
+            f"SELECT sp.package_id FROM shipment_packages sp "
+            f"JOIN shipment_requests sr ON sr.id = sp.shipment_id "
+            f"WHERE sp.package_id IN ({','.join(['?']*len(requested_set))}) "
+            f"AND sr.g_code=? AND sr.status IN ('待處理', '處理中')",
+            list(requested_set) + [g_code]
+        ).fetchall()}
     if duplicates:
         # 把重複的包裹 id 對應到 product_name 顯示得更友善
         dup_rows = conn.execute(
@@ -3974,17 +4526,43 @@ def create_shipment_request():
         })
     extra_services_json = json.dumps(customer_extras, ensure_ascii=False)
 
-    conn.execute(
+    cur = conn.execute(
         """INSERT INTO shipment_requests (g_code, customer_name, package_ids, package_summary, status, note, ship_recipient, ship_phone, ship_address, extra_services, created_at, agent_id)
            VALUES (?, ?, ?, ?, '待處理', ?, ?, ?, ?, ?, ?, ?)""",
         (g_code, customer_name, ids_str, summary, note, ship_recipient, ship_phone, ship_address, extra_services_json, now, sr_agent_id)
     )
+    migrations.link_shipment_packages(conn, cur.lastrowid, _parse_pkg_ids(ids_str))
+    _events.publish(conn, "shipment_request.created", {"id": cur.lastrowid, "g_code": g_code},
+                    audience=f"admin:{sr_agent_id or 0}", g_code=g_code)
     conn.commit()
     conn.close()
 
     return jsonify({"success": True, "message": "出貨申請已送出，管理員會盡快處理！"})
 
 
+def _customer_shipment_requests(conn, g_code, limit=None):
+    """客戶端「我的出貨申請」清單（新→舊，附台灣配送貨況）；limit 有給只取前幾筆
+
+    配送單號在貨況同步 / 匯出時就對好存在 shipment_delivery（見 migrations.match_shipment_delivery）。
+    """
+    rows = conn.execute(
+        """SELECT sr.*, sd.carrier AS delivery_carrier, sd.tracking_num AS delivery_tracking
+           FROM shipment_requests sr LEFT JOIN shipment_delivery sd ON sd.shipment_id = sr.id
+           WHERE sr.g_code=? ORDER BY sr.id DESC LIMIT ?""",
+        (g_code, -1 if limit is None else limit)
+    ).fetchall()
+
+    result = []
+    for r in rows:
+        d = dict(r)
+        if d["delivery_tracking"]:
+            d["delivery_url"] = delivery_tracking_url(d["delivery_carrier"], d["delivery_tracking"])
+        else:
+            del d["delivery_carrier"], d["delivery_tracking"]
+        result.append(d)
+    return result
+
+
 @app.route("/api/shipment_requests", methods=["GET"])
 def get_my_shipment_requests():
     """客戶查看自己的出貨申請"""
@@ -3992,52 +4570,13 @@ def get_my_shipment_requests():
     if not g_code:
         return jsonify({"success": False, "error": "缺少會員編號"})
     conn = get_db()
-    rows = conn.execute(
-        "SELECT * FROM shipment_requests WHERE g_code=? ORDER BY id DESC", (g_code,)
-    ).fetchall()
-
-    # 台灣配送貨況：每筆出貨單用「存的 export_code ＋ 現算 {g_code}-{MMDD}」多候選比對，
-    # 讓 export_code 上線前的舊單也能對到（MMDD 取 updated_at＝標記已出貨那天，其次 created_at）
-    def _mmdd(v):
-        try:
-            return datetime.strptime(str(v)[:10], "%Y-%m-%d").strftime("%m%d")
-        except (ValueError, TypeError):
-            return None
-
-    req_candidates = {}
-    all_codes = set()
-    for r in rows:
-        cands, seen = [], set()
-        for c in ([r["export_code"]] +
-                  [f"{r['g_code']}-{mm}" for mm in (_mmdd(r["updated_at"]), _mmdd(r["created_at"])) if mm]):
-            if c and c not in seen:
-                seen.add(c); cands.append(c)
-        req_candidates[r["id"]] = cands
-        all_codes.update(cands)
-
-    tmap = {}
-    if all_codes:
-        codes_list = list(all_codes)
-        ph = ",".join(["?"] * len(codes_list))
-        for t in conn.execute(
-            f"SELECT customer_code, carrier, tracking_num FROM delivery_tracking WHERE customer_code IN ({ph})",
-            codes_list
-        ).fetchall():
-            tmap[t["customer_code"]] = t
+    etag = _customer_etag(conn, g_code, "requests")
+    if request.if_none_match.contains(etag):
+        conn.close()
+        return _not_modified(etag)
+    result = _customer_shipment_requests(conn, g_code)
     conn.close()
-
-    result = []
-    for r in rows:
-        d = dict(r)
-        for c in req_candidates.get(r["id"], []):
-            t = tmap.get(c)
-            if t and t["tracking_num"]:
-                d["delivery_carrier"] = t["carrier"]
-                d["delivery_tracking"] = t["tracking_num"]
-                d["delivery_url"] = delivery_tracking_url(t["carrier"], t["tracking_num"])
-                break
-        result.append(d)
-    return jsonify({"success": True, "requests": result})
+    return _etag_json({"success": True, "requests": result}, etag)
 
 
 @app.route("/api/shipment_requests/<int:req_id>/payment", methods=["POST"])
@@ -4056,7 +4595,7 @@ def submit_payment_info(req_id):
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     conn = get_db()
     # 確認是該客戶的申請
-    row = conn.execute("SELECT g_code FROM shipment_requests WHERE id=?", (req_id,)).fetchone()
+    row = conn.execute("SELECT g_code, agent_id FROM shipment_requests WHERE id=?", (req_id,)).fetchone()
     if not row or row["g_code"] != g_code:
         conn.close()
         return jsonify({"success": False, "error": "找不到該申請"})
@@ -4065,6 +4604,8 @@ def submit_payment_info(req_id):
         "UPDATE shipment_requests SET payment_last5=?, payment_at=? WHERE id=?",
         (last5, now, req_id)
     )
+    _events.publish(conn, "payment.reported", {"id": req_id, "g_code": g_code},
+                    audience=f"admin:{row['agent_id'] or 0}", g_code=g_code)
     conn.commit()
     conn.close()
     return jsonify({"success": True, "message": "匯款回報成功！"})
@@ -4085,16 +4626,16 @@ def admin_old_packages():
             """SELECT * FROM packages
                WHERE status != '已出貨'
                  AND agent_id = ?
-                 AND COALESCE(NULLIF(in_date, ''), substr(created_at, 1, 10)) <= ?
-               ORDER BY COALESCE(NULLIF(in_date, ''), substr(created_at, 1, 10)) ASC""",
+                 AND arrival_date <= ?
+               ORDER BY arrival_date ASC""",
             (aid, cutoff_date)
         ).fetchall()
     else:
         rows = conn.execute(
             """SELECT * FROM packages
                WHERE status != '已出貨'
-                 AND COALESCE(NULLIF(in_date, ''), substr(created_at, 1, 10)) <= ?
-               ORDER BY COALESCE(NULLIF(in_date, ''), substr(created_at, 1, 10)) ASC""",
+                 AND arrival_date <= ?
+               ORDER BY arrival_date ASC""",
             (cutoff_date,)
         ).fetchall()
     conn.close()
@@ -4298,9 +4839,10 @@ def _admin_exports_pending_impl():
     """).fetchall()
 
     # 撈所有相關 packages
+    req_pids = _shipment_pkg_ids(conn, [r["id"] for r in rows])
     pkg_ids = set()
-    for r in rows:
-        pkg_ids.update(_parse_pkg_ids(r["package_ids"]))
+    for pids in req_pids.values():
+        pkg_ids.update(pids)
 
     pkg_map = {}
     if pkg_ids:
@@ -4324,32 +4866,14 @@ def _admin_exports_pending_impl():
         for c in code_rows:
             codes_map.setdefault(c["g_code"], {})[c["vendor"]] = c["code"]
 
-    # Fallback 資料來源（與 /generate 一致）：members 表 + Shopify cache
-    members_map = {}
-    if g_codes:
-        placeholders = ",".join(["?"] * len(g_codes))
-        for m in conn.execute(
-            f"SELECT g_code, name, phone, address FROM members WHERE g_code IN ({placeholders})",
-            g_codes
-        ).fetchall():
-            members_map[m["g_code"]] = {"name": m["name"], "phone": m["phone"], "address": m["address"]}
-    # ★ 重要：用「目前已快取」的 Shopify 客戶，不觸發新抓取（避免冷啟動阻塞）
-    # 如果快取為空 → shopify_map 空 → fallback 只用 members 表 + customer_name
-    shopify_map = {}
+    # Fallback 資料來源（與 /generate 一致）：members 表 + Shopify 鏡像表
+    # ★ 重要：只讀鏡像表，不觸發新抓取（避免冷啟動阻塞）；鏡像表空 → fallback 只用 members 表 + customer_name
+    members_map = _member_fallback_map(conn, g_codes)
     try:
         cached = _customers_cache.get("data") or []
-        for c in cached:
-            if c.get("g_code") in g_codes:
-                shopify_map[c["g_code"]] = {"name": c.get("name", ""), "phone": c.get("phone", ""), "address": c.get("address", "")}
         # 順手在背景觸發更新（如果過期、不會阻塞請求）
         if cached and (time.time() - _customers_cache.get("time", 0)) >= CACHE_TTL:
-            with _cache_lock:
-                global _refresh_thread
-                if _refresh_thread is None or not _refresh_thread.is_alive():
-                    _refresh_thread = threading.Thread(
-                        target=_refresh_shopify_async, daemon=True, name="ShopifyRefresh"
-                    )
-                    _refresh_thread.start()
+            _start_background_refresh()
     except Exception as e:
         print(f"[export-pending] Shopify cache 讀取失敗（不致命）: {e}", flush=True)
     conn.close()
@@ -4357,13 +4881,13 @@ def _admin_exports_pending_impl():
     items = []
     for r in rows:
         rd = dict(r)
-        pids = _parse_pkg_ids(rd.get("package_ids"))
+        pids = req_pids.get(rd["id"], [])
         # ship_* 為空時用 fallback 在 UI 也能看到正確資料
         ship_recipient = _safe_str(rd.get("ship_recipient"))
         ship_phone     = _safe_str(rd.get("ship_phone"))
         ship_address   = _safe_str(rd.get("ship_address"))
         if not (ship_recipient and ship_phone and ship_address):
-            fb = members_map.get(rd["g_code"]) or shopify_map.get(rd["g_code"]) or {}
+            fb = members_map.get(rd["g_code"]) or {}
             if not ship_recipient: ship_recipient = _safe_str(fb.get("name")) or _safe_str(rd.get("customer_name"))
             if not ship_phone:     ship_phone     = _safe_str(fb.get("phone"))
             if not ship_address:   ship_address   = _safe_str(fb.get("address"))
@@ -4435,9 +4959,10 @@ def _admin_exports_generate_impl():
         return jsonify({"success": False, "error": "選定的單都已匯出或狀態不符（可能被別人剛剛搶先匯出了）"}), 400
 
     # 撈所有相關 packages
+    req_pids = _shipment_pkg_ids(conn, [r["id"] for r in rows])
     all_pkg_ids = set()
-    for r in rows:
-        all_pkg_ids.update(_parse_pkg_ids(r["package_ids"]))
+    for pids in req_pids.values():
+        all_pkg_ids.update(pids)
     pkg_map = {}
     if all_pkg_ids:
         ph = ",".join(["?"] * len(all_pkg_ids))
@@ -4449,23 +4974,8 @@ def _admin_exports_generate_impl():
 
     # 撈會員資料做 fallback（舊出貨單 ship_* 欄位可能空白）
     g_codes_needed = list({r["g_code"] for r in rows})
-    members_map = {}  # g_code → {name, phone, address}
-    if g_codes_needed:
-        ph = ",".join(["?"] * len(g_codes_needed))
-        for m in conn.execute(
-            f"SELECT g_code, name, phone, address FROM members WHERE g_code IN ({ph})",
-            g_codes_needed
-        ).fetchall():
-            members_map[m["g_code"]] = {"name": m["name"], "phone": m["phone"], "address": m["address"]}
-    # Shopify 客戶 fallback：從「目前已快取」撈，不觸發新抓取（避免冷啟動阻塞）
-    shopify_map = {}
-    try:
-        cached = _customers_cache.get("data") or []
-        for c in cached:
-            if c.get("g_code") in g_codes_needed:
-                shopify_map[c["g_code"]] = {"name": c.get("name", ""), "phone": c.get("phone", ""), "address": c.get("address", "")}
-    except Exception as ex:
-        print(f"[export] Shopify fallback 失敗（不致命）: {ex}", flush=True)
+    # members 表 + Shopify 鏡像表（不觸發新抓取，避免冷啟動阻塞）
+    members_map = _member_fallback_map(conn, g_codes_needed)  # g_code → {name, phone, address}
 
     # 組 shipments list
     shipments = []
@@ -4473,7 +4983,7 @@ def _admin_exports_generate_impl():
     missing_pkg_count = 0
     for r in rows:
         rd = dict(r)
-        pids = _parse_pkg_ids(rd.get("package_ids"))
+        pids = req_pids.get(rd["id"], [])
         # 包裹資料：找到的用真實值、找不到的用 stub
         # vendor 範本實際上只用 package_id 當隨機種子，不用 logis_num/weight 等具體欄位
         # 所以孤立資料（migration 後 packages 表沒對應）也能撐過 Excel 產出
@@ -4497,7 +5007,7 @@ def _admin_exports_generate_impl():
         ship_address   = _safe_str(rd.get("ship_address"))
         if not (ship_recipient and ship_phone and ship_address):
             g_code = rd["g_code"]
-            fallback_src = members_map.get(g_code) or shopify_map.get(g_code) or {}
+            fallback_src = members_map.get(g_code) or {}
             if not ship_recipient: ship_recipient = _safe_str(fallback_src.get("name")) or _safe_str(rd.get("customer_name"))
             if not ship_phone:     ship_phone     = _safe_str(fallback_src.get("phone"))
             if not ship_address:   ship_address   = _safe_str(fallback_src.get("address"))
@@ -4581,6 +5091,7 @@ def _admin_exports_generate_impl():
         "UPDATE shipment_requests SET export_code=? WHERE id=?",
         [(vendor_templates.export_code_for(s), s["id"]) for s in shipments]
     )
+    _match_delivery_ids(conn, shipment_ids_actually_used)
     # 順手把 fallback 出來的 ship_* 值寫回（下次匯出不用再算）
     if fallback_updates:
         conn.executemany(
@@ -4632,9 +5143,21 @@ def admin_exports_history():
     })
 
 
+# date_field 參數 → 正規化日期欄位（產生欄位，有索引）
+_SR_DATE_COLUMNS = {
+    "created_at": "created_date",
+    "updated_at": "ship_date",
+    "payment_at": "paid_date",
+}
+
+
 @app.route("/api/admin/shipment_requests", methods=["GET"])
 def admin_get_shipment_requests():
-    """管理員查看所有出貨申請（含對應客戶的待處理預報資料）"""
+    """管理員查看所有出貨申請（含對應客戶的待處理預報資料）
+
+    分頁：?cursor=（回傳的 next_cursor / prev_cursor）或 ?after_id= / ?before_id=，舊的 ?page= 仍可用；
+    ?count=exact 強制重算總筆數、?count=none 不算（游標模式預設用 COUNT_TTL 秒內的快取）。
+    """
     maybe_auto_sync()  # 後台有人活動時，距上次同步>24h 就背景同步台灣配送貨況
     status = request.args.get("status", "")
     pay = (request.args.get("pay") or "").strip()   # 帳單付款狀態：unpaid / paid / all
@@ -4650,7 +5173,6 @@ def admin_get_shipment_requests():
         limit = min(200, max(1, int(request.args.get("limit", 50))))
     except (ValueError, TypeError):
         limit = 50
-    offset = (page - 1) * limit
     aid = get_current_agent_id()
     try:
         conn = get_db()
@@ -4677,39 +5199,47 @@ def admin_get_shipment_requests():
         # 代理過濾
         if aid > 0:
             where.append("agent_id=?"); params.append(aid)
-        # 關鍵字（後端查，不再前端全撈）
+        # 關鍵字（後端查，不再前端全撈；≥3 字元走全文索引，?sort=rank 依相關度）
+        join, jparams = "", []
         if q:
-            like = f"%{q}%"
-            fields = ["g_code", "customer_name", "ship_recipient", "ship_phone",
-                      "ship_address", "note", "tracking_num", "package_summary", "payment_last5"]
-            where.append("(" + " OR ".join(f"{f} LIKE ?" for f in fields) + ")")
-            params += [like] * len(fields)
+            ranked = request.args.get("sort") == "rank"
+            join, jparams, w, wparams = _keyword_filter("shipment_requests", q, ranked)
+            if w:
+                where.append(w); params += wparams
+            elif ranked:
+                order = "ORDER BY fts.fts_rank, id DESC"
+        # 游標分頁的排序鍵（與 order 對應；依相關度排序只能用 page）。
+        # 排序鍵欄位一律 NOT NULL / 預設 ''（payment_at 未付款是 ''），可直接用 row value 比較
+        spec = {"ORDER BY id DESC": ["id"], "ORDER BY payment_at DESC, id DESC": ["payment_at", "id"]}.get(order)
         # 日期區間（auto：已出貨/已付款→出貨日 updated_at，其他→申請日 created_at）
+        # 只接受白名單欄位，對應到有索引的正規化日期欄（見 migrations v11）
         if date_from or date_to:
             df = date_field
             if df == "auto":
                 df = "updated_at" if status in ("已出貨", "已付款") else "created_at"
-            col = f"date(replace(substr(COALESCE(NULLIF({df},''), created_at),1,10),'/','-'))"
+            col = _SR_DATE_COLUMNS.get(df, "created_date")
             if date_from:
                 where.append(f"{col} >= date(?)"); params.append(date_from)
             if date_to:
                 where.append(f"{col} <= date(?)"); params.append(date_to)
 
-        wsql = (" WHERE " + " AND ".join(where)) if where else ""
-        total = conn.execute(f"SELECT COUNT(*) AS c FROM shipment_requests{wsql}", params).fetchone()["c"]
-        # 帳單管理需要「全部符合」的加總（列印摘要用），一次算好
+        try:
+            pg = _paginate(conn, "shipment_requests", join, jparams, where, params, order, spec, page, limit)
+        except ValueError as e:
+            conn.close()
+            return jsonify({"success": False, "error": str(e), "requests": []}), 400
+        rows = pg["rows"]
+        # 帳單管理需要「全部符合」的加總（列印摘要用）；翻頁時同條件重用快取，不每頁重算
         sum_total = sum_weight = 0
         if pay:
-            srow = conn.execute(
-                f"SELECT COALESCE(SUM(total_fee),0) AS st, COALESCE(SUM(billed_weight),0) AS sw FROM shipment_requests{wsql}",
-                params
-            ).fetchone()
-            sum_total = round(srow["st"] or 0)
-            sum_weight = round((srow["sw"] or 0), 1)
-        rows = conn.execute(
-            f"SELECT * FROM shipment_requests{wsql} {order} LIMIT ? OFFSET ?",
-            params + [limit, offset]
-        ).fetchall()
+            wsql = (" WHERE " + " AND ".join(where)) if where else ""
+            st, sw = _cached_agg(
+                conn,
+                f"SELECT COALESCE(SUM(total_fee),0), COALESCE(SUM(billed_weight),0) FROM shipment_requests{join}{wsql}",
+                jparams + params, exact=not pg["cursor_mode"]
+            )
+            sum_total = round(st or 0)
+            sum_weight = round((sw or 0), 1)
 
         # 一次撈出涉及到的客戶的待處理預報（避免 N+1 查詢）
         g_codes = list({r["g_code"] for r in rows if r["g_code"]})
@@ -4733,20 +5263,16 @@ def admin_get_shipment_requests():
                 })
 
         # 每筆出貨單的「信件」件數 → 帳單自動帶入信件費（件數 × NT$20）
-        req_pids = {}
-        all_pids = set()
-        for r in rows:
-            pids = _parse_pkg_ids(r["package_ids"])
-            req_pids[r["id"]] = pids
-            all_pids.update(pids)
-        letter_ids = set()
-        if all_pids:
-            ph = ",".join(["?"] * len(all_pids))
-            trows = conn.execute(
-                f"SELECT id FROM packages WHERE id IN ({ph}) AND pkg_type='信件'",
-                list(all_pids)
-            ).fetchall()
-            letter_ids = {t["id"] for t in trows}
+        letter_counts = {}
+        if rows:
+            ph = ",".join(["?"] * len(rows))
+            for t in conn.execute(
+                f"SELECT sp.shipment_id, COUNT(*) AS c FROM shipment_packages sp "
+                f"JOIN packages p ON p.id = sp.package_id "
+                f"WHERE sp.shipment_id IN ({ph}) AND p.pkg_type='信件' GROUP BY sp.shipment_id",
+                [r["id"] for r in rows]
+            ).fetchall():
+                letter_counts[t["shipment_id"]] = t["c"]
 
         conn.close()
 
@@ -4754,11 +5280,11 @@ def admin_get_shipment_requests():
         for r in rows:
             d = dict(r)
             d["pending_forecasts"] = forecast_map.get(r["g_code"], [])
-            d["letter_count"] = sum(1 for pid in req_pids.get(r["id"], []) if pid in letter_ids)
+            d["letter_count"] = letter_counts.get(r["id"], 0)
             result.append(d)
         return jsonify({"success": True, "requests": result,
-                        "total": total, "page": page, "limit": limit,
-                        "has_more": offset + len(rows) < total,
+                        "total": pg["total"], "page": page, "limit": limit, "has_more": pg["has_more"],
+                        "next_cursor": pg["next_cursor"], "prev_cursor": pg["prev_cursor"],
                         "sum_total": sum_total, "sum_weight": sum_weight})
     except Exception as e:
         return jsonify({"success": False, "error": str(e), "requests": []})
@@ -4812,16 +5338,14 @@ def admin_update_shipment_request(req_id):
     g_code_val = ""
     customer_name_val = ""
     if status == "已出貨":
-        req = conn.execute("SELECT package_ids, g_code, customer_name FROM shipment_requests WHERE id=?", (req_id,)).fetchone()
+        req = conn.execute("SELECT g_code, customer_name FROM shipment_requests WHERE id=?", (req_id,)).fetchone()
         if req:
             g_code_val = req["g_code"]
             customer_name_val = req["customer_name"] or ""
-            pkg_ids = [int(x.strip()) for x in req["package_ids"].split(",") if x.strip()]
-            if pkg_ids:
-                placeholders = ",".join(["?"] * len(pkg_ids))
-                conn.execute(
-                    f"UPDATE packages SET status='已出貨' WHERE id IN ({placeholders})", pkg_ids
-                )
+            conn.execute(
+                "UPDATE packages SET status='已出貨' "
+                "WHERE id IN (SELECT package_id FROM shipment_packages WHERE shipment_id=?)", (req_id,)
+            )
             # 自動把該客戶的待處理預報標為已處理
             conn.execute(
                 "UPDATE forecasts SET status='已處理' WHERE g_code=? AND status='待處理'",
@@ -4832,6 +5356,10 @@ def admin_update_shipment_request(req_id):
         if req:
             g_code_val = req["g_code"]
             customer_name_val = req["customer_name"] or ""
+    _match_delivery_ids(conn, [req_id])     # updated_at 變了 → {g_code}-{MMDD} 候選跟著變
+    if g_code_val:
+        _events.publish(conn, "shipment_request.updated", {"id": req_id, "status": status},
+                        audience="customer", g_code=g_code_val)
 
     conn.commit()
     conn.close()
@@ -4849,7 +5377,6 @@ def admin_revert_shipment_request(req_id):
     if not ok:
         return jsonify({"success": False, "error": "權限不足"}), 403
     conn = get_db()
-    req = conn.execute("SELECT * FROM shipment_requests WHERE id=?", (req_id,)).fetchone()
 
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     conn.execute(
@@ -4863,14 +5390,11 @@ def admin_revert_shipment_request(req_id):
     )
 
     # 包裹狀態還原為「已到貨」
-    pkg_ids_str = req["package_ids"]
-    if pkg_ids_str:
-        pkg_ids = [int(x.strip()) for x in pkg_ids_str.split(",") if x.strip()]
-        if pkg_ids:
-            placeholders = ",".join(["?"] * len(pkg_ids))
-            conn.execute(
-                f"UPDATE packages SET status='已到貨' WHERE id IN ({placeholders})", pkg_ids
-            )
+    conn.execute(
+        "UPDATE packages SET status='已到貨' "
+        "WHERE id IN (SELECT package_id FROM shipment_packages WHERE shipment_id=?)", (req_id,)
+    )
+    _match_delivery_ids(conn, [req_id])
 
     conn.commit()
     conn.close()
@@ -4906,22 +5430,17 @@ def create_forecast_simple():
            VALUES (?, ?, ?, '待處理', ?, ?, ?)""",
         (g_code, customer_name, json.dumps(valid_items, ensure_ascii=False), note, now, fc_agent_id)
     )
+    _events.publish(conn, "forecast.created", {"g_code": g_code}, audience=f"admin:{fc_agent_id or 0}", g_code=g_code)
     conn.commit()
     conn.close()
     return jsonify({"success": True, "message": "預報已送出！我們收到後會盡快處理。"})
 
 
-@app.route("/api/my_forecasts", methods=["GET"])
-def get_my_forecasts():
-    """客戶查看自己的預報"""
-    g_code = request.args.get("g_code", "").upper()
-    if not g_code:
-        return jsonify({"success": False, "error": "缺少會員編號"})
-    conn = get_db()
+def _customer_forecasts(conn, g_code, limit=20):
+    """客戶端「我的預報」清單（新→舊，items_json 展開成 items）"""
     rows = conn.execute(
-        "SELECT * FROM forecasts WHERE g_code=? ORDER BY id DESC LIMIT 20", (g_code,)
+        "SELECT * FROM forecasts WHERE g_code=? ORDER BY id DESC LIMIT ?", (g_code, limit)
     ).fetchall()
-    conn.close()
     results = []
     for r in rows:
         row = dict(r)
@@ -4930,7 +5449,138 @@ def get_my_forecasts():
         except:
             row["items"] = []
         results.append(row)
-    return jsonify({"success": True, "forecasts": results})
+    return results
+
+
+@app.route("/api/my_forecasts", methods=["GET"])
+def get_my_forecasts():
+    """客戶查看自己的預報"""
+    g_code = request.args.get("g_code", "").upper()
+    if not g_code:
+        return jsonify({"success": False, "error": "缺少會員編號"})
+    conn = get_db()
+    etag = _customer_etag(conn, g_code, "forecasts")
+    if request.if_none_match.contains(etag):
+        conn.close()
+        return _not_modified(etag)
+    results = _customer_forecasts(conn, g_code)
+    conn.close()
+    return _etag_json({"success": True, "forecasts": results}, etag)
+
+
+DASHBOARD_LIMIT = 20
+
+
+@app.route("/api/me/dashboard", methods=["GET"])
+def customer_dashboard():
+    """客戶首頁一次拿齊：徽章數字（倉庫中包裹 / 待付款出貨單 / 待處理預報）＋三個清單的第一頁。
+
+    數字讀 customer_summary（migrations v19 的 trigger 在寫入時維護），不必撈整份清單來數。
+    ETag 同其他客戶端 GET（見 _customer_etag）；沒變 → 304，只花一次主鍵查詢。
+    ?limit= 每個清單筆數（預設 20，上限 100）；?counts_only=1 只回數字（分頁徽章用，不撈清單）。
+    """
+    g_code = (request.args.get("g_code") or "").strip().upper()
+    if not g_code:
+        return jsonify({"success": False, "error": "缺少會員編號"})
+    try:
+        limit = max(1, min(int(request.args.get("limit") or DASHBOARD_LIMIT), 100))
+    except (ValueError, TypeError):
+        limit = DASHBOARD_LIMIT
+    counts_only = request.args.get("counts_only") == "1"
+    conn = get_db()
+    etag = _customer_etag(conn, g_code, "dash") + ("-counts" if counts_only else f"-{limit}")
+    if request.if_none_match.contains(etag):
+        conn.close()
+        return _not_modified(etag)
+    summary = conn.execute("SELECT * FROM customer_summary WHERE g_code=?", (g_code,)).fetchone()
+    s = dict(summary) if summary else {}
+    counts = {k: s.get(k, 0) for k in ("packages_total", "packages_waiting", "requests_total", "requests_unpaid",
+                                      "forecasts_total", "forecasts_pending")}
+    if counts_only:
+        conn.close()
+        return _etag_json({"success": True, "counts": counts}, etag)
+    packages = _customer_packages(conn, g_code, limit) if counts["packages_total"] else []
+    ship_reqs = _customer_shipment_requests(conn, g_code, limit) if counts["requests_total"] else []
+    forecasts = _customer_forecasts(conn, g_code, limit) if counts["forecasts_total"] else []
+    conn.close()
+    return _etag_json({
+        "success": True,
+        "counts": counts,
+        "packages": packages,
+        "requests": ship_reqs,
+        "forecasts": forecasts,
+        "has_more": {"packages": counts["packages_total"] > len(packages),
+                     "requests": counts["requests_total"] > len(ship_reqs),
+                     "forecasts": counts["forecasts_total"] > len(forecasts)},
+    }, etag)
+
+
+@app.route("/api/admin/badges", methods=["GET"])
+def admin_badges():
+    """後台側欄徽章數字（每 30 秒輪詢）：待處理出貨申請、已付款、待處理預報。
+
+    ETag = 出貨申請 / 預報的變更計數（migrations v15 的 trigger 維護）＋代理 ID；
+    沒變 → 304，只花一次主鍵查詢。有變才一條 SQL 算三個數字（都走索引）。
+    """
+    if not current_user():
+        return jsonify({"success": False, "error": "請先登入"}), 403
+    aid = get_current_agent_id()
+    conn = get_db()
+    versions = dict(conn.execute(
+        "SELECT name, n FROM change_counters WHERE name IN ('shipment_requests', 'forecasts')"
+    ).fetchall())
+    etag = f"badges-{aid}-{versions.get('shipment_requests', 0)}-{versions.get('forecasts', 0)}"
+    if request.if_none_match.contains(etag):
+        conn.close()
+        resp = make_response("", 304)
+        resp.set_etag(etag)
+        return resp
+    af = " AND agent_id=?" if aid > 0 else ""
+    row = conn.execute(
+        f"""SELECT
+            (SELECT COUNT(*) FROM shipment_requests WHERE status='待處理'{af}) AS shipreq_pending,
+            (SELECT COUNT(*) FROM shipment_requests
+              WHERE status='已出貨' AND payment_last5 != '' AND payment_last5 IS NOT NULL{af}) AS shipreq_paid,
+            (SELECT COUNT(*) FROM forecasts WHERE status='待處理'{af}) AS forecast_pending""",
+        (aid, aid, aid) if aid > 0 else ()
+    ).fetchone()
+    conn.close()
+    resp = jsonify({"success": True, **dict(row)})
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"   # 瀏覽器每次都帶 If-None-Match 回來驗證
+    return resp
+
+
+@app.route("/api/events", methods=["GET"])
+def event_stream():
+    """即時通知（Server-Sent Events）。帶 ?g_code= → 客戶端（自己的包裹到貨 / 出貨單更新 + 公告）；
+    否則須登入後台（出貨申請、匯款回報、預報；代理只收自己客戶的，管理員另收內部公告）。
+
+    斷線重連時瀏覽器自動帶 Last-Event-ID，從那之後補送；沒帶 → 只送之後的新事件。
+    後台 / 客戶端串流名額分開（events.MAX_STREAMS / MAX_CUSTOMER_STREAMS）：客戶分頁開再多也擠不掉後台；
+    名額滿 → 503，前端照舊輪詢。
+    """
+    g_code = (request.args.get("g_code") or "").strip().upper()
+    pool = "customer" if g_code else "staff"
+    if g_code:
+        where, params = "(audience = 'customer' AND g_code = ?) OR audience = 'customers'", [g_code]
+    elif current_user():
+        aid = get_current_agent_id()
+        where, params = ("audience GLOB 'admin:*'", []) if aid == 0 else ("audience = ?", [f"admin:{aid}"])
+        if is_super_admin():
+            where += " OR audience = 'staff'"
+    else:
+        return jsonify({"success": False, "error": "請先登入"}), 403
+    last = (request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or "").strip()
+    last_id = int(last) if last.isdigit() else _events.last_id()
+    body = _events.open(last_id, where, params, pool=pool)
+    if body is None:
+        resp = jsonify({"success": False, "error": "即時通知連線已滿，請稍後再試"})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = "60"
+        return resp
+    return Response(body, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route("/api/admin/forecasts", methods=["GET"])
@@ -0,0 +1,228 @@
+"""背景批次寫入（append-only 稽核類資料：操作紀錄等）
+
+用法（app.py）：
+    import batch_writer
+
+    _oplog_writer = batch_writer.BatchWriter(
+        "operation_logs",
+        "INSERT INTO operation_logs (operator, role, action, target, detail, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        connect=get_db,
+    )
+    _oplog_writer.submit((operator, role, action, target, detail, now))   # 不碰 DB、立即返回
+    _oplog_writer.flush()                                                 # 讀之前要看到剛寫的 → 先清空佇列
+
+行為：
+  • submit() 只把一列丟進佇列；背景執行緒每 flush_ms 毫秒或累積 max_rows 列，一次交易 executemany + commit
+    → request 路徑上不再有「拿寫鎖 + fsync」，也不和主要寫入搶鎖
+  • 佇列滿（DB 長時間鎖住）→ 該列改在呼叫端同步寫入（背壓），不丟資料
+  • 寫入失敗 → 下一輪重試，連續 MAX_RETRIES 次失敗才放棄並印出
+  • 行程結束（atexit）會把佇列寫完；gunicorn fork 後第一次 submit 才在子行程啟動執行緒
+  • metrics()：佇列深度、寫入列數 / 批次、flush 延遲（最近 / 平均 / 最大）
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+
+MAX_RETRIES = 3
+
+_STOP = object()
+
+
+class BatchWriter:
+    """單一 INSERT 語句的批次寫入器；執行緒安全。"""
+
+    def __init__(self, name, sql, connect, flush_ms=200, max_rows=100, max_queue=10000):
+        self.name = name
+        self.sql = sql
+        self.connect = connect
+        self.flush_ms = flush_ms
+        self.max_rows = max_rows
+        self._q = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.stats = {"submitted": 0, "written": 0, "batches": 0, "errors": 0, "dropped": 0,
+                      "sync_writes": 0, "max_batch": 0,
+                      "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0}
+        _writers.append(self)
+
+    # ── 對外 ──
+
+    def submit(self, row):
+        self._ensure_thread()
+        with self._lock:
+            self.stats["submitted"] += 1
+        try:
+            self._q.put_nowait(row)
+        except queue.Full:
+            # 背壓：佇列滿代表 DB 卡住了，這列就在呼叫端直接寫
+            with self._lock:
+                self.stats["sync_writes"] += 1
+            self._write([row])
+
+    def flush(self, timeout=5.0):
+        """等目前佇列裡的列都寫進 DB 才返回（讀取端要 read-your-writes 時呼叫）。"""
+        with self._lock:
+            s = self.stats
+            if s["submitted"] <= s["written"] + s["dropped"]:
+                return          # 沒有還沒落地的列
+        if not self._alive():
+            self._drain_sync()
+            return
+        done = threading.Event()
+        try:
+            self._q.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def close(self, timeout=5.0):
+        """停止背景執行緒並寫完剩餘資料（atexit 會呼叫）。"""
+        if self._alive():
+            try:
+                self._q.put(_STOP, timeout=timeout)
+                self._thread.join(timeout)
+            except queue.Full:
+                pass
+        self._drain_sync()
+
+    def metrics(self):
+        with self._lock:
+            s = dict(self.stats)
+        total = s.pop("total_flush_ms")
+        s["avg_flush_ms"] = round(total / s["batches"], 2) if s["batches"] else 0.0
+        s["last_flush_ms"] = round(s["last_flush_ms"], 2)
+        s["max_flush_ms"] = round(s["max_flush_ms"], 2)
+        s.update(name=self.name, queue_depth=self._q.qsize(), alive=self._alive(),
+                 flush_ms=self.flush_ms, max_rows=self.max_rows)
+        return s
+
+    # ── 內部 ──
+
+    def _alive(self):
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def _ensure_thread(self):
+        if self._alive():
+            return
+        with self._lock:
+            if self._alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name=f"BatchWriter-{self.name}")
+            self._thread.start()
+
+    def _run(self):
+        pending = []        # 上一輪寫失敗、待重試的列
+        retries = 0
+        while True:
+            batch, waiters, stop = pending, [], False
+            try:
+                item = self._q.get(timeout=None if not batch else self.flush_ms / 1000)
+            except queue.Empty:
+                item = None
+            deadline = time.monotonic() + self.flush_ms / 1000
+            while item is not None:
+                if item is _STOP:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.max_rows:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if stop:
+                # 收尾：把佇列剩下的也帶走
+                batch += self._take_all(waiters)
+            pending = []
+            if batch:
+                ok = self._write(batch)
+                if not ok:
+                    retries += 1
+                    if retries < MAX_RETRIES and not stop:
+                        pending = batch
+                    else:
+                        with self._lock:
+                            self.stats["dropped"] += len(batch)
+                        print(f"[batch_writer] ❌ {self.name} 連續 {retries} 次寫入失敗，放棄 {len(batch)} 列",
+                              flush=True)
+                        retries = 0
+                else:
+                    retries = 0
+            for w in waiters:
+                w.set()
+            if stop:
+                return
+
+    def _take_all(self, waiters):
+        rows = []
+        while True:
+            try:
+                item = self._q.get_nowait()
+            except queue.Empty:
+                return rows
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+            elif item is not _STOP:
+                rows.append(item)
+
+    def _drain_sync(self):
+        waiters = []
+        rows = self._take_all(waiters)
+        if rows and not self._write(rows):
+            with self._lock:
+                self.stats["dropped"] += len(rows)
+        for w in waiters:
+            w.set()
+
+    def _write(self, rows):
+        t0 = time.time()
+        try:
+            conn = self.connect()
+            try:
+                conn.executemany(self.sql, rows)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            with self._lock:
+                self.stats["errors"] += 1
+            print(f"[batch_writer] ⚠️ {self.name} 寫入 {len(rows)} 列失敗: {e}", flush=True)
+            return False
+        ms = (time.time() - t0) * 1000
+        with self._lock:
+            s = self.stats
+            s["written"] += len(rows)
+            s["batches"] += 1
+            s["max_batch"] = max(s["max_batch"], len(rows))
+            s["last_flush_ms"] = ms
+            s["max_flush_ms"] = max(s["max_flush_ms"], ms)
+            s["total_flush_ms"] += ms
+        return True
+
+
+_writers = []
+
+
+def metrics():
+    return [w.metrics() for w in list(_writers)]
+
+
+@atexit.register
+def _close_all():
+    for w in list(_writers):
+        try:
+            w.close()
+        except Exception as e:
+            print(f"[batch_writer] 結束時寫入 {w.name} 失敗: {e}", flush=True)
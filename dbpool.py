@@ -0,0 +1,208 @@
+"""SQLite 連線池（每個 worker 行程各一組，依 DB 路徑分池）
+
+用法（app.py）：
+    import dbpool
+    dbpool.init_app(app)
+
+    def get_db():
+        return dbpool.connect(DB_PATH)
+
+行為：
+  • 連線開一次、PRAGMA 設一次（busy_timeout / synchronous / cache_size / mmap_size / temp_store），
+    之後一直重用 → 不再每次 get_db() 都 connect + 冷 page cache
+  • 同一個 request（Flask app context）內多次 get_db() 共用同一條連線，
+    巢狀呼叫（例如 create_shipment_request 裡的 get_agent_id_for_g_code）不再另開連線
+  • close() 只是「歸還」：引用數歸零時 rollback 沒 commit 的交易、放回池子（行為與以前關連線一致）
+  • request 結束（teardown_appcontext）強制歸還，漏 close 也不會洩漏
+  • sqlite3 的 statement cache 跟著連線走 → 熱門 SQL 的 prepared statement 跨 request 重用
+  • 沒有 app context（開機 init_db、背景執行緒）→ 直接向池子借一條，close() 時歸還
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from flask import g, has_app_context
+
+# 每條連線的 page cache（KB，負值＝以 KB 計）、mmap 大小；可用環境變數微調
+CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_KB", "16000"))
+MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_MB", "128")) * 1024 * 1024
+# 池子最多保留幾條閒置連線（超過的歸還時直接關掉）
+MAX_IDLE = int(os.environ.get("SQLITE_POOL_SIZE", "8"))
+# sqlite3 模組每條連線快取的 prepared statement 數（預設 128，app 的 SQL 種類比這多）
+STATEMENT_CACHE = 256
+
+PRAGMAS = (
+    # 等鎖最多 5 秒（預設 0 秒）→ 多 worker 同時寫時不會立刻「database is locked」
+    "PRAGMA busy_timeout=5000",
+    # WAL 下 NORMAL 就安全，比 FULL 少一半 fsync（synchronous 是連線層級，每條都要設）
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA cache_size=-{CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size={MMAP_SIZE}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class ConnectionPool:
+    """單一 DB 檔的連線池。acquire() 借、release() 還；執行緒安全。"""
+
+    def __init__(self, path, max_idle=MAX_IDLE):
+        self.path = path
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._in_use = 0
+        self.stats = {"opened": 0, "reused": 0, "released": 0,
+                      "discarded": 0, "rollbacks": 0, "open_ms": 0.0}
+
+    def _check_fork(self):
+        # gunicorn fork 後不能沿用父行程的連線：丟掉（不 close，避免動到父行程的鎖）
+        if self._pid != os.getpid():
+            self._idle = []
+            self._in_use = 0
+            self._pid = os.getpid()
+
+    def _open(self):
+        t0 = time.time()
+        conn = sqlite3.connect(self.path, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE)
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        self.stats["opened"] += 1
+        self.stats["open_ms"] += (time.time() - t0) * 1000
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            self._check_fork()
+            conn = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            if conn is not None:
+                self.stats["reused"] += 1
+                return conn
+        try:
+            return self._open()
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+            raise
+
+    def release(self, conn):
+        keep = True
+        try:
+            if conn.in_transaction:
+                # 與以前「沒 commit 就 close」一致：未提交的寫入丟棄
+                conn.rollback()
+                self.stats["rollbacks"] += 1
+        except sqlite3.Error:
+            keep = False
+        with self._lock:
+            self._in_use = max(0, self._in_use - 1)
+            self.stats["released"] += 1
+            if keep and len(self._idle) < self.max_idle and self._pid == os.getpid():
+                self._idle.append(conn)
+                return
+            self.stats["discarded"] += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def metrics(self):
+        with self._lock:
+            s = dict(self.stats)
+            opened = s["opened"] or 1
+            s["open_ms_avg"] = round(s.pop("open_ms") / opened, 2)
+            s.update(path=self.path, pid=self._pid, idle=len(self._idle),
+                     in_use=self._in_use, max_idle=self.max_idle)
+            total = s["opened"] + s["reused"]
+            s["reuse_ratio"] = round(s["reused"] / total, 3) if total else 0.0
+            return s
+
+
+class PooledConnection:
+    """包一層 sqlite3.Connection：close() 改成歸還連線池，其餘屬性/方法原樣轉交。"""
+
+    def __init__(self, conn, pool):
+        object.__setattr__(self, "_conn", conn)
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_refs", 1)
+
+    def _live(self):
+        conn = object.__getattribute__(self, "_conn")
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return conn
+
+    def __getattr__(self, name):
+        return getattr(self._live(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._live(), name, value)
+
+    def __enter__(self):
+        return self._live().__enter__()
+
+    def __exit__(self, *exc):
+        return self._live().__exit__(*exc)
+
+    def close(self):
+        if self._conn is None:
+            return
+        object.__setattr__(self, "_refs", self._refs - 1)
+        if self._refs <= 0:
+            self._release()
+
+    def _release(self):
+        conn = self._conn
+        if conn is None:
+            return
+        object.__setattr__(self, "_conn", None)
+        object.__setattr__(self, "_refs", 0)
+        self._pool.release(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path):
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(path, ConnectionPool(path))
+    return pool
+
+
+def connect(path, shared=True):
+    """借一條已設定好的連線；用完照舊呼叫 close()（＝歸還）。
+
+    shared=False：不共用本 request 的連線（自己 commit 不會順帶提交 request 還沒 commit 的寫入）。
+    """
+    pool = get_pool(path)
+    if not shared or not has_app_context():
+        return PooledConnection(pool.acquire(), pool)
+    leases = g.setdefault("_dbpool_leases", {})
+    pc = leases.get(path)
+    if pc is not None and pc._conn is not None:
+        object.__setattr__(pc, "_refs", pc._refs + 1)
+        return pc
+    pc = PooledConnection(pool.acquire(), pool)
+    leases[path] = pc
+    return pc
+
+
+def release_context(exc=None):
+    """teardown_appcontext：歸還本 request 借出但沒 close 的連線。"""
+    for pc in g.pop("_dbpool_leases", {}).values():
+        pc._release()
+
+
+def init_app(app):
+    app.teardown_appcontext(release_context)
+
+
+def metrics():
+    return [p.metrics() for p in list(_pools.values())]
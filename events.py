@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""即時通知：事件匯流排 + SSE（Server-Sent Events）串流
+
+用法（app.py）：
+    import events
+
+    _events = events.EventBus(connect=lambda: dbpool.connect(DB_PATH, shared=False))
+
+    # 寫入端：和業務資料同一交易，commit 才算發出（rollback → 事件也不存在）
+    _events.publish(conn, "payment.reported", {"id": 12}, audience="admin:0", g_code="G0001")
+    conn.commit()
+
+    # 讀取端：回 text/event-stream；名額滿 → None（後台 / 客戶各自一份名額）
+    body = _events.open(last_id, "audience = 'customer' AND g_code = ?", ["G0001"], pool="customer")
+    return Response(body, mimetype="text/event-stream")
+
+events(id, kind, audience, g_code, data, created_at)：id 就是 SSE 的 event id。
+瀏覽器斷線重連會帶 Last-Event-ID → 從那之後補送，中間漏掉的事件不會遺失。
+
+行為：
+  • 同一個 worker 裡 publish → 叫醒 watcher 執行緒，它一看到 MAX(id) 變大就喚醒所有串流（幾十毫秒內送達）
+  • 別的 gunicorn worker 寫的事件：watcher 每 POLL_MS 毫秒查一次 MAX(id)（主鍵，極便宜）
+  • 一條串流佔一條執行緒：最長 MAX_SECONDS 秒就結束（瀏覽器自動重連）。每個 worker 同時最多
+    MAX_STREAMS 條後台串流 + MAX_CUSTOMER_STREAMS 條客戶串流（分開算：客戶端不用登入，開再多分頁也擠不掉後台；
+    兩者加起來要比 gunicorn --threads 少，留執行緒給一般請求），超過 → open() 回 None，端點回 503，前端退回輪詢
+  • 沒事件時每 HEARTBEAT 秒送一行註解，避免中間的代理把閒置連線砍掉
+  • 事件保留 RETENTION_HOURS 小時，watcher 每 PRUNE_SECONDS 秒清一次更舊的
+  • gunicorn fork 後第一次開串流才在子行程啟動 watcher
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+POLL_MS = int(os.environ.get("SSE_POLL_MS", "1000"))
+MAX_SECONDS = int(os.environ.get("SSE_MAX_SECONDS", "300"))
+MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", "6"))
+MAX_CUSTOMER_STREAMS = int(os.environ.get("SSE_MAX_CUSTOMER_STREAMS", "4"))
+HEARTBEAT = 15
+RETRY_MS = 3000
+RETENTION_HOURS = 72
+PRUNE_SECONDS = 600
+BATCH = 100
+# publish 之後（呼叫端還沒 commit）改成每 FAST_MS 毫秒查一次，最多 FAST_WINDOW 秒
+FAST_MS = 20
+FAST_WINDOW = 1.0
+
+
+def _frame(event_id, kind, data):
+    return f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n"
+
+
+class _Stream:
+    """SSE 回應本體。WSGI 伺服器在連線結束時呼叫 close() → 一定歸還名額（就算一次都沒讀過）"""
+
+    def __init__(self, gen, release):
+        self._gen = gen
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._gen)
+
+    def close(self):
+        self._gen.close()
+        if self._release:
+            self._release()
+            self._release = None
+
+
+class EventBus:
+    """events 表 + 每個 worker 一條 watcher 執行緒；執行緒安全。"""
+
+    def __init__(self, connect, poll_ms=POLL_MS, max_seconds=MAX_SECONDS, max_streams=MAX_STREAMS,
+                 heartbeat=HEARTBEAT, max_customer_streams=MAX_CUSTOMER_STREAMS):
+        self.connect = connect
+        self.poll_ms = poll_ms
+        self.max_seconds = max_seconds
+        self.max_streams = {"staff": max_streams, "customer": max_customer_streams}
+        self.heartbeat = heartbeat
+        self._cond = threading.Condition()
+        self._nudge = threading.Event()
+        self._top = 0
+        self._streams = dict.fromkeys(self.max_streams, 0)
+        self._thread = None
+        self._pid = None
+        self._owner = os.getpid()
+        self.stats = {"published": 0, "sent": 0, "streams_opened": 0, "rejected": 0, "pruned": 0}
+
+    # ── 寫入端 ──
+
+    def publish(self, conn, kind, data=None, audience="", g_code=""):
+        """記一筆事件（在呼叫端的交易裡，由呼叫端 commit）。
+
+        audience：'staff'（管理員）、'admin:<代理 id>'（該代理的後台，0 = 主站）、
+                  'customer'（g_code 那位客戶）、'customers'（全部客戶）
+        """
+        conn.execute(
+            "INSERT INTO events (kind, audience, g_code, data, created_at) VALUES (?, ?, ?, ?, ?)",
+            (kind, audience, g_code or "", json.dumps(data or {}, ensure_ascii=False, separators=(",", ":")),
+             datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+        self.stats["published"] += 1
+        if self._alive():
+            self._nudge.set()
+
+    # ── 讀取端 ──
+
+    def last_id(self):
+        conn = self.connect()
+        try:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        finally:
+            conn.close()
+
+    def open(self, last_id, where, params, pool="staff"):
+        """開一條 SSE 串流：佔一個名額並回傳可迭代的回應本體；名額滿 → None（呼叫端回 503）。
+
+        where / params：篩選事件的 SQL 條件與參數（呼叫端依登入身分組好）。
+        pool：'staff'（後台）或 'customer'（客戶端），兩邊名額分開算。
+        """
+        self._ensure_thread()
+        with self._cond:
+            if self._streams[pool] >= self.max_streams[pool]:
+                self.stats["rejected"] += 1
+                return None
+            self._streams[pool] += 1
+            self.stats["streams_opened"] += 1
+        return _Stream(self._stream(last_id, where, params), lambda: self._release(pool))
+
+    def _release(self, pool):
+        with self._cond:
+            self._streams[pool] -= 1
+
+    def _stream(self, last_id, where, params):
+        """先補送 id > last_id 且符合 where 的事件，之後等新事件；max_seconds 秒後結束（瀏覽器會自動重連）"""
+        yield f"retry: {RETRY_MS}\n\n"
+        deadline = time.time() + self.max_seconds
+        while time.time() < deadline:
+            with self._cond:
+                seen = self._top
+            rows = self._fetch(last_id, where, params)
+            for event_id, kind, data in rows:
+                yield _frame(event_id, kind, data)
+                last_id = event_id
+            self.stats["sent"] += len(rows)
+            if len(rows) == BATCH:
+                continue
+            with self._cond:
+                woke = self._cond.wait_for(lambda: self._top > seen,
+                                           timeout=min(self.heartbeat, max(deadline - time.time(), 0)))
+            if not woke:
+                yield ": ping\n\n"
+
+    def _fetch(self, last_id, where, params):
+        conn = self.connect()
+        try:
+            return [tuple(r) for r in conn.execute(
+                f"SELECT id, kind, data FROM events WHERE id > ? AND ({where}) ORDER BY id LIMIT ?",
+                [last_id] + list(params) + [BATCH]
+            ).fetchall()]
+        finally:
+            conn.close()
+
+    def metrics(self):
+        return {**self.stats, "streams": self._streams["staff"], "customer_streams": self._streams["customer"],
+                "last_id": self._top}
+
+    # ── watcher ──
+
+    def _alive(self):
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def _ensure_thread(self):
+        if self._alive():
+            return
+        if self._owner != os.getpid():
+            # fork 後父行程的鎖 / 串流計數不能沿用
+            self._owner = os.getpid()
+            self._cond = threading.Condition()
+            self._nudge = threading.Event()
+            self._streams = dict.fromkeys(self.max_streams, 0)
+        with self._cond:
+            if self._alive():
+                return
+            self._top = self.last_id()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="events-watcher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        fast_until = 0.0
+        next_prune = time.time()
+        while True:
+            wait = FAST_MS if time.time() < fast_until else self.poll_ms
+            if self._nudge.wait(wait / 1000):
+                self._nudge.clear()
+                fast_until = time.time() + FAST_WINDOW
+            try:
+                top = self.last_id()
+                if top > self._top:
+                    with self._cond:
+                        self._top = top
+                        self._cond.notify_all()
+                    fast_until = 0.0
+                if time.time() >= next_prune:
+                    next_prune = time.time() + PRUNE_SECONDS
+                    self.prune()
+            except Exception as e:
+                print(f"[events] watcher 例外: {e}", flush=True)
+
+    def prune(self, hours=RETENTION_HOURS):
+        cutoff = (datetime.now() - timedelta(hours=hours)).strftime("%Y-%m-%d %H:%M:%S")
+        conn = self.connect()
+        try:
+            n = conn.execute("DELETE FROM events WHERE created_at < ?", (cutoff,)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        self.stats["pruned"] += n
+        return n
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""會員編號（前綴 + 四位流水號，例：G0123、T0007）配號
+
+用法（app.py）：
+    import g_codes
+
+    code = g_codes.allocate(conn, "T")      # 配一個新編號；和 INSERT members 同一交易，commit 才算數
+    g_codes.peek(conn, "G")                 # (目前最大流水號, 下一個會配出的編號)，只看不配
+    g_codes.claim(conn, "T0123")            # 手動指定 / Shopify 那邊建的編號：從空號清單拿掉、序號推到它後面
+    g_codes.release(conn, "T0007")          # 刪除會員：編號放回空號清單
+    g_codes.rebuild(conn, "G")              # 從現有編號重算序號與空號（migration 回填、Shopify 全量同步後）
+
+g_code_sequences(prefix, next_value)：每個前綴一列，配號 = 一條 UPDATE … RETURNING；
+同時兩個建會員的請求由 SQLite 寫鎖排隊，不會配到同一號（舊作法每次撈出全部編號、在 Python 找第一個空號，O(n) 又會撞號）。
+g_code_free(prefix, value)：空號清單（刪掉的會員、回填時發現的中間空號）。REUSE_GAPS 開著時優先配最小的空號，
+等同舊行為「從 1 往上找第一個沒用過的」；關掉（G_CODE_REUSE_GAPS=0）就只往上配新號。
+"""
+import os
+import re
+
+REUSE_GAPS = os.environ.get("G_CODE_REUSE_GAPS", "1") == "1"
+
+_CODE_RE = re.compile(r"([A-Z]+)([0-9]+)")
+_MAX_SKIP = 1000
+
+
+def format_code(prefix, n):
+    return f"{prefix}{n:04d}"
+
+
+def split(code):
+    """'T0007' → ('T', 7)；不是「大寫前綴 + 數字」→ None"""
+    m = _CODE_RE.fullmatch(code or "")
+    return (m.group(1), int(m.group(2))) if m else None
+
+
+def _used_numbers(conn, prefix):
+    """該前綴已用掉的流水號（本地會員 + Shopify 鏡像表；GLOB 走 g_code 索引）"""
+    pattern = prefix + "[0-9]*"
+    used = set()
+    for (code,) in conn.execute("SELECT g_code FROM members WHERE g_code GLOB ? "
+                                "UNION ALL SELECT g_code FROM shopify_members WHERE g_code GLOB ?",
+                                (pattern, pattern)):
+        parsed = split(code)
+        if parsed and parsed[0] == prefix:
+            used.add(parsed[1])
+    return used
+
+
+def _in_use(conn, code):
+    return conn.execute("SELECT 1 FROM members WHERE g_code=? UNION ALL "
+                        "SELECT 1 FROM shopify_members WHERE g_code=? LIMIT 1", (code, code)).fetchone() is not None
+
+
+def rebuild(conn, prefix):
+    """從現有編號重算 prefix 的序號與空號清單（呼叫端負責 commit）。
+
+    先寫 g_code_sequences 拿到寫鎖再讀現有編號，讀到寫完之間不會有別人配號。
+    序號只往上推不往回退：最大那號被刪掉也不重配（避免和還沒同步進來的舊資料撞號）。
+    """
+    conn.execute("INSERT OR IGNORE INTO g_code_sequences (prefix, next_value) VALUES (?, 1)", (prefix,))
+    used = _used_numbers(conn, prefix)
+    top = max(used, default=0)
+    conn.execute("UPDATE g_code_sequences SET next_value = MAX(next_value, ?) WHERE prefix=?", (top + 1, prefix))
+    conn.execute("DELETE FROM g_code_free WHERE prefix=?", (prefix,))
+    conn.executemany("INSERT INTO g_code_free (prefix, value) VALUES (?, ?)",
+                     ((prefix, n) for n in range(1, top) if n not in used))
+
+
+def allocate(conn, prefix):
+    """配一個新編號（呼叫端在同一交易裡 INSERT 會員後 commit）"""
+    for _ in range(_MAX_SKIP):
+        row = None
+        if REUSE_GAPS:
+            row = conn.execute(
+                "DELETE FROM g_code_free WHERE prefix=? "
+                "AND value = (SELECT MIN(value) FROM g_code_free WHERE prefix=?) RETURNING value",
+                (prefix, prefix)).fetchall()
+        if not row:
+            row = conn.execute("UPDATE g_code_sequences SET next_value = next_value + 1 WHERE prefix=? "
+                               "RETURNING next_value - 1", (prefix,)).fetchall()
+        if not row:
+            rebuild(conn, prefix)   # 這個前綴第一次配號（新代理）
+            continue
+        code = format_code(prefix, row[0][0])
+        # 序號表以外建的編號（手動指定、舊資料）→ 跳過這號繼續配
+        if not _in_use(conn, code):
+            return code
+    raise RuntimeError(f"前綴 {prefix} 連續 {_MAX_SKIP} 個編號都已被使用")
+
+
+def peek(conn, prefix):
+    """(目前最大流水號, 下一個會配出的編號)；唯讀，不佔號"""
+    seq = conn.execute("SELECT next_value FROM g_code_sequences WHERE prefix=?", (prefix,)).fetchone()
+    if seq is None:
+        used = _used_numbers(conn, prefix)
+        n = next((i for i in range(1, len(used) + 2) if i not in used), 1) if REUSE_GAPS else max(used, default=0) + 1
+        return max(used, default=0), format_code(prefix, n)
+    n = seq[0]
+    if REUSE_GAPS:
+        gap = conn.execute("SELECT MIN(value) FROM g_code_free WHERE prefix=?", (prefix,)).fetchone()[0]
+        n = gap or n
+    return seq[0] - 1, format_code(prefix, n)
+
+
+def claim(conn, code):
+    """不是 allocate 配出來的編號被用掉了：從空號清單拿掉，序號推到它後面"""
+    parsed = split(code)
+    if not parsed:
+        return
+    prefix, n = parsed
+    conn.execute("DELETE FROM g_code_free WHERE prefix=? AND value=?", (prefix, n))
+    conn.execute("UPDATE g_code_sequences SET next_value = MAX(next_value, ?) WHERE prefix=?", (n + 1, prefix))
+
+
+def release(conn, code):
+    """會員刪掉了：編號放回空號清單（REUSE_GAPS 關掉時只記著、不會配出去）"""
+    parsed = split(code)
+    if not parsed:
+        return
+    prefix, n = parsed
+    conn.execute("INSERT OR IGNORE INTO g_code_free (prefix, value) "
+                 "SELECT ?, ? FROM g_code_sequences WHERE prefix=? AND next_value > ?", (prefix, n, prefix, n))
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""對外 HTTP 共用 client（Shopify / JPD 雲倉 / Google 試算表）
+
+用法：
+    import http_client
+
+    resp = http_client.request("GET", csv_url, timeout=20)                  # 一般呼叫（讀取類預設可重試）
+    resp = http_client.request("POST", url, json=payload, idempotent=False)  # 會建立資料：只重試「根本沒送出去」的失敗
+    data = http_client.graphql(graphql_url, payload, headers=headers)       # Shopify GraphQL：依查詢成本節流
+    http_client.metrics()
+
+行為：
+  • 每個 host 一個 requests.Session（keep-alive 連線池，不必每次重新 TCP + TLS 握手）；gunicorn fork 後各行程自己建
+  • 重試：連線失敗 / 逾時 / 429 / 502 / 503 / 504，最多 MAX_RETRIES 次，指數退避 + full jitter（429 照 Retry-After）；
+    idempotent=False 的呼叫（JPD 建單、Shopify mutation）只重試連不上、429 這種「對方沒處理」的情況，避免重複建單
+  • Shopify REST：看 X-Shopify-Shop-Api-Call-Limit（leaky bucket 每秒補 2），快滿了先等再送
+  • Shopify GraphQL：看 extensions.cost.throttleStatus，可用點數不夠下一次查詢就先等補回；
+    回 THROTTLED（Shopify 沒執行）→ 等完重送
+  • 斷路器：同一 host 連續 BREAKER_THRESHOLD 次呼叫失敗 → BREAKER_COOLDOWN 秒內直接丟 CircuitOpenError
+    （不再每個請求都卡滿 timeout）；冷卻後先放一個試探請求，成功才恢復
+  • metrics()：各 host 呼叫數、錯誤、重試、節流等待、斷路器狀態、延遲（最近 / 平均 / p95 / 最大，含重試的整次呼叫）
+
+shopify-jpd-tool/ 裡有同一份（兩個服務分開部署），改這裡記得一起改。
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+MAX_RETRIES = 2
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+POOL_SIZE = 10                  # 每個 host 最多保留幾條 keep-alive 連線（≥ 同時送出的執行緒數）
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+RETRY_STATUS = (429, 502, 503, 504)
+REST_LEAK_PER_SEC = 2.0         # Shopify REST leaky bucket（標準方案每秒補 2）
+MAX_THROTTLE_WAIT = 10.0
+
+_IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """斷路器打開中：這個 host 最近連續失敗，暫時不送"""
+
+
+def _not_sent(e):
+    """連線根本沒建立（對方一定沒收到）→ 任何呼叫都能安全重試"""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    text = str(e)
+    return isinstance(e, requests.ConnectionError) and (
+        "NewConnectionError" in text or "NameResolutionError" in text or "Connection refused" in text)
+
+
+def _backoff(attempt, retry_after=None):
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class _Host:
+    """單一 host 的連線池、節流狀態、斷路器與統計"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        # 斷路器
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        # Shopify 節流
+        self.rest_used = self.rest_limit = 0
+        self.rest_at = 0.0
+        self.gql_available = None
+        self.gql_max = self.gql_restore = 0.0
+        self.gql_cost = 0.0
+        self.gql_at = 0.0
+        self.stats = {"calls": 0, "errors": 0, "retries": 0, "throttle_waits": 0, "throttle_wait_ms": 0.0,
+                      "breaker_opens": 0, "fast_fails": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0}
+        self.latencies = deque(maxlen=200)
+
+    def session(self):
+        with self.lock:
+            if self._session is None or self._pid != os.getpid():
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                self._session, self._pid = s, os.getpid()
+            return self._session
+
+    # ── 斷路器 ──
+
+    def admit(self):
+        with self.lock:
+            if self.failures < BREAKER_THRESHOLD:
+                return
+            if time.monotonic() < self.open_until or self.probing:
+                self.stats["fast_fails"] += 1
+                raise CircuitOpenError(f"{self.name} 連續 {self.failures} 次失敗，暫停呼叫中")
+            self.probing = True     # 冷卻結束：放這一個請求去試探
+
+    def done(self, t0, ok):
+        ms = (time.monotonic() - t0) * 1000
+        with self.lock:
+            self.probing = False
+            s = self.stats
+            s["calls"] += 1
+            s["last_ms"] = ms
+            s["total_ms"] += ms
+            s["max_ms"] = max(s["max_ms"], ms)
+            self.latencies.append(ms)
+            if ok:
+                self.failures = 0
+                return
+            s["errors"] += 1
+            self.failures += 1
+            if self.failures >= BREAKER_THRESHOLD:
+                self.open_until = time.monotonic() + BREAKER_COOLDOWN
+                s["breaker_opens"] += 1
+                print(f"[http_client] ⚠️ {self.name} 連續 {self.failures} 次失敗，斷路 {BREAKER_COOLDOWN:g}s",
+                      flush=True)
+
+    # ── Shopify 節流 ──
+
+    def _sleep(self, wait):
+        wait = min(wait, MAX_THROTTLE_WAIT)
+        if wait <= 0:
+            return
+        with self.lock:
+            self.stats["throttle_waits"] += 1
+            self.stats["throttle_wait_ms"] += wait * 1000
+        time.sleep(wait)
+
+    def wait_rest(self):
+        with self.lock:
+            if not self.rest_limit:
+                return
+            used = self.rest_used - (time.monotonic() - self.rest_at) * REST_LEAK_PER_SEC
+            wait = (used - (self.rest_limit - 2)) / REST_LEAK_PER_SEC
+        self._sleep(wait)
+
+    def note_rest(self, resp):
+        limit = resp.headers.get("X-Shopify-Shop-Api-Call-Limit")
+        if not limit or "/" not in limit:
+            return
+        used, _, total = limit.partition("/")
+        with self.lock:
+            try:
+                self.rest_used, self.rest_limit = int(used), int(total)
+            except ValueError:
+                return
+            self.rest_at = time.monotonic()
+
+    def wait_cost(self):
+        with self.lock:
+            if self.gql_available is None or not self.gql_restore:
+                return
+            available = min(self.gql_max, self.gql_available + (time.monotonic() - self.gql_at) * self.gql_restore)
+            wait = (self.gql_cost - available) / self.gql_restore
+        self._sleep(wait)
+
+    def note_cost(self, data):
+        cost = ((data or {}).get("extensions") or {}).get("cost") or {}
+        status = cost.get("throttleStatus") or {}
+        if "currentlyAvailable" not in status:
+            return
+        with self.lock:
+            self.gql_available = float(status["currentlyAvailable"])
+            self.gql_max = float(status.get("maximumAvailable") or self.gql_available)
+            self.gql_restore = float(status.get("restoreRate") or 0)
+            self.gql_cost = float(cost.get("requestedQueryCost") or cost.get("actualQueryCost") or 0)
+            self.gql_at = time.monotonic()
+
+    def metrics(self):
+        with self.lock:
+            s = dict(self.stats)
+            lat = sorted(self.latencies)
+            failures, open_until = self.failures, self.open_until
+        total = s.pop("total_ms")
+        s["avg_ms"] = round(total / s["calls"], 1) if s["calls"] else 0.0
+        s["p95_ms"] = round(lat[min(len(lat) - 1, int(len(lat) * 0.95))], 1) if lat else 0.0
+        for k in ("last_ms", "max_ms", "throttle_wait_ms"):
+            s[k] = round(s[k], 1)
+        s.update(host=self.name, consecutive_failures=failures,
+                 breaker_open=failures >= BREAKER_THRESHOLD and time.monotonic() < open_until)
+        return s
+
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def _host(url):
+    name = urlsplit(url).netloc
+    h = _hosts.get(name)
+    if h is None:
+        with _hosts_lock:
+            h = _hosts.setdefault(name, _Host(name))
+    return h
+
+
+def request(method, url, idempotent=None, retries=MAX_RETRIES, **kwargs):
+    """同 requests.request（回 Response；連線失敗丟 requests 的例外），多了連線池 / 重試 / 節流 / 斷路器。"""
+    method = method.upper()
+    if idempotent is None:
+        idempotent = method in _IDEMPOTENT_METHODS
+    h = _host(url)
+    h.admit()
+    t0 = time.monotonic()
+    try:
+        h.wait_rest()
+        attempt = 0
+        while True:
+            try:
+                resp = h.session().request(method, url, **kwargs)
+            except requests.exceptions.SSLError:
+                raise                   # 憑證問題重試也沒用
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt < retries and (idempotent or _not_sent(e)):
+                    with h.lock:
+                        h.stats["retries"] += 1
+                    time.sleep(_backoff(attempt))
+                    attempt += 1
+                    continue
+                raise
+            h.note_rest(resp)
+            status = resp.status_code
+            if status in RETRY_STATUS and attempt < retries and (idempotent or status == 429):
+                wait = _backoff(attempt, resp.headers.get("Retry-After") if status == 429 else None)
+                resp.close()
+                with h.lock:
+                    h.stats["retries"] += 1
+                time.sleep(wait)
+                attempt += 1
+                continue
+            break
+    except BaseException:
+        # 任何例外（含 requests 以外的、中斷）都要結算：否則試探旗標 probing 永遠不放，這台主機就再也打不通
+        h.done(t0, ok=False)
+        raise
+    h.done(t0, ok=status < 500)
+    return resp
+
+
+def _throttled(data):
+    return any(((e or {}).get("extensions") or {}).get("code") == "THROTTLED"
+               for e in (data or {}).get("errors") or [] if isinstance(e, dict))
+
+
+def graphql(url, payload, headers=None, timeout=15, retries=MAX_RETRIES):
+    """Shopify GraphQL → 解析後的 JSON。送之前依上次回報的可用點數先等；THROTTLED 就等完重送。
+    mutation 不做「可能已送達」的重試（見 request 的 idempotent）。"""
+    h = _host(url)
+    query = (payload or {}).get("query") or ""
+    idempotent = not query.lstrip().startswith("mutation")
+    for attempt in range(retries + 1):
+        h.wait_cost()
+        resp = request("POST", url, idempotent=idempotent, retries=retries,
+                       json=payload, headers=headers, timeout=timeout)
+        data = resp.json()
+        h.note_cost(data)
+        if not _throttled(data) or attempt == retries:
+            return data
+        with h.lock:
+            h.stats["retries"] += 1
+            has_status = h.gql_available is not None
+        if not has_status:
+            time.sleep(_backoff(attempt))
+    return data
+
+
+def metrics():
+    return [h.metrics() for h in list(_hosts.values())]
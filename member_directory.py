@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Shopify 會員清單的記憶體索引（唯讀）
+
+用法（app.py）：
+    from member_directory import MemberDirectory
+
+    d = MemberDirectory(customers)      # 每次快取更新建一份新的，整個物件替換（讀取端不用加鎖）
+    d.get("G0001")                      # 依客編 O(1)
+    d.by_gid("gid://shopify/Customer/1")
+
+    lookups = LookupCache(size=256, ttl=300)  # 冷啟動（還沒有整份名單）時單一會員查詢的結果
+
+索引鍵與舊的線性掃描一致：客編完全相符（同客編重複時取清單裡第一位）。
+管理端搜尋 / 電話比對走 shopify_members 鏡像表（SQL 索引），不在這裡。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemberDirectory:
+    """members = 快取裡的會員 dict 清單（不複製、不修改）"""
+
+    def __init__(self, members):
+        self.members = members
+        self._by_g_code = {}
+        self._by_gid = {}
+        for c in members:
+            self._by_g_code.setdefault(c.get("g_code") or "", c)
+            if c.get("gid"):
+                self._by_gid.setdefault(c["gid"], c)
+
+    def __len__(self):
+        return len(self.members)
+
+    def get(self, g_code):
+        return self._by_g_code.get(g_code)
+
+    def by_gid(self, gid):
+        return self._by_gid.get(gid)
+
+
+class LookupCache:
+    """小型 LRU + TTL（冷啟動時單一會員查詢用）；值可以是 None＝查無此人（也快取，避免打錯客編一直問 Shopify）。
+
+    執行緒安全；get() 沒有或過期 → LookupCache.MISS。
+    """
+
+    MISS = object()
+
+    def __init__(self, size=256, ttl=300, miss_ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self._items = OrderedDict()     # key → (到期時間, 值)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return self.MISS
+            if item[0] <= time.monotonic():
+                del self._items[key]
+                return self.MISS
+            self._items.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value):
+        ttl = self.ttl if value is not None else self.miss_ttl
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -0,0 +1,960 @@
+# -*- coding: utf-8 -*-
+"""
+資料庫 schema 版本遷移
+
+每個步驟 = (版本號, 說明, 函式)，依版本號順序套用；套用過的記在 schema_version 表。
+步驟本身冪等（先查 PRAGMA table_info 再 ALTER，不靠 try/except 吞錯），
+舊 DB（版本表還不存在、但欄位早就加過）跑一遍也只是補記版本。
+
+開機（app.init_db）只查一次目前版本：已是最新 → 不拿寫鎖、直接結束。
+部署時先跑一次（Procfile 已接好），gunicorn 各 worker 開機就只剩那一次查詢：
+
+    python migrations.py              # 套用尚未套用的步驟
+    python migrations.py --status     # 只看目前版本與待套用步驟
+    python migrations.py --db other.db
+
+新增欄位 / 資料表：在 MIGRATIONS 尾端加一步（版本號遞增），不要改已上線的步驟。
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import re
+import sqlite3
+import sys
+from datetime import datetime
+
+DB_PATH = os.environ.get("DB_PATH", "packages.db")
+
+
+# ============ 工具 ============
+
+def _columns(conn, table):
+    # table_xinfo 才看得到 generated column（table_info 會略過）
+    return {r[1] for r in conn.execute(f"PRAGMA table_xinfo({table})").fetchall()}
+
+
+def _add_columns(conn, table, cols):
+    """cols = [(欄位, 型別, 預設值)]；只加還不存在的欄位。"""
+    have = _columns(conn, table)
+    for col, col_type, default in cols:
+        if col in have:
+            continue
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {col_type} DEFAULT {default}")
+        print(f"[migrate] 已加 {table}.{col} 欄位", flush=True)
+
+
+def _add_generated(conn, table, cols):
+    """cols = [(欄位, 型別, 運算式)]；加 VIRTUAL generated column（ALTER 只能加 VIRTUAL）。"""
+    have = _columns(conn, table)
+    for col, col_type, expr in cols:
+        if col in have:
+            continue
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {col_type} GENERATED ALWAYS AS ({expr}) VIRTUAL")
+        print(f"[migrate] 已加 {table}.{col} 產生欄位", flush=True)
+
+
+def parse_pkg_ids(raw):
+    """容錯解析 package_ids 字串 → [int]（保序、不去重，與舊 list comprehension 行為一致）。
+
+    支援這些髒格式：
+      • "5,8,12"        → [5, 8, 12]   （正常）
+      • "5.0,8.0,12.0"  → [5, 8, 12]   （migration 把整數 floatify；舊版用 .isdigit() 會整批解析成空）
+      • " 5 , 8 "       → [5, 8]       （多餘空白）
+      • "5，8、12"       → [5, 8, 12]   （全形逗號／頓號／空白分隔）
+      • None / ""       → []
+    只接受純整數或「整數.000」格式；"5.7" / "abc" / "-3" / "1e3" 一律忽略，
+    避免把壞資料硬轉成錯誤 ID。
+
+    放在這裡是因為 shipment_packages 回填（v10）與 app.py 要用同一套規則。
+    """
+    if raw is None:
+        return []
+    out = []
+    for tok in re.split(r"[,，、\s]+", str(raw)):
+        tok = tok.strip()
+        if not tok:
+            continue
+        # 純整數，或整數後接全 0 的小數（"5"、"5.0"、"5.00"）
+        if re.fullmatch(r"\d+(?:\.0+)?", tok):
+            n = int(float(tok))
+            if n > 0:
+                out.append(n)
+    return out
+
+
+def link_shipment_packages(conn, shipment_id, pkg_ids):
+    """寫入（覆寫）某張出貨單的 shipment_packages 對照列；seq 保留原本順序。"""
+    conn.execute("DELETE FROM shipment_packages WHERE shipment_id=?", (shipment_id,))
+    conn.executemany(
+        "INSERT INTO shipment_packages (shipment_id, seq, package_id) VALUES (?, ?, ?)",
+        [(shipment_id, seq, pid) for seq, pid in enumerate(pkg_ids)]
+    )
+
+
+# 出貨單 → 貨運行試算表「客戶編號」比對要用的欄位（match_shipment_delivery 的 shipments 依此順序）
+DELIVERY_MATCH_COLS = "id, g_code, export_code, updated_at, created_at"
+
+
+def _mmdd(v):
+    try:
+        return datetime.strptime(str(v)[:10], "%Y-%m-%d").strftime("%m%d")
+    except (ValueError, TypeError):
+        return None
+
+
+def delivery_candidates(g_code, export_code, updated_at, created_at):
+    """出貨單在貨運行試算表可能的客戶編號（依優先順序）：存的 export_code ＋ 現算 {g_code}-{MMDD}。
+
+    MMDD 取 updated_at（＝標記已出貨那天），其次 created_at，讓 export_code 上線前的舊單也能對到。
+    """
+    out = []
+    for c in [export_code] + [f"{g_code}-{mm}" for mm in (_mmdd(updated_at), _mmdd(created_at)) if mm]:
+        if c and c not in out:
+            out.append(c)
+    return out
+
+
+def _chunks(seq, n=500):
+    seq = list(seq)
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+
+def match_shipment_delivery(conn, shipments):
+    """重算這些出貨單在 shipment_delivery 的台灣配送對應（依候選順序取第一個有派件單號的）。
+
+    shipments：DELIVERY_MATCH_COLS 順序的列。對不到的會刪掉舊對應。回傳「新對到」（之前沒有對應）的筆數。
+    放在這裡是因為 v22 回填與 app.py（貨況同步 / 匯出 / 出貨單更新）要用同一套規則。
+    """
+    cands = {r[0]: delivery_candidates(*r[1:5]) for r in shipments}
+    if not cands:
+        return 0
+    tmap = {}
+    for chunk in _chunks({c for cs in cands.values() for c in cs}):
+        for code, carrier, tracking in conn.execute(
+            f"SELECT customer_code, COALESCE(carrier, ''), tracking_num FROM delivery_tracking "
+            f"WHERE customer_code IN ({','.join('?' * len(chunk))}) AND COALESCE(tracking_num, '') != ''", chunk
+        ):
+            tmap[code] = (code, carrier, tracking)
+    existing = {}
+    for chunk in _chunks(cands):
+        for sid, code, carrier, tracking in conn.execute(
+            f"SELECT shipment_id, customer_code, carrier, tracking_num FROM shipment_delivery "
+            f"WHERE shipment_id IN ({','.join('?' * len(chunk))})", chunk
+        ):
+            existing[sid] = (code, carrier, tracking)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    upserts, deletes, matched = [], [], 0
+    for sid, cs in cands.items():
+        hit = next((tmap[c] for c in cs if c in tmap), None)
+        old = existing.get(sid)
+        if hit == old:
+            continue
+        if hit is None:
+            deletes.append((sid,))
+        else:
+            upserts.append((sid,) + hit + (now,))
+            matched += old is None
+    conn.executemany("DELETE FROM shipment_delivery WHERE shipment_id=?", deletes)
+    conn.executemany(
+        "INSERT INTO shipment_delivery (shipment_id, customer_code, carrier, tracking_num, matched_at) "
+        "VALUES (?, ?, ?, ?, ?) ON CONFLICT(shipment_id) DO UPDATE SET customer_code=excluded.customer_code, "
+        "carrier=excluded.carrier, tracking_num=excluded.tracking_num, matched_at=excluded.matched_at",
+        upserts
+    )
+    return matched
+
+
+# ============ 遷移步驟 ============
+
+def _m001_base_tables(conn):
+    """初版資料表（CREATE TABLE IF NOT EXISTS，既有 DB 不受影響）"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS packages (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            g_code      TEXT    NOT NULL,
+            logis_num   TEXT,
+            product_name TEXT   DEFAULT '',
+            weight      TEXT    DEFAULT '',
+            status      TEXT    DEFAULT '已到貨',
+            note        TEXT    DEFAULT '',
+            in_date     TEXT,
+            created_at  TEXT    NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS shipment_requests (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            g_code      TEXT    NOT NULL,
+            customer_name TEXT  DEFAULT '',
+            package_ids TEXT    NOT NULL,
+            package_summary TEXT DEFAULT '',
+            status      TEXT    DEFAULT '待處理',
+            note        TEXT    DEFAULT '',
+            admin_note  TEXT    DEFAULT '',
+            created_at  TEXT    NOT NULL,
+            updated_at  TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS forecasts (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            g_code      TEXT    NOT NULL,
+            customer_name TEXT  DEFAULT '',
+            items_json  TEXT    NOT NULL,
+            status      TEXT    DEFAULT '待處理',
+            note        TEXT    DEFAULT '',
+            created_at  TEXT    NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS admin_settings (
+            key   TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_tracking (
+            customer_code TEXT PRIMARY KEY,
+            carrier       TEXT DEFAULT '',
+            tracking_num  TEXT DEFAULT '',
+            synced_at     TEXT DEFAULT ''
+        )
+    """)
+    # ── 員工班表（老闆排班，員工登入可看全部人本月+下月）──
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS staff_schedules (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            staff_id   INTEGER NOT NULL,
+            staff_name TEXT DEFAULT '',
+            work_date  TEXT NOT NULL,
+            start_time TEXT DEFAULT '',
+            end_time   TEXT DEFAULT '',
+            created_at TEXT NOT NULL
+        )
+    """)
+    # ── 操作紀錄（誰做了什麼：到貨建立/出貨/帳單確認/認領）──
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS operation_logs (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            operator   TEXT DEFAULT '',
+            role       TEXT DEFAULT '',
+            action     TEXT DEFAULT '',
+            target     TEXT DEFAULT '',
+            detail     TEXT DEFAULT '',
+            created_at TEXT NOT NULL
+        )
+    """)
+    # ── 無主包裹認領牆（沒客編/羅馬拼音的包裹，先登記保留到倉日，認領後轉入 packages）──
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS unclaimed_packages (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient_name  TEXT DEFAULT '',
+            logis_num       TEXT DEFAULT '',
+            product_name    TEXT DEFAULT '',
+            weight          TEXT DEFAULT '',
+            note            TEXT DEFAULT '',
+            registered_date TEXT,
+            created_at      TEXT NOT NULL
+        )
+    """)
+    # ── 停用會員名單（集運系統層級，不動 Shopify；g_code 為鍵）──
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS disabled_members (
+            g_code       TEXT PRIMARY KEY,
+            reason       TEXT DEFAULT '',
+            disabled_at  TEXT DEFAULT ''
+        )
+    """)
+    # ── 代理每週分潤撥款記錄（agent_id + period_key 唯一）──
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS agent_payouts (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT,
+            agent_id      INTEGER NOT NULL,
+            period_key    TEXT NOT NULL,
+            amount        REAL DEFAULT 0,
+            payment_last5 TEXT DEFAULT '',
+            paid_at       TEXT DEFAULT '',
+            note          TEXT DEFAULT '',
+            created_at    TEXT DEFAULT '',
+            UNIQUE(agent_id, period_key)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS addresses (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            g_code      TEXT    NOT NULL,
+            label       TEXT    DEFAULT '',
+            recipient   TEXT    NOT NULL,
+            phone       TEXT    NOT NULL,
+            zipcode     TEXT    DEFAULT '',
+            address     TEXT    NOT NULL,
+            is_default  INTEGER DEFAULT 0,
+            created_at  TEXT    NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS announcements (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            title       TEXT    NOT NULL,
+            content     TEXT    NOT NULL,
+            is_active   INTEGER DEFAULT 1,
+            created_at  TEXT    NOT NULL
+        )
+    """)
+    # ── 內部公告（只給後台老闆/員工看，客戶端讀不到）──
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS internal_announcements (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            title       TEXT    NOT NULL,
+            content     TEXT    NOT NULL,
+            is_active   INTEGER DEFAULT 1,
+            created_at  TEXT    NOT NULL
+        )
+    """)
+    # ── 內部公告已讀記錄（誰按過「我知道了」）──
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS internal_ann_reads (
+            username    TEXT NOT NULL,
+            ann_id      INTEGER NOT NULL,
+            read_at     TEXT NOT NULL,
+            UNIQUE(username, ann_id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS admin_users (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            username    TEXT    UNIQUE NOT NULL,
+            password    TEXT    NOT NULL,
+            role        TEXT    DEFAULT 'admin',
+            created_at  TEXT    NOT NULL
+        )
+    """)
+    # ===== 代理帳號表（Phase 1）=====
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS agents (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            username        TEXT UNIQUE NOT NULL,
+            password        TEXT NOT NULL,
+            prefix          TEXT UNIQUE NOT NULL,
+            name            TEXT NOT NULL,
+            min_rate        REAL DEFAULT 180,
+            contact_phone   TEXT DEFAULT '',
+            contact_email   TEXT DEFAULT '',
+            status          TEXT DEFAULT 'active',
+            note            TEXT DEFAULT '',
+            created_at      TEXT NOT NULL
+        )
+    """)
+    # ===== 會員表（代理建的客戶，存本地；你自己的客戶仍走 Shopify）=====
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS members (
+            g_code          TEXT PRIMARY KEY,
+            agent_id        INTEGER NOT NULL,
+            name            TEXT NOT NULL,
+            password        TEXT DEFAULT '',
+            phone           TEXT DEFAULT '',
+            address         TEXT DEFAULT '',
+            line_id         TEXT DEFAULT '',
+            email           TEXT DEFAULT '',
+            note            TEXT DEFAULT '',
+            status          TEXT DEFAULT 'active',
+            created_at      TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_members_agent ON members(agent_id)")
+
+
+def _m002_billing_columns(conn):
+    """出貨單帳單欄位 + 出檔案給廠商（Nigel / JpD）追蹤欄位"""
+    _add_columns(conn, "shipment_requests", [
+        ("admin_note", "TEXT", "''"),
+        ("updated_at", "TEXT", "NULL"),
+        ("billed_weight", "REAL", "0"),
+        ("rate_per_kg", "REAL", "0"),
+        ("shipping_fee", "REAL", "0"),
+        ("handling_fee", "REAL", "0"),
+        ("total_fee", "REAL", "0"),
+        ("payment_last5", "TEXT", "''"),
+        ("payment_at", "TEXT", "''"),
+        ("tracking_num", "TEXT", "''"),
+        ("extra_services", "TEXT", "''"),
+        ("ship_recipient", "TEXT", "''"),
+        ("ship_phone", "TEXT", "''"),
+        ("ship_address", "TEXT", "''"),
+        ("consolidation_fee", "REAL", "0"),
+        ("letter_fee", "REAL", "0"),
+        ("boxes_json", "TEXT", "''"),   # 多箱明細 [{actual_weight,length,width,height,tracking_num,billed_weight}]
+        ("exported_at", "TEXT", "''"),
+        ("exported_vendor", "TEXT", "''"),
+        ("exported_batch_id", "TEXT", "''"),
+    ])
+
+
+def _m003_agent_id(conn):
+    """Phase 2：agent_id 欄位（既有資料預設 0 = 主管理員的）+ 索引"""
+    for table in ["packages", "forecasts", "shipment_requests", "announcements"]:
+        _add_columns(conn, table, [("agent_id", "INTEGER", "0")])
+    for table in ["packages", "forecasts", "shipment_requests"]:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_agent ON {table}(agent_id)")
+
+
+def _m004_member_rate(conn):
+    """members.shipping_rate：0 = 沿用該代理的 min_rate；>0 = 該會員的專屬費率"""
+    _add_columns(conn, "members", [("shipping_rate", "REAL", "0")])
+
+
+def _m005_pkg_type(conn):
+    """packages.pkg_type：區分「包裹」與「信件」（信件計費一件 +NT$20）"""
+    _add_columns(conn, "packages", [("pkg_type", "TEXT", "'包裹'")])
+
+
+def _m006_export_code(conn):
+    """shipment_requests.export_code（{g_code}-{MMDD}）：供台灣配送貨況比對"""
+    _add_columns(conn, "shipment_requests", [("export_code", "TEXT", "''")])
+
+
+def _m007_vendor_codes(conn):
+    """客戶 × 廠商編號對照（Shopify 主帳號客戶 + 代理客戶通用）"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS customer_vendor_codes (
+            g_code TEXT NOT NULL,
+            vendor TEXT NOT NULL,
+            code TEXT NOT NULL,
+            updated_at TEXT,
+            PRIMARY KEY (g_code, vendor)
+        )
+    """)
+
+
+def _m008_agent_branding(conn):
+    """代理品牌欄位（referral URL + 登入後客製內容）+ 撥款用銀行帳戶"""
+    _add_columns(conn, "agents", [
+        ("contact_line", "TEXT", "''"),
+        ("insurance_url", "TEXT", "''"),
+        ("insurance_label", "TEXT", "''"),
+        ("insurance_desc", "TEXT", "''"),
+        ("signup_guide", "TEXT", "''"),
+        ("promo_text", "TEXT", "''"),
+        ("promo_price", "TEXT", "''"),
+        ("owner_name", "TEXT", "''"),
+        ("owner_address", "TEXT", "''"),
+        ("bank_code", "TEXT", "''"),
+        ("bank_name", "TEXT", "''"),
+        ("bank_branch", "TEXT", "''"),
+        ("bank_account", "TEXT", "''"),
+        ("bank_account_name", "TEXT", "''"),
+    ])
+
+
+def _m009_hot_indexes(conn):
+    """熱門查詢的複合索引（依實際 WHERE / ORDER BY 設計；test_query_plans.py 會檢查）
+
+    partial index（WHERE status != '已出貨'）與運算式索引的寫法必須跟 app.py 查詢字面一致，
+    SQLite 才認得出來；改查詢時記得一起改這裡。
+    """
+    for sql in (
+        # ── packages ──
+        # get_packages / admin 搜客編：g_code=? ORDER BY id DESC
+        "CREATE INDEX IF NOT EXISTS idx_packages_gcode ON packages(g_code, id)",
+        # admin_list_packages：status=? ORDER BY id DESC（代理版多一個 agent_id）
+        "CREATE INDEX IF NOT EXISTS idx_packages_status ON packages(status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_packages_agent_status ON packages(agent_id, status, id)",
+        # 未出貨清單 / 久放包裹：只索引還在倉庫的（已出貨的永遠佔多數，不必進索引）
+        "CREATE INDEX IF NOT EXISTS idx_packages_instock ON packages(id) WHERE status != '已出貨'",
+        "CREATE INDEX IF NOT EXISTS idx_packages_instock_ref ON packages("
+        "COALESCE(NULLIF(in_date, ''), substr(created_at, 1, 10))) WHERE status != '已出貨'",
+        "CREATE INDEX IF NOT EXISTS idx_packages_agent_instock_ref ON packages(agent_id, "
+        "COALESCE(NULLIF(in_date, ''), substr(created_at, 1, 10))) WHERE status != '已出貨'",
+        # 每日進出統計：到倉日
+        "CREATE INDEX IF NOT EXISTS idx_packages_in_day ON packages(substr(COALESCE(in_date,''),1,10))",
+        # ── shipment_requests ──
+        # 客戶自己的申請 / 進行中申請 / 未付款：g_code=? [AND status ...]
+        "CREATE INDEX IF NOT EXISTS idx_sr_gcode_status ON shipment_requests(g_code, status, id)",
+        # 後台依狀態分頁：status=? ORDER BY id DESC
+        "CREATE INDEX IF NOT EXISTS idx_sr_status ON shipment_requests(status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_sr_agent_status ON shipment_requests(agent_id, status, id)",
+        # 帳單 / 待匯出：status='已出貨' + 付款末五碼 + 匯出時間
+        "CREATE INDEX IF NOT EXISTS idx_sr_pay_export ON shipment_requests(status, payment_last5, exported_at)",
+        # 每日進出統計：出貨日
+        "CREATE INDEX IF NOT EXISTS idx_sr_ship_day ON shipment_requests("
+        "status, substr(COALESCE(NULLIF(updated_at,''), created_at),1,10))",
+        # 匯出批次列表：只索引已匯出的
+        "CREATE INDEX IF NOT EXISTS idx_sr_export_batch ON shipment_requests("
+        "exported_batch_id, exported_vendor) WHERE exported_at IS NOT NULL AND exported_at != ''",
+        # ── forecasts ──
+        "CREATE INDEX IF NOT EXISTS idx_forecasts_gcode_status ON forecasts(g_code, status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_forecasts_status ON forecasts(status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_forecasts_agent_status ON forecasts(agent_id, status, id)",
+        # ── 其他 ──
+        # 地址簿：g_code=? ORDER BY is_default DESC, id DESC
+        "CREATE INDEX IF NOT EXISTS idx_addresses_gcode ON addresses(g_code, is_default, id)",
+        "CREATE INDEX IF NOT EXISTS idx_staff_schedules_date ON staff_schedules(work_date, staff_id)",
+    ):
+        conn.execute(sql)
+    # delivery_tracking 以 customer_code 為主鍵，IN (...) 查詢本來就走索引
+
+
+def _m010_shipment_packages(conn):
+    """出貨單 × 包裹對照表：取代到處 split(",") 解析 package_ids
+
+    「這個包裹在不在進行中的出貨單裡」變成一次索引查詢（idx_shipment_packages_pkg）。
+    package_ids 欄位照舊寫入（人看 / 舊資料相容），但程式一律讀這張表。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS shipment_packages (
+            shipment_id INTEGER NOT NULL,
+            seq         INTEGER NOT NULL,
+            package_id  INTEGER NOT NULL,
+            PRIMARY KEY (shipment_id, seq)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shipment_packages_pkg "
+                 "ON shipment_packages(package_id, shipment_id)")
+    n = 0
+    for sid, raw in conn.execute("SELECT id, package_ids FROM shipment_requests").fetchall():
+        link_shipment_packages(conn, sid, parse_pkg_ids(raw))
+        n += 1
+    print(f"[migrate] shipment_packages 已回填 {n} 張出貨單", flush=True)
+
+
+def _iso_date(expr):
+    # 日期欄位混著 "YYYY-MM-DD HH:MM:SS" / "YYYY/MM/DD" / 空字串 → 正規化成 ISO 日期（壞值 → NULL）
+    return f"date(replace(substr({expr}, 1, 10), '/', '-'))"
+
+
+def _m011_typed_dates(conn):
+    """正規化的日期 / 重量產生欄位 + 索引，取代查詢裡的 substr / replace / CAST 運算式
+
+    VIRTUAL 欄位不佔空間、寫入時不必改程式；建了索引後 BETWEEN / <= 就是索引區間掃描。
+      shipment_requests.created_date  申請日
+      shipment_requests.ship_date     出貨日（updated_at，舊單 fallback created_at）
+      shipment_requests.paid_date     付款日（payment_at → updated_at → created_at，與對帳一致）
+      packages.arrival_date           到倉日（in_date，沒填 fallback created_at；與久放包裹同一套）
+      packages.weight_kg              重量（weight 是 TEXT）
+    """
+    _add_generated(conn, "shipment_requests", [
+        ("created_date", "TEXT", _iso_date("created_at")),
+        ("ship_date", "TEXT", _iso_date("COALESCE(NULLIF(updated_at, ''), created_at)")),
+        ("paid_date", "TEXT", _iso_date("COALESCE(NULLIF(payment_at, ''), NULLIF(updated_at, ''), created_at)")),
+    ])
+    _add_generated(conn, "packages", [
+        ("arrival_date", "TEXT", _iso_date("COALESCE(NULLIF(in_date, ''), created_at)")),
+        ("weight_kg", "REAL", "CAST(weight AS REAL)"),
+    ])
+    # v9 的運算式索引由下面的欄位索引取代
+    for name in ("idx_packages_in_day", "idx_packages_instock_ref",
+                 "idx_packages_agent_instock_ref", "idx_sr_ship_day"):
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+    for sql in (
+        "CREATE INDEX IF NOT EXISTS idx_sr_created_date ON shipment_requests(created_date)",
+        "CREATE INDEX IF NOT EXISTS idx_sr_ship_date ON shipment_requests(ship_date)",
+        "CREATE INDEX IF NOT EXISTS idx_sr_paid_date ON shipment_requests(paid_date)",
+        # 每日營運：進倉件數 / 重量直接從索引加總，不回表
+        "CREATE INDEX IF NOT EXISTS idx_packages_arrival ON packages(arrival_date, weight_kg)",
+        # 久放包裹：只索引還在倉庫的
+        "CREATE INDEX IF NOT EXISTS idx_packages_instock_arrival ON packages(arrival_date) "
+        "WHERE status != '已出貨'",
+        "CREATE INDEX IF NOT EXISTS idx_packages_agent_instock_arrival ON packages(agent_id, arrival_date) "
+        "WHERE status != '已出貨'",
+    ):
+        conn.execute(sql)
+
+
+# 全文搜尋欄位（app.py 的 LIKE 後備搜尋也用這份清單，兩邊一致）
+FTS_COLUMNS = {
+    "shipment_requests": ["g_code", "customer_name", "ship_recipient", "ship_phone",
+                          "ship_address", "note", "tracking_num", "package_summary", "payment_last5"],
+    "packages": ["g_code", "logis_num", "product_name"],
+    "operation_logs": ["operator", "action", "target", "detail"],
+}
+
+
+def _create_fts(conn, table, cols):
+    """external-content FTS5（trigram）+ 同步 trigger + 重建索引。
+
+    trigram 以「每 3 個字元」切詞：中文姓名、電話、追蹤碼的任意片段都搜得到，
+    效果等同 LIKE '%q%'（不分大小寫），但走倒排索引。查詢字串少於 3 字元時 app 改用 LIKE。
+    """
+    fts = f"{table}_fts"
+    col_list = ", ".join(cols)
+    new_vals = ", ".join(f"new.{c}" for c in cols)
+    old_vals = ", ".join(f"old.{c}" for c in cols)
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            {col_list}, content='{table}', content_rowid='id', tokenize='trigram'
+        )
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals});
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {col_list} ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals});
+            INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals});
+        END
+    """)
+    conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+    print(f"[migrate] 已建 {fts} 全文索引", flush=True)
+
+
+def _m012_fulltext(conn):
+    """出貨申請 / 包裹 / 操作紀錄的關鍵字搜尋改走 FTS5"""
+    for table, cols in FTS_COLUMNS.items():
+        _create_fts(conn, table, cols)
+
+
+# 追蹤號反轉鍵長度：末 N 碼以內的尾碼都能用索引前綴查（實際追蹤號不超過 30 碼）
+LOGIS_REV_LEN = 32
+# 正規化：去頭尾空白、去 - 與空白、轉大寫（app 端查詢字串用同一套，見 app._logis_norm）
+_LOGIS_NORM = "replace(replace(upper(trim(COALESCE(logis_num, ''))), '-', ''), ' ', '')"
+
+
+def _m013_logis_rev(conn):
+    """packages.logis_rev：正規化後的 logis_num 倒過來寫（產生欄位）+ 索引
+
+    倉庫用「末四碼」認包裹：尾碼查詢 = logis_rev 的前綴查詢 → 索引區間掃描，O(log n)。
+    SQLite 沒有 reverse()，用 substr(x, -1, 1) || substr(x, -2, 1) || … 展開；
+    全是內建函式，其他工具（sqlite3 CLI、備份腳本）開這個 DB 也不受影響。
+    """
+    expr = " || ".join(f"substr({_LOGIS_NORM}, -{i}, 1)" for i in range(1, LOGIS_REV_LEN + 1))
+    _add_generated(conn, "packages", [("logis_rev", "TEXT", expr)])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_packages_logis_rev ON packages(logis_rev)")
+
+
+def _m014_paid_order_index(conn):
+    """已付款帳單列表（ORDER BY payment_at DESC, id DESC）的排序索引：游標分頁直接從索引接續往下讀"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sr_paid_order ON shipment_requests(payment_at, id) "
+                 "WHERE status='已出貨' AND payment_last5 != ''")
+
+
+def add_change_counter(conn, table, cols=None):
+    """change_counters 裡 table 那一列：INSERT / DELETE / UPDATE（cols 有給就只看這些欄位）時 +1 的 trigger。
+
+    讀取端拿計數當 ETag 的一部分：計數沒變 → 304，不必重跑查詢。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS change_counters (
+            name TEXT PRIMARY KEY,
+            n INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    conn.execute("INSERT OR IGNORE INTO change_counters (name, n) VALUES (?, 0)", (table,))
+    bump = f"UPDATE change_counters SET n = n + 1 WHERE name = '{table}';"
+    of = f" OF {', '.join(cols)}" if cols else ""
+    for suffix, event in (("ai", "INSERT"), ("ad", "DELETE"), ("au", f"UPDATE{of}")):
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_cc_{suffix} AFTER {event} ON {table} "
+                     f"BEGIN {bump} END")
+
+
+def _m015_badge_counters(conn):
+    """後台徽章（待處理出貨申請 / 已付款 / 待處理預報）的變更計數"""
+    add_change_counter(conn, "shipment_requests", ["status", "payment_last5", "agent_id"])
+    add_change_counter(conn, "forecasts", ["status", "agent_id"])
+
+
+def _m016_shopify_members(conn):
+    """shopify_members：Shopify 會員快取的 SQL 鏡像（app 每次同步時整批 / 增量寫入）
+
+    會員清單、搜尋、匯出補地址可以直接和 members、packages、出貨單 JOIN / UNION，不必在 Python 迴圈裡湊。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS shopify_members (
+            gid TEXT PRIMARY KEY,
+            customer_id TEXT NOT NULL DEFAULT '',
+            g_code TEXT NOT NULL,
+            name TEXT NOT NULL DEFAULT '',
+            email TEXT NOT NULL DEFAULT '',
+            phone TEXT NOT NULL DEFAULT '',
+            phone_raw TEXT NOT NULL DEFAULT '',
+            address TEXT NOT NULL DEFAULT '',
+            shipping_rate TEXT NOT NULL DEFAULT '',
+            created_at TEXT NOT NULL DEFAULT '',
+            updated_at TEXT NOT NULL DEFAULT ''
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shopify_members_gcode ON shopify_members(g_code)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_shopify_members_phone ON shopify_members(phone)")
+
+
+def _m017_member_counters(conn):
+    """後台會員清單的變更計數（ETag 用）
+
+    shopify_members 不掛 trigger：全量同步一次改幾萬列，由 app 每次寫鏡像表時在同一交易裡 +1。
+    """
+    add_change_counter(conn, "members")
+    add_change_counter(conn, "disabled_members")
+    add_change_counter(conn, "agents", ["name", "min_rate", "prefix"])
+    conn.execute("INSERT OR IGNORE INTO change_counters (name, n) VALUES ('shopify_members', 0)")
+
+
+def _m018_g_code_sequences(conn):
+    """會員編號配號表 + 回填：每個前綴（G + 各代理）的下一號與中間空號（配號邏輯見 g_codes.py）"""
+    import g_codes
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS g_code_sequences (
+            prefix TEXT PRIMARY KEY,
+            next_value INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS g_code_free (
+            prefix TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            PRIMARY KEY (prefix, value)
+        ) WITHOUT ROWID
+    """)
+    for (prefix,) in conn.execute("SELECT 'G' UNION SELECT prefix FROM agents").fetchall():
+        g_codes.rebuild(conn, prefix)
+
+
+# 客戶首頁摘要：各資料表負責的計數欄位 → 條件（g_code = ? 以外的）
+CUSTOMER_SUMMARY = {
+    "packages": {
+        "packages_total": "",
+        "packages_waiting": "status IN ('已到貨', '已入庫')",
+    },
+    "shipment_requests": {
+        "requests_total": "",
+        "requests_unpaid": "status = '已出貨' AND total_fee > 0 AND TRIM(COALESCE(payment_last5, '')) = ''",
+    },
+    "forecasts": {
+        "forecasts_total": "",
+        "forecasts_pending": "status = '待處理'",
+    },
+}
+
+
+def _summary_upsert(table, g, when=""):
+    """重算 g（NEW.g_code / OLD.g_code）在 table 負責的計數，並把 version +1；when：額外條件"""
+    cols = CUSTOMER_SUMMARY[table]
+    counts = ", ".join(f"(SELECT COUNT(*) FROM {table} WHERE g_code = {g}{' AND ' + cond if cond else ''})"
+                       for cond in cols.values())
+    sets = ", ".join(f"{c} = excluded.{c}" for c in cols)
+    return (f"INSERT INTO customer_summary (g_code, {', '.join(cols)}) SELECT {g}, {counts} "
+            f"WHERE {when}COALESCE({g}, '') != '' "
+            f"ON CONFLICT(g_code) DO UPDATE SET {sets}, version = customer_summary.version + 1;")
+
+
+def _m019_customer_summary(conn):
+    """客戶首頁摘要（每個 g_code 一列）：徽章數字 + version（ETag 用），由 trigger 在寫入時維護
+
+    包裹 / 出貨申請 / 預報任何一列新增、刪除、修改 → 重算該會員那張表的計數（走 g_code 索引），version +1。
+    g_code 被改掉（轉會員）時新舊兩位都重算。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS customer_summary (
+            g_code TEXT PRIMARY KEY,
+            packages_total INTEGER NOT NULL DEFAULT 0,
+            packages_waiting INTEGER NOT NULL DEFAULT 0,
+            requests_total INTEGER NOT NULL DEFAULT 0,
+            requests_unpaid INTEGER NOT NULL DEFAULT 0,
+            forecasts_total INTEGER NOT NULL DEFAULT 0,
+            forecasts_pending INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 1
+        ) WITHOUT ROWID
+    """)
+    for table, cols in CUSTOMER_SUMMARY.items():
+        new, old = _summary_upsert(table, "NEW.g_code"), _summary_upsert(table, "OLD.g_code")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_cs_ai AFTER INSERT ON {table} BEGIN {new} END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_cs_ad AFTER DELETE ON {table} BEGIN {old} END")
+        moved = _summary_upsert(table, "OLD.g_code", "OLD.g_code IS NOT NEW.g_code AND ")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_cs_au AFTER UPDATE ON {table} BEGIN {new} {moved} END")
+        # 回填
+        sums = ", ".join(f"COUNT(*) FILTER (WHERE {cond or 1})" for cond in cols.values())
+        sets = ", ".join(f"{c} = excluded.{c}" for c in cols)
+        conn.execute(f"INSERT INTO customer_summary (g_code, {', '.join(cols)}) "
+                     f"SELECT g_code, {sums} FROM {table} WHERE COALESCE(g_code, '') != '' GROUP BY g_code "
+                     f"ON CONFLICT(g_code) DO UPDATE SET {sets}")
+    # 首頁清單裡的台灣配送貨況來自 delivery_tracking（不分會員）
+    add_change_counter(conn, "delivery_tracking", ["carrier", "tracking_num"])
+
+
+def _summary_bump(g, when=""):
+    """只把 g 的 customer_summary.version +1（沒有計數要重算的資料表用）"""
+    return (f"INSERT INTO customer_summary (g_code) SELECT {g} WHERE {when}COALESCE({g}, '') != '' "
+            f"ON CONFLICT(g_code) DO UPDATE SET version = customer_summary.version + 1;")
+
+
+def _m020_address_version(conn):
+    """地址簿寫入也推進該會員的 version：客戶端四個 GET 共用同一個 per-g_code 版本號當 ETag"""
+    new, old = _summary_bump("NEW.g_code"), _summary_bump("OLD.g_code")
+    moved = _summary_bump("OLD.g_code", "OLD.g_code IS NOT NEW.g_code AND ")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS addresses_cs_ai AFTER INSERT ON addresses BEGIN {new} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS addresses_cs_ad AFTER DELETE ON addresses BEGIN {old} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS addresses_cs_au AFTER UPDATE ON addresses BEGIN {new} {moved} END")
+
+
+def _m021_events(conn):
+    """即時通知事件記錄（SSE 用，跨 worker 共用；見 events.py）"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind       TEXT NOT NULL,
+            audience   TEXT NOT NULL DEFAULT '',
+            g_code     TEXT NOT NULL DEFAULT '',
+            data       TEXT NOT NULL DEFAULT '{}',
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_created ON events(created_at)")
+
+
+def _m022_shipment_delivery(conn):
+    """出貨單 ↔ 台灣配送單號的對應表（貨況同步 / 匯出時算好，客戶查詢只要一個 JOIN）＋回填
+
+    對應變動 → 該會員的 customer_summary.version +1（客戶端 ETag 不必再帶整張貨況表的變更計數，
+    v19 掛在 delivery_tracking 上的計數 trigger 一併拿掉）。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS shipment_delivery (
+            shipment_id   INTEGER PRIMARY KEY,
+            customer_code TEXT NOT NULL,
+            carrier       TEXT NOT NULL DEFAULT '',
+            tracking_num  TEXT NOT NULL,
+            matched_at    TEXT NOT NULL DEFAULT ''
+        )
+    """)
+    # 貨況同步時由試算表的客戶編號反查出貨單
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sr_export_code ON shipment_requests(export_code)")
+    owner = "(SELECT g_code FROM shipment_requests WHERE id = {}.shipment_id)"
+    new, old = _summary_bump(owner.format("NEW")), _summary_bump(owner.format("OLD"))
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS shipment_delivery_cs_ai AFTER INSERT ON shipment_delivery "
+                 f"BEGIN {new} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS shipment_delivery_cs_ad AFTER DELETE ON shipment_delivery "
+                 f"BEGIN {old} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS shipment_delivery_cs_au AFTER UPDATE ON shipment_delivery "
+                 f"BEGIN {new} END")
+    for suffix in ("ai", "ad", "au"):
+        conn.execute(f"DROP TRIGGER IF EXISTS delivery_tracking_cc_{suffix}")
+    conn.execute("DELETE FROM change_counters WHERE name = 'delivery_tracking'")
+    n = match_shipment_delivery(conn, conn.execute(f"SELECT {DELIVERY_MATCH_COLS} FROM shipment_requests").fetchall())
+    print(f"[migrate] shipment_delivery 回填 {n} 筆", flush=True)
+
+
+MIGRATIONS = [
+    (1, "初版資料表", _m001_base_tables),
+    (2, "出貨單帳單 / 匯出欄位", _m002_billing_columns),
+    (3, "agent_id 欄位與索引", _m003_agent_id),
+    (4, "members.shipping_rate", _m004_member_rate),
+    (5, "packages.pkg_type", _m005_pkg_type),
+    (6, "shipment_requests.export_code", _m006_export_code),
+    (7, "customer_vendor_codes", _m007_vendor_codes),
+    (8, "代理品牌 / 銀行欄位", _m008_agent_branding),
+    (9, "熱門查詢複合索引", _m009_hot_indexes),
+    (10, "shipment_packages 對照表", _m010_shipment_packages),
+    (11, "日期 / 重量產生欄位", _m011_typed_dates),
+    (12, "FTS5 全文搜尋", _m012_fulltext),
+    (13, "追蹤號尾碼索引", _m013_logis_rev),
+    (14, "已付款排序索引", _m014_paid_order_index),
+    (15, "後台徽章變更計數", _m015_badge_counters),
+    (16, "shopify_members 鏡像表", _m016_shopify_members),
+    (17, "會員清單變更計數", _m017_member_counters),
+    (18, "會員編號配號表", _m018_g_code_sequences),
+    (19, "客戶首頁摘要", _m019_customer_summary),
+    (20, "地址簿版本號", _m020_address_version),
+    (21, "即時通知事件", _m021_events),
+    (22, "出貨單配送對應表", _m022_shipment_delivery),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+
+# ============ 引擎 ============
+
+def current_version(conn) -> int:
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:     # 版本表還不存在 = 從沒跑過
+        return 0
+    return int(row[0] or 0)
+
+
+def pending(conn) -> list:
+    v = current_version(conn)
+    return [(ver, desc) for ver, desc, _ in MIGRATIONS if ver > v]
+
+
+def _enable_wal(conn):
+    # WAL 持久化在 DB 檔案內，只需設一次（不能在交易裡切換 journal_mode）
+    # 讀寫不互鎖：讀者不擋寫者、寫者不擋讀者
+    try:
+        mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        print(f"[DB] ✅ SQLite journal_mode = {mode}", flush=True)
+    except sqlite3.Error as e:
+        print(f"[DB] ⚠️ 啟用 WAL 失敗（將使用預設模式）: {e}", flush=True)
+
+
+def migrate(conn) -> list:
+    """套用尚未套用的步驟，回傳這次套用的版本號（已是最新 → []，只做一次查詢）。
+
+    整批在一個 BEGIN IMMEDIATE 交易裡：多個 worker 同時開機時只有一個真的在遷移，
+    其他的等鎖後重查版本、發現已是最新就直接結束。
+    """
+    if current_version(conn) >= LATEST:
+        return []
+    _enable_wal(conn)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version     INTEGER PRIMARY KEY,
+                description TEXT DEFAULT '',
+                applied_at  TEXT NOT NULL
+            )
+        """)
+        v = current_version(conn)
+        applied = []
+        for ver, desc, fn in MIGRATIONS:
+            if ver <= v:
+                continue
+            fn(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (ver, desc, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            )
+            print(f"[migrate] ✅ v{ver} {desc}", flush=True)
+            applied.append(ver)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+
+# ============ 命令列 ============
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="helpshipping schema 遷移")
+    p.add_argument("--db", default=None, help="SQLite 路徑（預設 $DB_PATH 或 packages.db）")
+    p.add_argument("--status", action="store_true", help="只顯示目前版本與待套用步驟")
+    args = p.parse_args(argv)
+
+    conn = sqlite3.connect(args.db or DB_PATH, timeout=30)
+    try:
+        if args.status:
+            print(f"目前版本 v{current_version(conn)}，最新 v{LATEST}")
+            for ver, desc in pending(conn):
+                print(f"  待套用 v{ver} {desc}")
+            return 0
+        applied = migrate(conn)
+        if applied:
+            print(f"已套用 {len(applied)} 步，目前版本 v{current_version(conn)}")
+        else:
+            print(f"已是最新版本 v{LATEST}")
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
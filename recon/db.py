@@ -10,6 +10,7 @@
     payment_last5  匯款欄（末五碼，或「現金 / 後付 / 管確認 / 收日幣現金」）
     payment_at     銷帳時間 ← 用來做付款日區間篩選
     updated_at     標記已出貨那天（＝出貨日），舊單 fallback created_at
+    paid_date / ship_date  上面兩者正規化成 ISO 日期的產生欄位（migrations v11，有索引）
     agent_id       0 = 主管理員
 """
 from __future__ import annotations
@@ -51,12 +52,7 @@ SELECT
 FROM shipment_requests sr
 WHERE sr.status = '已出貨'
   AND COALESCE(sr.payment_last5, '') <> ''
-  AND (
-        date(replace(substr(COALESCE(NULLIF(sr.payment_at,''), sr.updated_at, sr.created_at), 1, 10), '/', '-'))
-        BETWEEN date(:start) AND date(:end)
-     OR date(replace(substr(COALESCE(NULLIF(sr.updated_at,''), sr.created_at), 1, 10), '/', '-'))
-        BETWEEN date(:start) AND date(:end)
-      )
+  AND (sr.paid_date BETWEEN :start AND :end OR sr.ship_date BETWEEN :start AND :end)
   {agent_filter}
 ORDER BY sr.payment_at DESC, sr.id DESC
 """
@@ -72,8 +68,7 @@ def diagnose(conn, start: date, end: date, agent_id: int = 0) -> dict:
         return conn.execute(f"SELECT COUNT(*) c FROM shipment_requests sr WHERE {where} {af}", p).fetchone()["c"]
     in_range = (
         "sr.status='已出貨' AND COALESCE(sr.payment_last5,'')<>'' AND ("
-        "date(replace(substr(COALESCE(NULLIF(sr.payment_at,''),sr.updated_at,sr.created_at),1,10),'/','-')) BETWEEN date(:start) AND date(:end)"
-        " OR date(replace(substr(COALESCE(NULLIF(sr.updated_at,''),sr.created_at),1,10),'/','-')) BETWEEN date(:start) AND date(:end))")
+        "sr.paid_date BETWEEN :start AND :end OR sr.ship_date BETWEEN :start AND :end)")
     # 取樣：區間內帳單的 payment_last5 實際長怎樣（判斷是數字末五碼還是文字如『管確認/現金』）
     samples = [str(r["payment_last5"]) for r in conn.execute(
         f"SELECT DISTINCT payment_last5 FROM shipment_requests sr WHERE {in_range} {af} LIMIT 12", p).fetchall()]
@@ -6,6 +6,7 @@ Shopify × JPD 雲倉 串接工具
 
 from flask import Flask, render_template, request, jsonify, Response
 import requests
+import http_client
 import json
 import os
 import sqlite3
@@ -139,24 +140,15 @@ def shopify_request(endpoint: str, method: str = "GET", data: dict = None) -> di
         "X-Shopify-Access-Token": SHOPIFY_ACCESS_TOKEN,
         "Content-Type": "application/json"
     }
+    body = data if method != "GET" else None
     try:
-        if method == "GET":
-            response = requests.get(url, headers=headers, timeout=30, verify=True)
-        elif method == "POST":
-            response = requests.post(url, headers=headers, json=data, timeout=30, verify=True)
-        elif method == "PUT":
-            response = requests.put(url, headers=headers, json=data, timeout=30, verify=True)
+        response = http_client.request(method, url, headers=headers, json=body, timeout=30, verify=True)
         return response.json()
     except requests.exceptions.SSLError:
         import urllib3
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         try:
-            if method == "GET":
-                response = requests.get(url, headers=headers, timeout=30, verify=False)
-            elif method == "POST":
-                response = requests.post(url, headers=headers, json=data, timeout=30, verify=False)
-            elif method == "PUT":
-                response = requests.put(url, headers=headers, json=data, timeout=30, verify=False)
+            response = http_client.request(method, url, headers=headers, json=body, timeout=30, verify=False)
             return response.json()
         except Exception as e:
             return {"error": f"SSL 錯誤: {str(e)}"}
@@ -176,7 +168,9 @@ def jpd_request(operation: str, data: dict) -> dict:
     print(f"📤 JPD API 請求: {operation}")
     print(f"Data: {json.dumps(data, ensure_ascii=False, indent=2)}")
     try:
-        response = requests.post(url, json=payload, timeout=30)
+        # 只有查詢類（TSearch*）可以逾時重送；建單 / 預報 / 確認 / 刪除重送可能重複執行
+        response = http_client.request("POST", url, json=payload, timeout=30,
+                                       idempotent=operation.startswith("TSearch"))
         result = response.json()
         print(f"📥 回應: {json.dumps(result, ensure_ascii=False, indent=2)}")
         return result
@@ -668,7 +662,7 @@ def push_tracking_to_shopify(shopify_order_id, carrier, tracking, notify=True):
 def sync_shopify_tracking(notify=True):
     """抓試算表 → 只處理對得到 Shopify 訂單（8碼注文番號）的列 → 回寫台灣追蹤。notify 決定是否發信。回傳統計。"""
     url = _kv_get("tracking_sheet_url", DEFAULT_TRACKING_SHEET_URL)
-    resp = requests.get(url, timeout=20)
+    resp = http_client.request("GET", url, timeout=20)
     resp.raise_for_status()
     text = resp.content.decode("utf-8-sig", errors="replace")
     rows = list(csv.reader(StringIO(text)))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Shopify 批次匯出（bulkOperationRunQuery）→ 逐行讀 JSONL 匯入會員
+
+用法（app.py）：
+    import shopify_bulk
+
+    for g_code, node in shopify_bulk.iter_customers(shopify_graphql, fields):
+        ...   # 一次一位，不把整份 JSONL 讀進記憶體
+
+流程：
+  1. bulkOperationRunQuery 送出「全部 customers + goyoutati_id metafield」的查詢
+  2. 每 POLL_SEC 秒查一次狀態，COMPLETED 後拿到 JSONL 下載網址（Shopify 簽好的暫時網址，不帶 token）
+  3. stream=True 逐行解析（走 http_client 的連線池 / 重試） → 沒有 goyoutati_id 的顧客跳過
+不受分頁上限影響（舊的 metafields 分頁最多 10 頁 = 1000 位）；失敗丟 BulkOperationError，
+呼叫端改走分頁抓取。離線測試 / 壓測用 shopify_standin.py 當假的 Shopify。
+"""
+import json
+import time
+
+import http_client
+
+POLL_SEC = 2.0
+TIMEOUT_SEC = 600      # 等批次作業最多 10 分鐘
+POLL_ERRORS_MAX = 3    # 查狀態連續失敗（回 errors / 連線失敗 / 查無作業）幾次就放棄，不空等到逾時
+
+_RUN_MUTATION = """
+mutation run($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+_STATUS_QUERY = """
+query status($id: ID!) {
+  node(id: $id) { ... on BulkOperation { id status errorCode objectCount url } }
+}
+"""
+
+
+class BulkOperationError(Exception):
+    """批次作業無法啟動 / 失敗 / 逾時"""
+
+
+def customers_query(fields):
+    """批次匯出用的 customers 查詢（fields = 顧客欄位；goyoutati_id 另外帶）"""
+    return ('{ customers { edges { node { ' + fields
+            + ' goyoutati:metafield(namespace:"custom",key:"goyoutati_id"){value} } } } }')
+
+
+def run_query(graphql, query, poll_sec=POLL_SEC, timeout=TIMEOUT_SEC):
+    """啟動批次作業並等它完成 → JSONL 網址（沒有任何資料時 Shopify 不給網址 → None）"""
+    result = graphql(_RUN_MUTATION, {"query": query})
+    payload = (result.get("data") or {}).get("bulkOperationRunQuery") or {}
+    errors = payload.get("userErrors") or result.get("errors") or result.get("error")
+    op = payload.get("bulkOperation")
+    if errors or not op:
+        raise BulkOperationError(f"無法啟動批次作業: {errors or result}")
+    deadline = time.time() + timeout
+    poll_errors = 0
+    while True:
+        status = graphql(_STATUS_QUERY, {"id": op["id"]})
+        node = (status.get("data") or {}).get("node") or {}
+        state = node.get("status")
+        if state is None:
+            poll_errors += 1
+            if poll_errors >= POLL_ERRORS_MAX:
+                raise BulkOperationError(
+                    f"查詢批次作業狀態連續失敗 {poll_errors} 次: {status.get('errors') or status.get('error') or status}")
+        else:
+            poll_errors = 0
+        if state == "COMPLETED":
+            print(f"[Shopify] 批次作業完成：{node.get('objectCount')} 筆", flush=True)
+            return node.get("url")
+        if state in ("FAILED", "CANCELED", "CANCELING", "EXPIRED"):
+            raise BulkOperationError(f"批次作業 {state}: {node.get('errorCode')}")
+        if time.time() >= deadline:
+            raise BulkOperationError(f"批次作業逾時（{timeout}s，狀態 {state}）")
+        time.sleep(poll_sec)
+
+
+def stream_jsonl(url, timeout=60):
+    """逐行下載解析 JSONL（一行一個物件），記憶體用量與總筆數無關"""
+    with http_client.request("GET", url, stream=True, timeout=timeout) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def iter_customers(graphql, fields, poll_sec=POLL_SEC, timeout=TIMEOUT_SEC):
+    """批次匯出所有有 goyoutati_id 的顧客 → 逐位 yield (g_code, customer 節點)"""
+    url = run_query(graphql, customers_query(fields), poll_sec=poll_sec, timeout=timeout)
+    if not url:
+        return
+    for node in stream_jsonl(url):
+        g_code = (node.get("goyoutati") or {}).get("value") or ""
+        if g_code:
+            yield g_code, node
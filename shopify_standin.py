@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""本機假 Shopify Admin API（離線測試 / 壓測會員匯入用，不連真的 Shopify）
+
+    python shopify_standin.py --members 50000 --port 8765
+    SHOPIFY_ADMIN_URL=http://127.0.0.1:8765/admin/api/2026-01 python app.py
+
+只實作 app 會員同步用到的查詢（用字串比對認查詢種類，不是真的 GraphQL 解析器）：
+  • bulkOperationRunQuery / node(id) 狀態輪詢 / GET /bulk/<id>.jsonl（逐行串流產生，不整份放記憶體）
+  • metafieldDefinitions → metafields(first:N, after:"…") 分頁（舊路徑 / 後備）
+  • customers(query:"updated_at:>='…'") 增量查詢
+  • customer(id:) 單一顧客（webhook 收到後查現況）
+  • customers(query:"metafields.custom.goyoutati_id:…") 依客編查一位（冷啟動登入）
+  • metafieldsSet（只接 custom.shipping_rate；和真的一樣最多 25 個、整批原子）
+顧客資料是合成的：第 i 位 → gid://shopify/Customer/i、客編 G%05d；每 10 位有 1 位沒有客編（非集運會員）。
+edits[i] 可改掉第 i 位的資料（None = 已刪除），模擬在 Shopify 後台修改。
+"""
+import argparse
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+UPDATED_AT = "2026-01-01T00:00:00Z"
+
+
+def customer(i):
+    """第 i 位合成顧客（與 Shopify customer 節點同形）"""
+    return {
+        "id": f"gid://shopify/Customer/{i}",
+        "firstName": f"{i}",
+        "lastName": "測試",
+        "email": f"member{i}@example.com",
+        "phone": None,
+        "defaultAddress": {"phone": f"+886 9{i % 100000000:08d}", "province": "", "city": "",
+                           "zip": "100", "address1": f"測試路{i}號", "address2": ""},
+        "createdAt": "2025-01-01T00:00:00Z",
+        "updatedAt": UPDATED_AT,
+        "shippingRate": {"value": "180"} if i % 3 == 0 else None,
+        "goyoutati": {"value": f"G{i:05d}"} if i % 10 else None,
+    }
+
+
+class Standin:
+    """members = 顧客總數；bulk_delay = 批次作業幾秒後才 COMPLETED；fail_bulk = 模擬批次作業啟動失敗"""
+
+    def __init__(self, members=1000, bulk_delay=0.0, fail_bulk=False):
+        self.members = members
+        self.bulk_delay = bulk_delay
+        self.fail_bulk = fail_bulk
+        self.ops = {}
+        self.edits = {}           # i → 顧客節點（覆蓋合成資料）或 None（已刪除）
+        self.requests = []        # (種類, …) 呼叫紀錄，測試用來斷言
+        self.server = None
+
+    def node(self, i):
+        return self.edits[i] if i in self.edits else customer(i)
+
+    # ── 查詢處理 ──
+
+    def graphql(self, query, variables):
+        if "metafieldsSet" in query:
+            return self.metafields_set((variables or {}).get("metafields") or [])
+        if "bulkOperationRunQuery" in query:
+            self.requests.append(("bulk_run",))
+            if self.fail_bulk:
+                return {"data": {"bulkOperationRunQuery": {"bulkOperation": None, "userErrors": [
+                    {"field": None, "message": "A bulk query operation for this app and shop is already in progress"}]}}}
+            op_id = f"gid://shopify/BulkOperation/{len(self.ops) + 1}"
+            self.ops[op_id] = time.time()
+            return {"data": {"bulkOperationRunQuery": {"bulkOperation": {"id": op_id, "status": "CREATED"},
+                                                       "userErrors": []}}}
+        if "BulkOperation" in query:
+            op_id = (variables or {}).get("id")
+            self.requests.append(("bulk_status", op_id))
+            started = self.ops.get(op_id)
+            if started is None:
+                return {"data": {"node": None}}
+            done = time.time() - started >= self.bulk_delay
+            url = f"{self.base_url}/bulk/{op_id.rsplit('/', 1)[-1]}.jsonl"
+            return {"data": {"node": {"id": op_id, "status": "COMPLETED" if done else "RUNNING",
+                                      "errorCode": None, "objectCount": str(self.members) if done else "0",
+                                      "url": url if done else None}}}
+        if "metafieldDefinitions" in query:
+            first = int(re.search(r"metafields\(first:\s*(\d+)", query).group(1))
+            m = re.search(r'after:\s*"(\d+)"', query)
+            start = int(m.group(1)) if m else 0
+            self.requests.append(("metafields", start, first))
+            # 只有有客編的顧客才有 metafield；多取一位判斷還有沒有下一頁
+            ids = list(itertools.islice((i for i in range(start + 1, self.members + 1) if i % 10), first + 1))
+            has_next = len(ids) > first
+            ids = ids[:first]
+            edges = []
+            for i in ids:
+                c = self.node(i)
+                if not (c and c.get("goyoutati")):
+                    continue
+                owner = {k: v for k, v in c.items() if k != "goyoutati"}
+                edges.append({"cursor": str(i), "node": {"value": c["goyoutati"]["value"], "owner": owner}})
+            return {"data": {"metafieldDefinitions": {"edges": [{"node": {
+                "id": "gid://shopify/MetafieldDefinition/1",
+                "metafields": {"edges": edges, "pageInfo": {"hasNextPage": has_next}}}}]}}}
+        if "customer(id:" in query:
+            gid = (variables or {}).get("id") or ""
+            self.requests.append(("customer", gid))
+            i = int(gid.rsplit("/", 1)[-1]) if gid.rsplit("/", 1)[-1].isdigit() else 0
+            return {"data": {"customer": self.node(i) if 1 <= i <= self.members else None}}
+        m = re.search(r'goyoutati_id:\\?"G(\d+)', query)
+        if "customers(" in query and m:
+            i = int(m.group(1))
+            self.requests.append(("customer_by_code", f"G{i:05d}"))
+            c = self.node(i) if 1 <= i <= self.members else None
+            edges = [{"node": c}] if c and c.get("goyoutati") else []
+            return {"data": {"customers": {"edges": edges}}}
+        if "customers(" in query:
+            m = re.search(r"updated_at:>='([^']*)'", query)
+            since = m.group(1) if m else ""
+            self.requests.append(("customers_since", since))
+            # 合成資料不會變動：since 晚於 UPDATED_AT 就沒有異動
+            return {"data": {"customers": {"edges": [], "pageInfo": {"hasNextPage": False}}}}
+        return {"errors": [{"message": "standin: unsupported query"}]}
+
+    def metafields_set(self, metafields):
+        self.requests.append(("metafields_set", len(metafields)))
+        if len(metafields) > 25:
+            return {"errors": [{"message": "The input array size of 26 is greater than the maximum allowed of 25."}]}
+        errors, owners = [], []
+        for idx, mf in enumerate(metafields):
+            tail = mf["ownerId"].rsplit("/", 1)[-1]
+            i = int(tail) if tail.isdigit() else 0
+            if not (1 <= i <= self.members and self.node(i)):
+                errors.append({"field": ["metafields", str(idx), "ownerId"], "message": "Owner does not exist"})
+            owners.append(i)
+        if errors:      # 整批原子：有錯就全部不寫
+            return {"data": {"metafieldsSet": {"metafields": None, "userErrors": errors}}}
+        out = []
+        for i, mf in zip(owners, metafields):
+            self.edits[i] = dict(self.node(i), shippingRate={"value": mf["value"]})
+            out.append({"key": mf["key"], "value": mf["value"], "owner": {"id": mf["ownerId"]}})
+        return {"data": {"metafieldsSet": {"metafields": out, "userErrors": []}}}
+
+    def iter_jsonl(self):
+        for i in range(1, self.members + 1):
+            c = self.node(i)
+            if c:
+                yield (json.dumps(c, ensure_ascii=False) + "\n").encode("utf-8")
+
+    # ── 伺服器 ──
+
+    def start(self, host="127.0.0.1", port=0):
+        """背景執行緒啟動；回傳 SHOPIFY_ADMIN_URL"""
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                out = json.dumps(standin.graphql(body.get("query", ""), body.get("variables"))).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def do_GET(self):
+                if not self.path.startswith("/bulk/"):
+                    self.send_error(404)
+                    return
+                standin.requests.append(("bulk_download",))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/jsonl")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                buf = []
+                for line in standin.iter_jsonl():
+                    buf.append(line)
+                    if len(buf) >= 500:
+                        self._chunk(b"".join(buf))
+                        buf = []
+                if buf:
+                    self._chunk(b"".join(buf))
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://{host}:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="ShopifyStandin").start()
+        return f"{self.base_url}/admin/api/2026-01"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="本機假 Shopify Admin API")
+    ap.add_argument("--members", type=int, default=50000)
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--bulk-delay", type=float, default=1.0)
+    args = ap.parse_args()
+    admin_url = Standin(args.members, bulk_delay=args.bulk_delay).start(port=args.port)
+    print(f"[standin] {args.members} 位顧客 → SHOPIFY_ADMIN_URL={admin_url}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
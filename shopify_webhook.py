@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Shopify webhook 簽章（HMAC-SHA256）驗證 + 本機送簽好名的測試 webhook
+
+用法（app.py）：
+    import shopify_webhook
+
+    if not shopify_webhook.verify(request.get_data(), request.headers.get("X-Shopify-Hmac-Sha256"), secret):
+        return ..., 401
+    gid = shopify_webhook.customer_gid(topic, payload)   # 這個 webhook 影響哪一位顧客
+
+本機測試（不用真的 Shopify 後台，自己簽名送到本機 app）：
+    python shopify_webhook.py --secret xxx --topic customers/update --id 123 \\
+        --url http://127.0.0.1:5000/webhooks/shopify/customers
+
+簽章 = base64(HMAC-SHA256(app 的 client secret, 原始 request body))，放在 X-Shopify-Hmac-Sha256。
+驗證一定要用原始 bytes（不能先 json 解析再序列化），比對用 compare_digest 避免時間側通道。
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+
+CUSTOMER_TOPICS = ("customers/create", "customers/update", "customers/delete")
+
+
+def sign(body, secret):
+    """body（bytes）→ X-Shopify-Hmac-Sha256 標頭值"""
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def verify(body, header, secret):
+    if not secret or not header:
+        return False
+    return hmac.compare_digest(sign(body, secret), header.strip())
+
+
+def customer_gid(topic, payload):
+    """webhook 內容 → 受影響顧客的 gid（不是顧客相關的 webhook → None）
+
+    customers/*：payload 就是顧客（id / admin_graphql_api_id）；
+    metafields/*：payload 是 metafield，owner_resource == "customer" 時 owner_id 是顧客 id。
+    """
+    if topic in CUSTOMER_TOPICS:
+        gid = payload.get("admin_graphql_api_id")
+        cid = payload.get("id")
+    elif topic.startswith("metafields/") and payload.get("owner_resource") == "customer":
+        gid, cid = None, payload.get("owner_id")
+    else:
+        return None
+    if gid:
+        return gid
+    return f"gid://shopify/Customer/{cid}" if cid else None
+
+
+def headers(body, secret, topic, shop="standin.myshopify.com"):
+    """送一個簽好名的 webhook 需要的標頭（測試 / 本機重送用）"""
+    return {
+        "Content-Type": "application/json",
+        "X-Shopify-Topic": topic,
+        "X-Shopify-Shop-Domain": shop,
+        "X-Shopify-Hmac-Sha256": sign(body, secret),
+    }
+
+
+if __name__ == "__main__":
+    import requests
+
+    ap = argparse.ArgumentParser(description="送一個簽好名的 Shopify 顧客 webhook 到本機")
+    ap.add_argument("--url", default="http://127.0.0.1:5000/webhooks/shopify/customers")
+    ap.add_argument("--secret", required=True)
+    ap.add_argument("--topic", default="customers/update")
+    ap.add_argument("--id", type=int, required=True, help="Shopify customer id（數字）")
+    args = ap.parse_args()
+    if args.topic.startswith("metafields/"):
+        payload = {"owner_id": args.id, "owner_resource": "customer", "namespace": "custom"}
+    else:
+        payload = {"id": args.id, "admin_graphql_api_id": f"gid://shopify/Customer/{args.id}"}
+    raw = json.dumps(payload).encode("utf-8")
+    resp = requests.post(args.url, data=raw, headers=headers(raw, args.secret, args.topic), timeout=15)
+    print(resp.status_code, resp.text)
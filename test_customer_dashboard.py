@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""客戶首頁摘要測試（暫存 DB）
+
+customer_summary 由 trigger 維護：新增 / 改狀態 / 轉會員 / 刪除後，計數要和直接 COUNT 的結果一致；
+/api/me/dashboard 沒變動 → 304，有變動 → 新 ETag。
+台灣配送對應：貨況同步時依 export_code / {g_code}-{MMDD} 對到出貨單，客戶清單直接帶出單號。
+客戶端四個 GET（包裹 / 出貨申請 / 預報 / 地址）共用 per-g_code version：該會員有寫入才換 ETag，別人的寫入不影響。
+"""
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp()
+os.environ["DB_PATH"] = os.path.join(_tmp, "dashboard.db")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app as A
+import migrations
+
+A.DB_PATH = os.environ["DB_PATH"]
+A.init_db()
+conn = A.get_db()
+now = "2026-01-01 10:00:00"
+conn.executemany("INSERT INTO packages (g_code, logis_num, status, created_at) VALUES (?, ?, ?, ?)",
+                 [("G0001", f"1000{i}", "已到貨" if i % 2 else "已出貨", now) for i in range(30)])
+conn.executemany(
+    "INSERT INTO shipment_requests (g_code, package_ids, status, created_at, total_fee, payment_last5) "
+    "VALUES (?, '', ?, ?, ?, ?)",
+    [("G0001", "已出貨", now, 500, ""), ("G0001", "已出貨", now, 500, "12345"), ("G0001", "待處理", now, 0, ""),
+     ("G0002", "已出貨", now, 300, None)])
+conn.executemany("INSERT INTO forecasts (g_code, items_json, status, created_at) VALUES (?, '[]', ?, ?)",
+                 [("G0001", "待處理", now), ("G0001", "已處理", now)])
+conn.commit()
+
+
+def expected(g):
+    row = {}
+    for table, cols in migrations.CUSTOMER_SUMMARY.items():
+        for col, cond in cols.items():
+            row[col] = conn.execute(f"SELECT COUNT(*) FROM {table} WHERE g_code=?{' AND ' + cond if cond else ''}",
+                                    (g,)).fetchone()[0]
+    return row
+
+
+def summary(g):
+    row = conn.execute("SELECT * FROM customer_summary WHERE g_code=?", (g,)).fetchone()
+    return {k: row[k] for k in expected(g)} if row else None
+
+
+assert summary("G0001") == expected("G0001") == {
+    "packages_total": 30, "packages_waiting": 15, "requests_total": 3, "requests_unpaid": 1,
+    "forecasts_total": 2, "forecasts_pending": 1}
+assert summary("G0002")["requests_unpaid"] == 1
+
+client = A.app.test_client()
+r = client.get("/api/me/dashboard?g_code=g0001&limit=10")
+d = r.get_json()
+assert d["counts"] == expected("G0001")
+assert len(d["packages"]) == 10 and d["has_more"]["packages"] and not d["has_more"]["forecasts"]
+etag = r.headers["ETag"]
+assert client.get("/api/me/dashboard?g_code=G0001&limit=10", headers={"If-None-Match": etag}).status_code == 304
+# 分頁徽章只要數字：不撈清單，ETag 與帶清單的版本分開
+r = client.get("/api/me/dashboard?g_code=G0001&counts_only=1")
+assert r.get_json() == {"success": True, "counts": expected("G0001")} and r.headers["ETag"] != etag
+assert client.get("/api/me/dashboard?g_code=G0001&counts_only=1",
+                  headers={"If-None-Match": r.headers["ETag"]}).status_code == 304
+
+# 改狀態 / 付款 / 轉會員 / 刪除 → 計數跟著變、ETag 換新
+conn.execute("UPDATE packages SET status='已出貨' WHERE g_code='G0001' AND status='已到貨' AND id % 3 = 0")
+conn.execute("UPDATE shipment_requests SET payment_last5='00001' WHERE g_code='G0001' AND payment_last5=''")
+conn.execute("UPDATE forecasts SET g_code='G0002' WHERE g_code='G0001' AND status='待處理'")
+conn.execute("DELETE FROM packages WHERE g_code='G0001' AND id <= 4")
+conn.commit()
+for g in ("G0001", "G0002"):
+    assert summary(g) == expected(g), (g, summary(g), expected(g))
+assert summary("G0002")["forecasts_pending"] == 1
+r = client.get("/api/me/dashboard?g_code=G0001&limit=10", headers={"If-None-Match": etag})
+assert r.status_code == 200 and r.headers["ETag"] != etag
+assert r.get_json()["counts"] == expected("G0001")
+
+# 沒資料的會員：全 0
+assert client.get("/api/me/dashboard?g_code=G9999").get_json()["counts"]["packages_total"] == 0
+
+# 客戶端清單 GET：自己的寫入 → 新 ETag；別的會員寫入 → 還是 304
+URLS = ["/api/packages?g_code=G0001", "/api/shipment_requests?g_code=G0001",
+        "/api/my_forecasts?g_code=G0001", "/api/addresses?g_code=G0001"]
+
+
+def etags():
+    return [client.get(u).headers["ETag"] for u in URLS]
+
+
+def still_fresh(tags):
+    return [client.get(u, headers={"If-None-Match": t}).status_code == 304 for u, t in zip(URLS, tags)]
+
+
+tags = etags()
+assert all(still_fresh(tags))
+conn.execute("INSERT INTO addresses (g_code, recipient, phone, address, created_at) VALUES ('G0002', 'a', '1', 'x', ?)",
+             (now,))
+conn.execute("UPDATE packages SET note='x' WHERE g_code='G0002'")
+conn.commit()
+assert all(still_fresh(tags))
+for sql in ("INSERT INTO addresses (g_code, recipient, phone, address, created_at) VALUES ('G0001', 'a', '1', 'x', '')",
+            "UPDATE addresses SET is_default=1 WHERE g_code='G0001'",
+            "UPDATE packages SET note='到貨' WHERE id=(SELECT MAX(id) FROM packages WHERE g_code='G0001')",
+            "UPDATE shipment_requests SET admin_note='x' WHERE g_code='G0001'",
+            "INSERT INTO shipment_delivery (shipment_id, customer_code, tracking_num) VALUES (1, 'G0001-0101', '1')",
+            "DELETE FROM addresses WHERE g_code='G0001'"):
+    conn.execute(sql)
+    conn.commit()
+    assert not any(still_fresh(tags)), sql     # 同一個版本號 → 四個都換 ETag
+    tags = etags()
+
+# 台灣配送對應：export_code 優先，其次 {g_code}-{updated_at 的 MMDD}、{g_code}-{created_at 的 MMDD}
+conn.executemany(
+    "INSERT INTO shipment_requests (id, g_code, package_ids, status, created_at, updated_at, export_code) "
+    "VALUES (?, 'G0003', '', '已出貨', ?, ?, ?)",
+    [(101, "2026-03-01 10:00:00", "2026-03-05 10:00:00", "G0003-0310"),
+     (102, "2026-03-01 10:00:00", "2026-03-06 10:00:00", ""),
+     (103, "2026-03-02 10:00:00", "", ""),
+     (104, "2026-03-20 10:00:00", "", "")])
+conn.executemany("INSERT INTO delivery_tracking (customer_code, carrier, tracking_num) VALUES (?, ?, ?)",
+                 [("G0003-0310", "黑貓", "T1"), ("G0003-0305", "黑貓", "T0"), ("G0003-0306", "新竹", "H2"),
+                  ("G0003-0302", "黑貓", "T3"), ("G0003-0320", "黑貓", "")])
+conn.commit()
+codes = ["G0003-0310", "G0003-0305", "G0003-0306", "G0003-0302", "G0003-0320"]
+assert A._match_delivery_codes(conn, codes) == 3
+assert A._match_delivery_codes(conn, codes) == 0        # 再同步一次：沒有新對到的
+conn.commit()
+got = {r[0]: r[1] for r in conn.execute("SELECT shipment_id, tracking_num FROM shipment_delivery WHERE shipment_id > 100")}
+assert got == {101: "T1", 102: "H2", 103: "T3"}, got
+reqs = {r["id"]: r for r in client.get("/api/shipment_requests?g_code=G0003").get_json()["requests"]}
+assert reqs[102]["delivery_carrier"] == "新竹" and "hct" in reqs[102]["delivery_url"]
+assert "delivery_tracking" not in reqs[104]
+# 貨運行改單號 → 跟著改；出貨單 updated_at 變了 → 候選跟著變
+conn.execute("UPDATE delivery_tracking SET tracking_num='T1b' WHERE customer_code='G0003-0310'")
+conn.execute("UPDATE shipment_requests SET updated_at='2026-03-20 09:00:00' WHERE id=102")
+assert A._match_delivery_codes(conn, ["G0003-0310"]) == 0
+assert A._match_delivery_ids(conn, [102]) == 0
+conn.commit()
+got = {r[0]: r[1] for r in conn.execute("SELECT shipment_id, tracking_num FROM shipment_delivery WHERE shipment_id > 100")}
+assert got == {101: "T1b", 103: "T3"}, got
+conn.close()
+
+print("✅ 全部通過")
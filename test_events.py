@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""即時通知（SSE）測試（暫存 DB）
+
+兩個 EventBus 共用同一個 DB 檔 = 兩個 gunicorn worker：A 發的事件 B 的串流也收得到；
+Last-Event-ID 補送；rollback 的事件不會送出；名額滿 → None，close() 一定歸還名額（後台 / 客戶分開算）；
+/api/events 依身分篩選（客戶只收自己的、代理只收自己客戶的、管理員另收內部公告）。
+"""
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+_tmp = tempfile.mkdtemp()
+os.environ["DB_PATH"] = os.path.join(_tmp, "events.db")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app as A
+import dbpool
+import events
+
+A.DB_PATH = os.environ["DB_PATH"]
+A.init_db()
+
+
+def connect():
+    return dbpool.connect(A.DB_PATH, shared=False)
+
+
+def ids(chunks):
+    return [int(m) for m in re.findall(r"^id: (\d+)$", "".join(chunks), re.M)]
+
+
+bus_a = events.EventBus(connect, poll_ms=50, max_seconds=2, heartbeat=0.2)
+bus_b = events.EventBus(connect, poll_ms=50, max_seconds=2, heartbeat=0.2, max_streams=1)
+
+# B 開串流等著，A 發兩筆（一筆 rollback）→ B 只收到 commit 的那筆
+start = bus_b.last_id()
+body = bus_b.open(start, "audience = 'customer' AND g_code = ?", ["G0001"])
+assert body is not None
+assert bus_b.open(start, "1", []) is None            # 名額 1：第二條被拒
+got = []
+reader = threading.Thread(target=lambda: got.extend(body))
+reader.start()
+time.sleep(0.1)
+conn = connect()
+bus_a.publish(conn, "package.arrived", {"id": 1}, audience="customer", g_code="G0002")
+bus_a.publish(conn, "package.arrived", {"id": 2}, audience="customer", g_code="G0001")
+conn.commit()
+bus_a.publish(conn, "package.arrived", {"id": 3}, audience="customer", g_code="G0001")
+conn.rollback()
+conn.close()
+t0 = time.time()
+while len(ids(got)) < 1 and time.time() - t0 < 2:
+    time.sleep(0.01)
+latency = time.time() - t0
+reader.join()
+body.close()
+assert len(ids(got)) == 1 and '"id":2' in "".join(got), got
+assert latency < 0.5, latency
+assert got[0].startswith("retry:") and ": ping" in "".join(got)
+assert bus_b.metrics()["streams"] == 0
+first = ids(got)[0]
+
+# Last-Event-ID 補送：斷線期間發的事件，重連後從游標之後送
+conn = connect()
+for n in range(3):
+    bus_a.publish(conn, "shipment_request.updated", {"n": n}, audience="customer", g_code="G0001")
+conn.commit()
+conn.close()
+body = bus_b.open(first, "audience = 'customer' AND g_code = ?", ["G0001"])
+chunk = []
+for part in body:
+    chunk.append(part)
+    if len(ids(chunk)) == 3:
+        break
+body.close()
+assert ids(chunk) == list(range(first + 1, first + 4)), ids(chunk)
+
+# 沒讀過就關掉 → 名額照樣歸還
+body = bus_b.open(first, "1", [])
+body.close()
+assert bus_b.open(first, "1", []) is not None
+
+# 清舊事件
+conn = connect()
+conn.execute("UPDATE events SET created_at='2000-01-01 00:00:00' WHERE id <= ?", (first,))
+conn.commit()
+conn.close()
+assert bus_a.prune() == first
+
+# /api/events 依身分篩選
+conn = connect()
+conn.execute("INSERT INTO agents (username, password, prefix, name, created_at) VALUES ('ag', 'x', 'T', '代理', '')")
+conn.commit()
+conn.close()
+A._events = events.EventBus(connect, poll_ms=50, max_seconds=0.3, heartbeat=0.1)
+start = A._events.last_id()
+conn = connect()
+for kind, audience, g in (("shipment_request.created", "admin:0", "G0001"),
+                          ("shipment_request.created", "admin:1", "T0001"),
+                          ("internal_announcement.created", "staff", ""),
+                          ("package.arrived", "customer", "G0001"),
+                          ("package.arrived", "customer", "G0002"),
+                          ("announcement.created", "customers", "")):
+    A._events.publish(conn, kind, {}, audience=audience, g_code=g)
+conn.commit()
+conn.close()
+client = A.app.test_client()
+
+
+def kinds(session=None, query=""):
+    with client.session_transaction() as s:
+        s.clear()
+        s.update(session or {})
+    r = client.get("/api/events" + query, headers={"Last-Event-ID": str(start)})
+    assert r.status_code == 200 and r.mimetype == "text/event-stream", r.status_code
+    text = r.get_data(as_text=True)
+    return [(int(i), k) for i, k in re.findall(r"^id: (\d+)\nevent: (\S+)$", text, re.M)]
+
+
+boss = dict(user_type="admin", role="super", user_id=1, username="boss", agent_id=0)
+agent = dict(user_type="agent", role="agent", user_id=1, username="ag", agent_id=1, prefix="T")
+assert [k for _, k in kinds(boss)] == ["shipment_request.created", "shipment_request.created",
+                                       "internal_announcement.created"]
+assert [i - start for i, _ in kinds(agent)] == [2]
+assert [i - start for i, _ in kinds(query="?g_code=g0001")] == [4, 6]
+with client.session_transaction() as s:
+    s.clear()
+assert client.get("/api/events").status_code == 403
+
+# 客戶 / 後台名額分開：客戶串流佔滿（不用登入就能開）也不能讓管理員 503
+full = events.EventBus(connect, poll_ms=50, max_seconds=0.3, heartbeat=0.1, max_streams=1, max_customer_streams=1)
+full, A._events = A._events, full
+held = A._events.open(start, "0", [], pool="customer")
+with client.session_transaction() as s:
+    s.clear()
+assert client.get("/api/events?g_code=G0001").status_code == 503
+assert [k for _, k in kinds(boss)] == ["shipment_request.created", "shipment_request.created",
+                                       "internal_announcement.created"]
+held.close()
+assert A._events.metrics()["customer_streams"] == 0 and client.get("/api/events?g_code=G0001").status_code == 200
+A._events = full
+
+# 寫入端：客戶回報匯款 → 主站後台收到
+conn = connect()
+conn.execute("INSERT INTO shipment_requests (g_code, package_ids, status, created_at, total_fee) "
+             "VALUES ('G0001', '', '已出貨', '', 500)")
+conn.commit()
+conn.close()
+start = A._events.last_id()
+r = client.post("/api/shipment_requests/1/payment", json={"last5": "12345", "g_code": "G0001"})
+assert r.get_json()["success"]
+assert [k for _, k in kinds(boss)] == ["payment.reported"]
+
+# 後台改包裹狀態：改成已到貨才通知客戶（已經是到貨狀態再改不重發）
+conn = connect()
+pkg_id = conn.execute("INSERT INTO packages (g_code, logis_num, product_name, status, created_at) "
+                      "VALUES ('G0001', 'L1', '鞋子', '已出貨', '')").lastrowid
+conn.commit()
+conn.close()
+start = A._events.last_id()
+with client.session_transaction() as s:
+    s.clear()
+    s.update(boss)
+assert client.put(f"/api/admin/packages/{pkg_id}", json={"status": "已到貨"}).get_json()["success"]
+assert client.put(f"/api/admin/packages/{pkg_id}", json={"status": "已入庫"}).get_json()["success"]
+assert kinds(query="?g_code=G0001") == [(start + 1, "package.arrived")]
+
+print("✅ 全部通過")
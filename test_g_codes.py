@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""會員編號配號測試（暫存 DB）
+
+回填：既有編號的最大號 + 中間空號；配號先補最小空號再往上；手動指定 / 刪除會更新空號清單；
+多執行緒、各自連線同時配號不會撞號。
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import g_codes
+import migrations
+
+path = os.path.join(tempfile.mkdtemp(), "g_codes.db")
+conn = sqlite3.connect(path, timeout=30)
+migrations.migrate(conn)
+now = "2026-01-01 00:00:00"
+conn.execute("INSERT INTO agents (username, password, prefix, name, created_at) VALUES ('ag', 'x', 'T', '代理', ?)",
+             (now,))
+for code in ("T0001", "T0002", "T0005", "TX01"):
+    conn.execute("INSERT INTO members (g_code, agent_id, name, created_at) VALUES (?, 1, '客', ?)", (code, now))
+conn.execute("INSERT INTO shopify_members (gid, g_code) VALUES ('gid://shopify/Customer/1', 'G0003')")
+conn.commit()
+
+# 回填（= migration v18 做的事）
+for prefix in ("G", "T"):
+    g_codes.rebuild(conn, prefix)
+conn.commit()
+assert g_codes.peek(conn, "T") == (5, "T0003")
+assert g_codes.peek(conn, "G") == (3, "G0001")
+assert [r[0] for r in conn.execute("SELECT value FROM g_code_free WHERE prefix='T' ORDER BY value")] == [3, 4]
+
+# 配號：先補空號，補完往上
+assert [g_codes.allocate(conn, "T") for _ in range(3)] == ["T0003", "T0004", "T0006"]
+conn.rollback()     # 沒 INSERT 會員就 rollback → 號碼退回
+assert g_codes.peek(conn, "T") == (5, "T0003")
+
+# 手動指定跳號 → 序號推到後面；刪除 → 放回空號清單
+g_codes.claim(conn, "T0010")
+conn.execute("DELETE FROM members WHERE g_code='T0002'")
+g_codes.release(conn, "T0002")
+conn.commit()
+assert g_codes.peek(conn, "T") == (10, "T0002")
+assert g_codes.allocate(conn, "T") == "T0002"
+conn.rollback()
+
+# 新前綴（migration 之後才建的代理）第一次配號 → 當場回填
+assert g_codes.peek(conn, "K") == (0, "K0001")
+assert g_codes.allocate(conn, "K") == "K0001"
+conn.commit()
+conn.close()
+
+# 同時配號：8 條執行緒、各自連線，配號 + INSERT 同一交易
+codes, errors = [], []
+
+
+def worker():
+    c = sqlite3.connect(path, timeout=30)
+    try:
+        for _ in range(10):
+            code = g_codes.allocate(c, "T")
+            c.execute("INSERT INTO members (g_code, agent_id, name, created_at) VALUES (?, 1, '客', ?)", (code, now))
+            c.commit()
+            codes.append(code)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        c.close()
+
+
+threads = [threading.Thread(target=worker) for _ in range(8)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+assert not errors, errors
+assert len(codes) == 80 and len(set(codes)) == 80
+assert sorted(codes)[:3] == ["T0002", "T0003", "T0004"]
+
+print("✅ 全部通過")
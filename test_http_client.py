@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""http_client 測試（本機小伺服器，不連外）
+
+keep-alive 連線重用；503 重試、建單類（idempotent=False）不重送；GraphQL THROTTLED 等完重送；
+REST call-limit 快滿先等；連續失敗斷路、冷卻後放試探請求。
+"""
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import http_client
+
+http_client.BACKOFF_BASE = 0.01
+hits = {}
+ports = set()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=()):
+        out = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(out)
+
+    def handle_any(self):
+        n = hits[self.path] = hits.get(self.path, 0) + 1
+        ports.add(self.client_address[1])
+        if self.headers.get("Content-Length"):
+            self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/flaky" and n <= 2:
+            return self.reply(503, {"error": "busy"})
+        if self.path == "/graphql.json" and n == 1:
+            return self.reply(200, {"errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+                                    "extensions": {"cost": {"requestedQueryCost": 50, "throttleStatus": {
+                                        "maximumAvailable": 1000, "currentlyAvailable": 40, "restoreRate": 100}}}})
+        if self.path == "/limit":
+            return self.reply(200, {"ok": n}, [("X-Shopify-Shop-Api-Call-Limit", "40/40")])
+        return self.reply(200, {"ok": n})
+
+    do_GET = do_POST = handle_any
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+server.daemon_threads = True
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base = f"http://127.0.0.1:{server.server_address[1]}"
+
+# keep-alive：連續呼叫同一條連線
+for _ in range(5):
+    assert http_client.request("GET", f"{base}/ok", timeout=5).json()["ok"]
+assert len(ports) == 1, ports
+
+# 503 → 重試到成功；建單類不重送
+assert http_client.request("GET", f"{base}/flaky", timeout=5).status_code == 200 and hits["/flaky"] == 3
+hits.pop("/flaky")
+assert http_client.request("POST", f"{base}/flaky", json={}, timeout=5, idempotent=False).status_code == 503
+assert hits["/flaky"] == 1
+
+# GraphQL：THROTTLED → 依 throttleStatus 等到點數補回（(50-40)/100 = 0.1s）再送
+t0 = time.time()
+data = http_client.graphql(f"{base}/graphql.json", {"query": "{ shop { name } }"})
+assert data == {"ok": 2} and time.time() - t0 >= 0.09, data
+
+# REST call-limit 40/40 → 下一次先等（每秒補 2，要等約 1s）
+http_client.request("GET", f"{base}/limit", timeout=5)
+t0 = time.time()
+http_client.request("GET", f"{base}/limit", timeout=5)
+assert 0.8 <= time.time() - t0 < 3
+
+# 斷路器：連不上的 host 連續失敗 → 直接丟 CircuitOpenError；冷卻後放一個試探
+s = socket.socket()
+s.bind(("127.0.0.1", 0))
+dead = f"http://127.0.0.1:{s.getsockname()[1]}/x"
+s.close()
+http_client.BREAKER_COOLDOWN = 0.2
+for _ in range(http_client.BREAKER_THRESHOLD):
+    try:
+        http_client.request("GET", dead, timeout=1)
+        raise AssertionError("應該連不上")
+    except http_client.CircuitOpenError:
+        raise AssertionError("還沒到門檻")
+    except Exception:
+        pass
+try:
+    http_client.request("GET", dead, timeout=1)
+    raise AssertionError("斷路中應直接失敗")
+except http_client.CircuitOpenError:
+    pass
+time.sleep(0.25)
+try:
+    http_client.request("GET", dead, timeout=1)
+except http_client.CircuitOpenError:
+    raise AssertionError("冷卻後要放試探請求")
+except Exception:
+    pass
+# 試探請求丟了 requests 以外的例外 → 照樣結算，下次冷卻後還是要放試探
+time.sleep(0.25)
+try:
+    http_client.request("GET", dead, timeout=1, bogus=1)
+    raise AssertionError("參數錯誤應該丟 TypeError")
+except TypeError:
+    pass
+time.sleep(0.25)
+try:
+    http_client.request("GET", dead, timeout=1)
+except http_client.CircuitOpenError:
+    raise AssertionError("試探旗標沒放掉")
+except Exception:
+    pass
+
+m = {x["host"]: x for x in http_client.metrics()}
+local = m[base.split("//")[1]]
+assert local["retries"] >= 3 and local["throttle_waits"] >= 2 and local["p95_ms"] > 0, local
+assert m[dead.split("//")[1].split("/")[0]]["fast_fails"] == 1
+
+server.shutdown()
+print("✅ 全部通過")
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""熱門查詢的 EXPLAIN QUERY PLAN 回歸測試（合成資料，不連 Shopify / 貨況試算表）
+
+作法：建一個大一點的暫存 DB → 用 test client 打各個後台 / 客戶端 GET 端點 →
+用 set_trace_callback 收集實際送出的 SQL → 逐條 EXPLAIN QUERY PLAN。
+有 WHERE 條件卻對熱門資料表整表 SCAN（沒走任何索引）就算退化，測試失敗。
+
+沒有 WHERE 的純列表（ORDER BY id DESC LIMIT ?）本來就是依 rowid 倒著讀，不算；
+ALLOW 裡是刻意容許的全表掃描，每條都寫明原因。
+"""
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+_tmp = tempfile.mkdtemp()
+os.environ["DB_PATH"] = os.path.join(_tmp, "plans.db")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app as A
+import dbpool
+import migrations
+
+TRACKED = {"packages", "shipment_requests", "forecasts", "addresses", "delivery_tracking", "shipment_delivery",
+           "members", "shopify_members", "staff_schedules", "customer_vendor_codes", "agent_payouts"}
+
+# (SQL 片段 regex, 原因)
+ALLOW = [
+    (r"LIKE '%", "關鍵字模糊搜尋（前後 %），B-tree 索引幫不上"),
+    (r"work_date LIKE '\d{4}-\d{2}%'", "班表月份前綴：資料量極小（每月幾十筆）"),
+]
+
+N_CUSTOMERS = 400
+N_PACKAGES = 20000
+N_REQUESTS = 6000
+
+
+def seed(path):
+    conn = sqlite3.connect(path)
+    now = datetime.now()
+    conn.execute("INSERT OR IGNORE INTO agents (id, username, password, prefix, name, created_at) "
+                 "VALUES (1, 'ag1', 'x', 'T', '測試代理', ?)", (now.strftime("%Y-%m-%d %H:%M:%S"),))
+    # 避免 admin_get_shipment_requests 觸發背景貨況同步（會連外）
+    conn.execute("INSERT OR REPLACE INTO admin_settings (key, value) VALUES ('tracking_last_sync', ?)",
+                 (now.strftime("%Y-%m-%d %H:%M:%S"),))
+    conn.executemany(
+        "INSERT INTO members (g_code, agent_id, name, phone, status, created_at) VALUES (?, 1, ?, ?, 'active', ?)",
+        [(f"T{i:04d}", f"會員{i}", f"09{i:08d}", "2026-01-01") for i in range(1, 51)]
+    )
+    pkgs = []
+    for i in range(N_PACKAGES):
+        g = f"G{i % N_CUSTOMERS:04d}"
+        d = (now - timedelta(days=i % 120)).strftime("%Y-%m-%d")
+        status = "已出貨" if i % 5 else "已到貨"
+        pkgs.append((g, f"{100000000000 + i}", f"商品{i}", str(0.5 + i % 7), status, d,
+                     d + " 10:00:00", 1 if i % 10 == 0 else 0, "信件" if i % 17 == 0 else "包裹"))
+    conn.executemany(
+        "INSERT INTO packages (g_code, logis_num, product_name, weight, status, in_date, created_at, agent_id, pkg_type) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", pkgs
+    )
+    reqs = []
+    statuses = ["已出貨", "已出貨", "已出貨", "待處理", "處理中"]
+    for i in range(N_REQUESTS):
+        g = f"G{i % N_CUSTOMERS:04d}"
+        d = (now - timedelta(days=i % 120)).strftime("%Y-%m-%d %H:%M:%S")
+        st = statuses[i % len(statuses)]
+        paid = st == "已出貨" and i % 3 != 0
+        reqs.append((g, f"客戶{i}", f"{i * 3 + 1},{i * 3 + 2}", st, d, d, 3.0, 600 if st == "已出貨" else 0,
+                     f"{i % 100000:05d}" if paid else "", d if paid else "",
+                     d if paid and i % 2 else "", f"B{i // 50}" if paid and i % 2 else "",
+                     1 if i % 10 == 0 else 0))
+    conn.executemany(
+        "INSERT INTO shipment_requests (g_code, customer_name, package_ids, status, created_at, updated_at, "
+        "billed_weight, total_fee, payment_last5, payment_at, exported_at, exported_batch_id, agent_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", reqs
+    )
+    conn.executemany(
+        "INSERT INTO shipment_packages (shipment_id, seq, package_id) VALUES (?, ?, ?)",
+        [(i + 1, k, i * 3 + 1 + k) for i in range(N_REQUESTS) for k in range(2)]
+    )
+    conn.executemany(
+        "INSERT INTO forecasts (g_code, items_json, status, created_at, agent_id) VALUES (?, '[]', ?, ?, ?)",
+        [(f"G{i % N_CUSTOMERS:04d}", "待處理" if i % 4 == 0 else "已處理", "2026-01-01",
+          1 if i % 10 == 0 else 0) for i in range(4000)]
+    )
+    conn.executemany(
+        "INSERT INTO addresses (g_code, recipient, phone, address, is_default, created_at) VALUES (?, 'a', '0912', 'x', ?, '2026-01-01')",
+        [(f"G{i % N_CUSTOMERS:04d}", 1 if i < N_CUSTOMERS else 0) for i in range(1200)]
+    )
+    conn.executemany(
+        "INSERT INTO delivery_tracking (customer_code, carrier, tracking_num, synced_at) VALUES (?, '黑貓', ?, '')",
+        [(f"G{i:04d}-0101", f"{900000 + i}") for i in range(N_CUSTOMERS)]
+    )
+    migrations.match_shipment_delivery(
+        conn, conn.execute(f"SELECT {migrations.DELIVERY_MATCH_COLS} FROM shipment_requests").fetchall())
+    conn.commit()
+    conn.close()
+
+
+def capture(client, url):
+    """打一次端點，回傳這次送出的 SQL（參數已展開）。"""
+    pool = dbpool.get_pool(A.DB_PATH)
+    conn = pool.acquire()
+    stmts = []
+
+    def trace(sql):
+        if not sql.startswith("--"):    # trigger / FTS5 內部語句
+            stmts.append(sql)
+    conn.set_trace_callback(trace)
+    pool.release(conn)       # 池子是 LIFO，接下來這個 request 借到的就是這條
+    r = client.get(url)
+    assert r.status_code == 200, (url, r.status_code, r.data[:200])
+    conn = pool.acquire()
+    conn.set_trace_callback(None)
+    pool.release(conn)
+    return stmts
+
+
+def full_scans(conn, sql):
+    plan = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+    bad = []
+    for row in plan:
+        m = re.fullmatch(r"SCAN (\w+)", row[3])
+        if m and m.group(1) in TRACKED:
+            bad.append(row[3])
+    return bad
+
+
+def check(sql):
+    head = sql.lstrip().split(None, 1)[0].upper()
+    if head not in ("SELECT", "UPDATE", "DELETE"):
+        return None
+    if " WHERE " not in re.sub(r"\s+", " ", sql.upper()):
+        return None
+    for pattern, _why in ALLOW:
+        if re.search(pattern, sql):
+            return None
+    return full_scans(plan_conn, sql) or None
+
+
+A.DB_PATH = os.environ["DB_PATH"]
+A.init_db()
+seed(A.DB_PATH)
+plan_conn = sqlite3.connect(A.DB_PATH)
+
+month = datetime.now().strftime("%Y-%m")
+d_from = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+d_to = datetime.now().strftime("%Y-%m-%d")
+
+CUSTOMER_URLS = [
+    "/api/packages?g_code=G0001",
+    "/api/shipment_requests?g_code=G0001",
+    "/api/my_forecasts?g_code=G0001",
+    "/api/addresses?g_code=G0001",
+    "/api/me/dashboard?g_code=G0001",
+]
+ADMIN_URLS = [
+    "/api/admin/packages",
+    "/api/admin/packages?status=未出貨",
+    "/api/admin/packages?status=已到貨",
+    "/api/admin/packages?q=G0001",
+    "/api/admin/packages?q=商品1&sort=rank",
+    "/api/admin/packages?status=未出貨&after_id=15000",
+    "/api/admin/packages?before_id=100",
+    "/api/admin/shipment_requests",
+    "/api/admin/shipment_requests?status=待處理",
+    "/api/admin/shipment_requests?status=已付款",
+    "/api/admin/shipment_requests?pay=unpaid",
+    "/api/admin/shipment_requests?pay=paid",
+    "/api/admin/shipment_requests?pay=all",
+    "/api/admin/shipment_requests?pay=paid&after_id=3000",
+    "/api/admin/shipment_requests?status=待處理&after_id=3000",
+    "/api/admin/shipment_requests?q=客戶12",
+    "/api/admin/shipment_requests?pay=paid&q=G00",
+    f"/api/admin/shipment_requests?status=已出貨&date_from={d_from}&date_to={d_to}",
+    "/api/admin/forecasts?status=待處理",
+    "/api/admin/forecasts?g_code=G0001",
+    "/api/admin/forecasts?g_code=G0001&status=待處理",
+    "/api/admin/old_packages?days=30",
+    "/api/admin/scan?code=0042",
+    "/api/admin/scan?code=100000000042",
+    "/api/admin/customer_unpaid/G0001",
+    "/api/admin/badges",
+    "/api/admin/stats/monthly",
+    f"/api/admin/stats/monthly/detail?month={month}",
+]
+# 代理看不到：每日營運 / 班表（限管理員）、匯出 / 操作紀錄（限老闆）
+BOSS_URLS = [
+    "/api/admin/stats/daily",
+    f"/api/admin/stats/daily?date_from={d_from}&date_to={d_to}",
+    "/api/admin/exports/pending",
+    "/api/admin/exports/history",
+    f"/api/admin/schedules?months={month}",
+    "/api/admin/operation_logs",
+    "/api/admin/operation_logs?q=出貨處理",
+    "/api/admin/operation_logs?after_id=5",
+    "/api/admin/search_members?q=G0001",
+]
+AGENT_URLS = ["/api/admin/members", "/api/admin/members?limit=50&page=2&q=T00&sort=g_code&order=desc",
+              "/api/admin/search_members?q=T00", "/api/agent/payouts"]
+
+client = A.app.test_client()
+failures = []
+seen = 0
+for session, urls in (
+    (dict(user_type="admin", role="super", user_id=1, username="boss", agent_id=0), CUSTOMER_URLS + ADMIN_URLS + BOSS_URLS),
+    (dict(user_type="agent", role="agent", user_id=1, username="ag1", agent_id=1, prefix="T"), ADMIN_URLS + AGENT_URLS),
+):
+    with client.session_transaction() as s:
+        s.clear(); s.update(session)
+    for url in urls:
+        for sql in capture(client, url):
+            seen += 1
+            bad = check(sql)
+            if bad:
+                failures.append(f"{url}\n    {' '.join(sql.split())[:300]}\n    → {bad}")
+
+plan_conn.close()
+assert seen > 50, f"只收到 {seen} 條 SQL，trace 沒接上？"
+assert not failures, "整表掃描：\n" + "\n".join(failures)
+print(f"✅ 全部通過（檢查 {seen} 條 SQL）")
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Shopify 會員匯入測試（本機假 Shopify：shopify_standin.py，不連外）
+
+批次匯出 5 萬位顧客 → 快取裡要有全部 4.5 萬位會員（每 10 位有 1 位沒客編）；
+批次作業失敗 → 改走分頁也不能再卡 1000 位；之後的增量同步只問 updatedAt ≥ hwm 的顧客；
+多個 worker 行程同時冷啟動只會有一個去抓 Shopify；顧客 webhook（自己簽名）只改那一位會員；
+完全沒有快取時登入只查那一位（不等整份名單）；改運費直接寫回快取、批次每 25 位一次。
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from shopify_standin import Standin, UPDATED_AT, customer
+
+N = 50000
+standin = Standin(members=N)
+_tmp = tempfile.mkdtemp()
+os.environ["SHOPIFY_ADMIN_URL"] = standin.start()
+os.environ["DB_PATH"] = os.path.join(_tmp, "bulk.db")
+os.environ["SHOPIFY_CACHE_FILE"] = os.path.join(_tmp, "shopify_cache.json")
+
+import app as A
+
+# 同一個 pytest 行程裡 app 可能已被別的測試先 import：設定直接蓋過去（DB 也換成自己的），並等開機預熱跑完
+A.SHOPIFY_ADMIN_URL = os.environ["SHOPIFY_ADMIN_URL"]
+A.SHOPIFY_CACHE_FILE = os.environ["SHOPIFY_CACHE_FILE"]
+if A._refresh_thread is not None:
+    A._refresh_thread.join(120)
+A.DB_PATH = os.environ["DB_PATH"]
+A.init_db()
+standin.requests.clear()
+
+t0 = time.time()
+members = A._sync_customers(full=True)
+assert len(members) == N - N // 10, len(members)
+assert ("bulk_download",) in standin.requests
+assert not any(r[0] == "metafields" for r in standin.requests), "批次匯入成功就不該再走分頁"
+m = members[-1]
+assert m["g_code"] == f"G{N - 1:05d}" and m["phone"].startswith("09") and m["updated_at"] == UPDATED_AT
+print(f"批次匯入 {len(members)} 位：{time.time() - t0:.2f}s")
+
+# 鏡像表：與快取同步，管理端會員清單 / 搜尋 / 掃描直接在 SQL 裡 JOIN
+conn = A.get_db()
+assert conn.execute("SELECT COUNT(*) FROM shopify_members").fetchone()[0] == len(members)
+conn.close()
+assert A._member_fallback_map(A.get_db(), ["G00001", "G99999"])["G00001"]["address"] == members[0]["address"]
+
+# 會員索引：登入不再線性掃描
+d = A.member_directory()
+assert len(d) == len(members) and d.get("G00001")["gid"] == "gid://shopify/Customer/1"
+client = A.app.test_client()
+r = client.post("/api/verify_customer", json={"customer_id": "00007", "password": members[6]["phone"]}).get_json()
+assert r["success"] and r["customer"]["g_code"] == "G00007", r
+r = client.post("/api/verify_customer", json={"customer_id": "G00007", "password": "0900000000"}).get_json()
+assert not r["success"] and "密碼錯誤" in r["error"]
+
+# 快取過期 → 增量：只問 hwm 之後有異動的
+A._customers_cache = dict(A._customers_cache, time=0)
+standin.requests.clear()
+assert A._sync_customers() is not None
+assert standin.requests == [("customers_since", UPDATED_AT)], standin.requests
+
+# 管理端：會員總表 / 搜尋從鏡像表 UNION 本地會員
+with client.session_transaction() as sess:
+    sess.update(user_type="admin", role="super", user_id=1, username="boss", agent_id=0)
+r = client.get("/api/admin/search_members?q=G0420&limit=3").get_json()
+assert [m["g_code"] for m in r["results"]] == ["G04201", "G04202", "G04203"], r
+assert r["results"][0]["source"] == "shopify"
+r = client.get("/api/admin/search_members", query_string={"q": members[41]["phone"]}).get_json()
+assert [m["g_code"] for m in r["results"]] == [members[41]["g_code"]], r
+r = client.get("/api/admin/search_members", query_string={"q": members[41]["name"][1:], "limit": 50}).get_json()
+assert members[41]["g_code"] in [m["g_code"] for m in r["results"]], "姓名子字串要補比對"
+assert client.get("/api/admin/search_members?q=測試路12345號").get_json()["results"] == []
+r = client.get("/api/admin/members?limit=5&q=%20-%20").get_json()
+assert r["total"] == 0 and r["total_all"] == len(members), "電話正規化後是空字串 → 不能 LIKE '%%' 全中"
+
+# 批次作業啟動失敗 → 分頁後備，超過 1000 位也要全部抓到
+standin.members, standin.fail_bulk = 3000, True
+standin.requests.clear()
+t0 = time.time()
+members = A.get_all_goyoutati_customers(force_refresh=True)
+assert len(members) == 2700, len(members)
+assert sum(1 for r in standin.requests if r[0] == "metafields") == 11
+print(f"分頁後備 {len(members)} 位：{time.time() - t0:.2f}s")
+
+# 多個 worker 行程共用磁碟快取：同時冷啟動只有一個真的去抓（其他等它寫好直接讀）
+standin.fail_bulk, standin.bulk_delay = False, 1.0
+os.remove(A.SHOPIFY_CACHE_FILE)
+standin.requests.clear()
+worker = ("import sys; sys.path.insert(0, %r); import app as A; "
+          "print('N', len(A.get_all_goyoutati_customers()))" % os.path.dirname(os.path.abspath(__file__)))
+env = dict(os.environ, DB_PATH=A.DB_PATH)
+procs = [subprocess.Popen([sys.executable, "-c", worker], env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, text=True) for _ in range(3)]
+outs = [p.communicate(timeout=120)[0] for p in procs]
+assert all("N 2700" in o for o in outs), outs
+assert sum(1 for r in standin.requests if r[0] == "bulk_run") == 1, standin.requests
+
+# 顧客 webhook：簽章不對拒收；update / delete 只動那一位（快取、鏡像表、磁碟都要跟上）
+import json
+import shopify_webhook
+
+A.SHOPIFY_WEBHOOK_SECRET = "standin-secret"
+
+
+def webhook(topic, payload, secret=A.SHOPIFY_WEBHOOK_SECRET):
+    raw = json.dumps(payload).encode("utf-8")
+    return client.post("/webhooks/shopify/customers", data=raw,
+                       headers=shopify_webhook.headers(raw, secret, topic))
+
+
+assert webhook("customers/update", {"id": 7}, secret="wrong").status_code == 401
+edited = customer(7)
+edited["defaultAddress"]["phone"], edited["shippingRate"] = "+886 911222333", {"value": "150"}
+standin.edits[7] = edited
+standin.requests.clear()
+r = webhook("customers/update", {"id": 7, "admin_graphql_api_id": "gid://shopify/Customer/7"})
+assert r.status_code == 200 and r.get_json()["applied"], r.get_json()
+assert standin.requests == [("customer", "gid://shopify/Customer/7")], "webhook 不能觸發整批重抓"
+m = A.member_directory().get("G00007")
+assert m["phone"] == "0911222333" and m["shipping_rate"] == "150"
+assert A.member_directory().get("G00008")["phone"] == members[7]["phone"]
+r = webhook("metafields/update", {"owner_id": 8, "owner_resource": "customer"})
+assert r.status_code == 200 and A.member_directory().get("G00008") is not None
+# 整批同步佔著更新鎖 → 不跟著等（最多 CHANGE_LOCK_WAIT 秒），回 503 讓 Shopify 重送
+A.CHANGE_LOCK_WAIT = 0.2
+with A._refresh_lock():
+    t0 = time.time()
+    assert webhook("customers/delete", {"id": 7}).status_code == 503
+    assert time.time() - t0 < 2 and A.member_directory().get("G00007") is not None
+assert webhook("customers/delete", {"id": 7}).status_code == 200
+assert A.member_directory().get("G00007") is None and len(A.member_directory()) == 2699
+conn = A.get_db()
+assert conn.execute("SELECT COUNT(*) FROM shopify_members WHERE g_code='G00007'").fetchone()[0] == 0
+conn.close()
+with open(A.SHOPIFY_CACHE_FILE, encoding="utf-8") as f:
+    assert len(json.load(f)["data"]) == 2699
+assert webhook("orders/create", {"id": 1}).get_json().get("ignored") == "orders/create"
+
+# 冷啟動（磁碟快取 / 鏡像表都沒了）：登入只問 Shopify 這一個客編，整份名單在背景暖
+A._customers_cache = {"data": None, "time": 0, "hwm": "", "full_time": 0}
+os.remove(A.SHOPIFY_CACHE_FILE)
+conn = A.get_db()
+conn.execute("DELETE FROM shopify_members")
+conn.commit()
+conn.close()
+A._next_refresh_try = 0
+standin.bulk_delay = 3.0
+standin.requests.clear()
+t0 = time.time()
+phone9 = A.normalize_phone(customer(9)["defaultAddress"]["phone"])
+r = client.post("/api/verify_customer", json={"customer_id": "G00009", "password": phone9}).get_json()
+assert r["success"] and r["customer"]["g_code"] == "G00009", r
+assert time.time() - t0 < 2, "冷啟動登入不能等整份名單"
+r = client.post("/api/verify_customer", json={"customer_id": "G00009", "password": "0900000000"}).get_json()
+assert not r["success"] and "密碼錯誤" in r["error"]
+r = client.post("/api/verify_customer", json={"customer_id": "G00010", "password": phone9}).get_json()
+assert not r["success"] and "找不到" in r["error"]
+assert [q for q in standin.requests if q[0] == "customer_by_code"] == [
+    ("customer_by_code", "G00009"), ("customer_by_code", "G00010")], "同一客編第二次要走 LRU"
+if A._refresh_thread is not None:
+    A._refresh_thread.join(60)
+assert len(A.member_directory()) == 2700 and A.lookup_shopify_member("G00009")["phone"] == phone9
+
+# 運費：寫回快取 / 鏡像表（不整批重抓）；批次每 25 位一次 metafieldsSet，壞掉的那位剔掉其餘重送
+standin.requests.clear()
+r = client.post("/api/admin/shipping_rate", json={"customer_gid": "gid://shopify/Customer/11", "shipping_rate": "222"})
+assert r.get_json()["success"] and A.member_directory().get("G00011")["shipping_rate"] == "222"
+bad = "gid://shopify/Customer/999999"
+items = [{"customer_gid": bad, "shipping_rate": 150}] + [
+    {"customer_gid": f"gid://shopify/Customer/{i}", "shipping_rate": 150} for i in range(21, 81)]
+r = client.post("/api/admin/shipping_rate/bulk", json={"items": items}).get_json()
+assert r["updated"] == 60 and [f["customer_gid"] for f in r["failed"]] == [bad], r
+assert [q for q in standin.requests if q[0] != "metafields_set"] == [], "改運費不能觸發重抓"
+assert [q[1] for q in standin.requests] == [1, 25, 24, 25, 11], standin.requests
+assert A.member_directory().get("G00021")["shipping_rate"] == "150"
+conn = A.get_db()
+assert conn.execute("SELECT shipping_rate FROM shopify_members WHERE g_code='G00079'").fetchone()[0] == "150"
+conn.close()
+
+# 限流用光重試額度：剔掉 userErrors 重送不佔額度，最後還沒送出去的也要算失敗（不能當成功）
+throttled = {"errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}]}
+user_error = {"data": {"metafieldsSet": {"metafields": None, "userErrors": [
+    {"field": ["metafields", "0", "ownerId"], "message": "Owner does not exist"}]}}}
+ok = {"data": {"metafieldsSet": {"metafields": [{"id": "x"}], "userErrors": []}}}
+five = {f"gid://shopify/Customer/{i}": 180 for i in range(81, 86)}
+real_graphql = A.shopify_graphql
+for replies, n_failed in (([throttled, throttled, user_error, ok], 1),
+                          ([throttled, throttled, user_error] + [throttled] * 3, 5)):
+    sent = []
+    A.shopify_graphql = lambda q, v, replies=replies: sent.append(len(v["metafields"])) or replies[len(sent) - 1]
+    failed = A._set_shipping_rates(five)
+    assert len(failed) == n_failed and sent[-1] == 4, (failed, sent)
+A.shopify_graphql = real_graphql
+
+# 批次作業狀態查詢一直回 errors → 連續幾次就放棄，不空等到逾時
+replies = iter([{"data": {"bulkOperationRunQuery": {"bulkOperation": {"id": "op1"}, "userErrors": []}}}]
+               + [{"errors": [{"message": "Internal error"}]}] * A.shopify_bulk.POLL_ERRORS_MAX)
+t0 = time.time()
+try:
+    A.shopify_bulk.run_query(lambda q, v: next(replies), "{ customers { edges { node { id } } } }", poll_sec=0.01)
+    raise AssertionError("應該丟 BulkOperationError")
+except A.shopify_bulk.BulkOperationError as e:
+    assert "Internal error" in str(e) and time.time() - t0 < 1, e
+assert A.member_directory().get("G00082")["shipping_rate"] == "180"
+
+standin.stop()
+print("✅ 全部通過")